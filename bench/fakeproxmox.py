@@ -0,0 +1,475 @@
+#! /usr/bin/env python
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+import ssl
+import threading
+import time
+
+logger = logging.getLogger('fakeproxmox')
+
+GiB = 1024**3
+SIZE_SUFFIX = {'K': 1024, 'M': 1024**2, 'G': GiB, 'T': 1024**4}
+
+
+def size_bytes(size):
+    """ bytes of a proxmox disk size, a plain number is in GiB """
+    m = re.match(r'(\d+(?:\.\d+)?)([KMGT]?)$', size)
+    if m is None:
+        return 0
+    return int(float(m.group(1)) * SIZE_SUFFIX.get(m.group(2), GiB))
+
+
+class FakeCluster:
+    """ state of the stand-in cluster, shared by the api and the ssh
+    target: nodes, shared storage volumes, templates and the vms created by
+    the clones, with the timeline of every vm """
+
+    def __init__(self, nodes=8, volumes=('vol01', 'vol02'), templates=(),
+                 clone_time=1.0, node_cpus=64, node_ram=512 * GiB,
+                 volume_size=16 * 1024 * GiB, template_size=10 * GiB):
+        self.lock = threading.RLock()
+        self.nodes = ['node%02d' % i for i in range(1, nodes + 1)]
+        self.node_cpus = node_cpus
+        self.node_ram = node_ram
+        self.clone_time = clone_time
+        self.template_size = template_size
+        self.volumes = dict((volume, {'total': volume_size, 'used': 0,
+                                      'history': [(time.time(), 0)]})
+                            for volume in volumes)
+        self.vms = {}
+        self.tasks = {}
+        self.isos = {}
+        for i, name in enumerate(templates):
+            vmid = 9000 + i
+            volume = sorted(self.volumes)[0]
+            self.vms[vmid] = {
+                'vmid': vmid, 'name': name, 'node': self.nodes[0],
+                'template': 1, 'source': None, 'status': 'stopped',
+                'config': {'name': name, 'memory': '2048', 'cores': '1',
+                           'sockets': '1', 'template': 1,
+                           'bootdisk': 'virtio0',
+                           'virtio0': '%s:base-%s-disk-0.raw,size=%sG'
+                           % (volume, vmid, template_size // GiB)},
+                'timeline': {}}
+
+    def allocate(self, volume, size):
+        """ use size bytes of a volume, False if missing or full """
+        with self.lock:
+            if volume not in self.volumes:
+                return False
+            state = self.volumes[volume]
+            if state['used'] + size > state['total']:
+                return False
+            state['used'] += size
+            state['history'].append((time.time(), state['used']))
+            return True
+
+    def node_status(self, node):
+        """ status of a node, loaded by its running vms """
+        with self.lock:
+            running = [vm for vm in self.vms.values()
+                       if vm['node'] == node and vm['status'] == 'running']
+        used = sum(int(vm['config'].get('memory', 0)) * 1048576
+                   for vm in running)
+        load = '%.2f' % (0.25 * len(running))
+        return {'cpuinfo': {'cpus': self.node_cpus},
+                'loadavg': [load, load, load],
+                'memory': {'total': self.node_ram,
+                           'free': self.node_ram - used,
+                           'used': used}}
+
+    def storage(self):
+        """ status of the shared volumes, the same on every node """
+        with self.lock:
+            return [{'storage': volume, 'type': 'nfs', 'active': 1,
+                     'total': state['total'], 'used': state['used'],
+                     'avail': state['total'] - state['used']}
+                    for volume, state in sorted(self.volumes.items())]
+
+    def rrd(self, volume):
+        """ used space samples of a volume in the last hour """
+        with self.lock:
+            history = list(self.volumes[volume]['history'])
+        since = time.time() - 3600
+        samples = [{'time': int(t), 'used': used, 'total':
+                    self.volumes[volume]['total']}
+                   for t, used in history if t >= since]
+        return samples or [{'time': int(history[-1][0]),
+                            'used': history[-1][1]}]
+
+    def resources(self):
+        with self.lock:
+            return [{'type': 'qemu', 'id': 'qemu/%s' % vm['vmid'],
+                     'vmid': vm['vmid'], 'name': vm['name'],
+                     'node': vm['node'], 'status': vm['status'],
+                     'template': vm['template']}
+                    for vm in self.vms.values()]
+
+    def next_id(self, vmid=None):
+        """ the first free id from 100, or vmid if free, None if used """
+        with self.lock:
+            if vmid is not None:
+                return None if vmid in self.vms else vmid
+            vmid = 100
+            while vmid in self.vms:
+                vmid += 1
+            return vmid
+
+    def clone(self, node, source, params):
+        """ start a clone task, the new id is taken at once: return the
+        upid or an error message """
+        with self.lock:
+            template = self.vms.get(source)
+            if template is None:
+                return None, 'vm %s does not exist' % source
+            newid = int(params['newid'])
+            if newid in self.vms:
+                return None, 'vm %s already exists' % newid
+            full = params.get('full', '1') == '1'
+            volume = params.get('storage') or \
+                template['config']['virtio0'].split(':')[0]
+            if full and not self.allocate(volume, self.template_size):
+                return None, 'no space left on %s' % volume
+            config = dict(template['config'])
+            config.pop('template')
+            config['name'] = params.get('name', 'vm-%s' % newid)
+            config['virtio0'] = '%s:%s/vm-%s-disk-0.%s,size=%sG' % (
+                volume, newid, newid, 'raw' if full else 'qcow2',
+                self.template_size // GiB)
+            now = time.time()
+            self.vms[newid] = {
+                'vmid': newid, 'name': config['name'],
+                'node': params.get('target', node), 'template': 0,
+                'source': template['name'], 'status': 'stopped',
+                'config': config, 'timeline': {'clone': now}}
+            upid = 'UPID:%s:%08X:%08X:%08X:qmclone:%s:root@pam:' % (
+                node, os.getpid(), len(self.tasks), int(now), source)
+            self.tasks[upid] = {'vmid': newid, 'started': now,
+                                'duration': self.clone_time if full
+                                else self.clone_time / 10}
+            return upid, None
+
+    def task(self, upid):
+        """ status of a task, stopped once its duration elapsed """
+        with self.lock:
+            task = self.tasks.get(upid)
+            if task is None:
+                return None
+            elapsed = time.time() - task['started']
+            if elapsed < task['duration']:
+                return {'upid': upid, 'status': 'running'}, elapsed / \
+                    task['duration']
+            vm = self.vms[task['vmid']]
+            vm['timeline'].setdefault('cloned', task['started'] +
+                                      task['duration'])
+            return {'upid': upid, 'status': 'stopped',
+                    'exitstatus': 'OK'}, 1.0
+
+    def configure(self, vmid, params):
+        """ update a vm config, the new disks allocated on their volume """
+        with self.lock:
+            vm = self.vms.get(vmid)
+            if vm is None:
+                return 'vm %s does not exist' % vmid
+            for key, value in params.items():
+                m = re.match(r'([\w-]+):(\d+(?:\.\d+)?[KMGT]?)(,.*)?$',
+                             value)
+                if re.match(r'(virtio|scsi|sata|ide)\d+$', key) and \
+                        m is not None and 'media=cdrom' not in value:
+                    if not self.allocate(m.group(1),
+                                         size_bytes(m.group(2))):
+                        return 'no space left on %s' % m.group(1)
+                vm['config'][key] = value
+            vm['timeline']['configured'] = time.time()
+            return None
+
+    def start(self, vmid):
+        with self.lock:
+            vm = self.vms.get(vmid)
+            if vm is None:
+                return 'vm %s does not exist' % vmid
+            vm['status'] = 'running'
+            vm['timeline']['started'] = time.time()
+            return None
+
+    def template_of(self, vmid):
+        """ name of the template a vm was cloned from """
+        with self.lock:
+            vm = self.vms.get(vmid)
+            return vm['source'] if vm is not None else None
+
+
+def self_signed(directory, host='localhost'):
+    """ write a self signed certificate of host and its key, return their
+    paths """
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(
+        name).public_key(key.public_key()).serial_number(
+        x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(days=1)).not_valid_after(
+        now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+    cert_path = os.path.join(directory, 'api.crt')
+    key_path = os.path.join(directory, 'api.key')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """ the proxmox endpoints used by spartacus, under /api2/json """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def reply(self, code, data=None, reason=None):
+        body = json.dumps({'data': data}).encode()
+        self.send_response(code, reason)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def params(self):
+        """ the form fields of the request body, multipart ones skipped """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.api.count('bytes in', len(body))
+        if 'multipart/form-data' in (self.headers.get('Content-Type') or ''):
+            return {'multipart': body}
+        return dict((key, values[-1]) for key, values
+                    in parse_qs(body.decode()).items())
+
+    def do_GET(self):
+        self.dispatch('get')
+
+    def do_POST(self):
+        self.dispatch('post')
+
+    def do_PUT(self):
+        self.dispatch('put')
+
+    def do_DELETE(self):
+        self.dispatch('delete')
+
+    def dispatch(self, method):
+        api = self.server.api
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        params = self.params() if method != 'get' else {}
+        if api.latency:
+            time.sleep(api.latency)
+        if not path.startswith('/api2/json/'):
+            return self.reply(404, reason='not found')
+        path = path[len('/api2/json/'):]
+
+        if path == 'access/ticket' and method == 'post':
+            api.count('post access/ticket')
+            return self.reply(200, {'ticket': api.ticket,
+                                    'CSRFPreventionToken': api.csrf,
+                                    'username': params.get('username')})
+        cookie = self.headers.get('Cookie') or ''
+        if 'PVEAuthCookie=%s' % api.ticket not in cookie:
+            return self.reply(401, reason='no ticket')
+        if method != 'get' and \
+                self.headers.get('CSRFPreventionToken') != api.csrf:
+            return self.reply(401, reason='permission denied - invalid '
+                              'csrf token')
+
+        for route, pattern, handler in api.routes:
+            if route.split(' ')[0] != method:
+                continue
+            m = re.match(pattern + '$', path)
+            if m is not None:
+                api.count(route)
+                return handler(self, query, params, *m.groups())
+        api.count('%s unknown' % method)
+        logger.warning('no route for %s %s' % (method, path))
+        return self.reply(501, reason='method not implemented')
+
+
+class FakeProxmox:
+    """ https stand-in of the proxmox api on the local host, every request
+    answered after latency seconds: calls counted by route """
+
+    def __init__(self, cluster, workdir, host='127.0.0.1', port=0,
+                 latency=0.0):
+        self.cluster = cluster
+        self.latency = latency
+        self.ticket = 'PVE:root@pam:%08X::bench' % int(time.time())
+        self.csrf = '%08X:bench' % int(time.time())
+        self.calls = collections.Counter()
+        self.calls_lock = threading.Lock()
+        self.routes = [
+            ('get version', r'version', self.version),
+            ('get nodes', r'nodes', self.nodes),
+            ('get status', r'nodes/([^/]+)/status', self.status),
+            ('get storage', r'nodes/([^/]+)/storage', self.storage),
+            ('get rrddata', r'nodes/([^/]+)/storage/([^/]+)/rrddata',
+             self.rrddata),
+            ('post upload', r'nodes/([^/]+)/storage/([^/]+)/upload',
+             self.upload),
+            ('delete content', r'nodes/([^/]+)/storage/([^/]+)/content/(.+)',
+             self.delete),
+            ('get resources', r'cluster/resources', self.resources),
+            ('get nextid', r'cluster/nextid', self.nextid),
+            ('get qemu', r'nodes/([^/]+)/qemu', self.index),
+            ('get config', r'nodes/([^/]+)/qemu/(\d+)/config', self.config),
+            ('put config', r'nodes/([^/]+)/qemu/(\d+)/config',
+             self.configure),
+            ('post config', r'nodes/([^/]+)/qemu/(\d+)/config',
+             self.configure),
+            ('post clone', r'nodes/([^/]+)/qemu/(\d+)/clone', self.clone),
+            ('post start', r'nodes/([^/]+)/qemu/(\d+)/status/start',
+             self.vm_start),
+            ('get task status', r'nodes/([^/]+)/tasks/([^/]+)/status',
+             self.task_status),
+            ('get task log', r'nodes/([^/]+)/tasks/([^/]+)/log',
+             self.task_log),
+        ]
+        cert, key = self_signed(workdir)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.server = ThreadingHTTPServer((host, port), ApiHandler)
+        self.server.daemon_threads = True
+        self.server.socket = context.wrap_socket(self.server.socket,
+                                                 server_side=True)
+        self.server.api = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def count(self, route, n=1):
+        with self.calls_lock:
+            self.calls[route] += n
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='fakeproxmox', daemon=True)
+        self.thread.start()
+        logger.info('proxmox api stand-in on port %s' % self.port)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def api_calls(self):
+        """ requests served, the login included """
+        with self.calls_lock:
+            return sum(n for route, n in self.calls.items()
+                       if route != 'bytes in')
+
+    # endpoints
+    def version(self, h, query, params):
+        h.reply(200, {'version': '7.4', 'release': '7.4',
+                      'repoid': 'bench'})
+
+    def nodes(self, h, query, params):
+        h.reply(200, [{'node': node, 'status': 'online', 'type': 'node',
+                       'maxcpu': self.cluster.node_cpus,
+                       'maxmem': self.cluster.node_ram}
+                      for node in self.cluster.nodes])
+
+    def status(self, h, query, params, node):
+        if node not in self.cluster.nodes:
+            return h.reply(500, reason='hostname lookup \'%s\' failed'
+                           % node)
+        h.reply(200, self.cluster.node_status(node))
+
+    def storage(self, h, query, params, node):
+        h.reply(200, self.cluster.storage())
+
+    def rrddata(self, h, query, params, node, volume):
+        if volume not in self.cluster.volumes:
+            return h.reply(500, reason='storage \'%s\' does not exist'
+                           % volume)
+        h.reply(200, self.cluster.rrd(volume))
+
+    def upload(self, h, query, params, node, volume):
+        body = params.get('multipart', b'')
+        m = re.search(rb'filename="([^"]+)"', body)
+        key = (node, volume, m.group(1).decode() if m else '')
+        if key in self.cluster.isos:
+            return h.reply(500, reason='file already exists')
+        self.cluster.isos[key] = len(body)
+        h.reply(200, 'UPID:%s:00000000:00000000:00000000:imgcopy::root@pam:'
+                % node)
+
+    def delete(self, h, query, params, node, volume, content):
+        key = (node, volume, content.split('/')[-1])
+        if self.cluster.isos.pop(key, None) is None:
+            return h.reply(404, reason='volume \'%s\' does not exist'
+                           % content)
+        h.reply(200, None)
+
+    def resources(self, h, query, params):
+        h.reply(200, self.cluster.resources())
+
+    def nextid(self, h, query, params):
+        vmid = self.cluster.next_id(int(query['vmid']) if 'vmid' in query
+                                    else None)
+        if vmid is None:
+            return h.reply(400, reason='Parameter verification failed.')
+        h.reply(200, str(vmid))
+
+    def index(self, h, query, params, node):
+        h.reply(200, [vm for vm in self.cluster.resources()
+                      if vm['node'] == node])
+
+    def config(self, h, query, params, node, vmid):
+        vm = self.cluster.vms.get(int(vmid))
+        if vm is None:
+            return h.reply(500, reason='vm %s does not exist' % vmid)
+        h.reply(200, dict(vm['config']))
+
+    def configure(self, h, query, params, node, vmid):
+        error = self.cluster.configure(int(vmid), params)
+        if error is not None:
+            return h.reply(500, reason=error)
+        h.reply(200, None)
+
+    def clone(self, h, query, params, node, vmid):
+        upid, error = self.cluster.clone(node, int(vmid), params)
+        if error is not None:
+            return h.reply(500, reason=error)
+        h.reply(200, upid)
+
+    def vm_start(self, h, query, params, node, vmid):
+        error = self.cluster.start(int(vmid))
+        if error is not None:
+            return h.reply(500, reason=error)
+        h.reply(200, 'UPID:%s:00000000:00000000:00000000:qmstart:%s:'
+                'root@pam:' % (node, vmid))
+
+    def task_status(self, h, query, params, node, upid):
+        task = self.cluster.task(upid)
+        if task is None:
+            return h.reply(500, reason='no such task')
+        h.reply(200, task[0])
+
+    def task_log(self, h, query, params, node, upid):
+        task = self.cluster.task(upid)
+        if task is None:
+            return h.reply(500, reason='no such task')
+        total = self.cluster.template_size / GiB
+        h.reply(200, [{'n': int(query.get('start', 0)) + 1,
+                       't': 'transferred %.1f GiB of %.1f GiB (%.2f%%)'
+                       % (total * task[1], total, 100 * task[1])}])
@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+
+import base64
+import io
+import logging
+import paramiko
+import re
+import socket
+import struct
+import tarfile
+import threading
+import time
+
+logger = logging.getLogger('fakessh')
+
+SECTOR = 512
+# first partition of the template images, as in a debian cloud image
+PARTITION = (2048, 20969472)
+
+
+def mbr(first, sectors):
+    """ the first sectors of a raw disk with a single linux partition """
+    data = bytearray(34 * SECTOR)
+    data[446:462] = struct.pack('<B3xB3xII', 0x80, 0x83, first, sectors)
+    data[510:512] = b'\x55\xaa'
+    return bytes(data)
+
+
+class SshServer(paramiko.ServerInterface):
+    """ any user authenticated by any key or password, exec requests only """
+
+    def __init__(self, target):
+        self.target = target
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_FAILED
+
+    def check_channel_exec_request(self, channel, command):
+        worker = threading.Thread(target=self.target.execute,
+                                  args=(channel, command.decode()),
+                                  name='fakessh-exec', daemon=True)
+        worker.start()
+        return True
+
+
+class FakeSshTarget:
+    """ ssh stand-in of the proxmox host on the local host: the commands
+    of rawinit (single commands and the step scripts of RemoteSteps) are
+    emulated on the state of the fake cluster, every exec answered after
+    latency seconds. Sessions, execs and streamed bytes are counted """
+
+    def __init__(self, cluster, host='127.0.0.1', port=0, latency=0.0,
+                 nbd_devices=16):
+        self.cluster = cluster
+        self.latency = latency
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.lock = threading.Lock()
+        self.nbd_free = ['/dev/nbd%s' % i for i in range(nbd_devices)]
+        self.sessions = 0
+        self.execs = 0
+        self.streamed = 0
+        self.deployed = {}
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.serve, name='fakessh',
+                         daemon=True).start()
+        logger.info('ssh stand-in on port %s' % self.port)
+        return self
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+    def serve(self):
+        while self.running:
+            try:
+                client, address = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=SshServer(self))
+            with self.lock:
+                self.sessions += 1
+                self.transports.append(transport)
+            threading.Thread(target=self.accept, args=(transport,),
+                             daemon=True).start()
+
+    def accept(self, transport):
+        """ take the channels of a connection, served by their exec: kept
+        referenced until closed, a collected channel is closed """
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            channels = [c for c in channels if not c.closed]
+            if channel is not None:
+                channels.append(channel)
+
+    def execute(self, channel, command):
+        """ answer an exec request as the remote shell would """
+        with self.lock:
+            self.execs += 1
+        data = b''
+        if 'cat > $tmp' in command:
+            # streamed archive, the stdin is read up to its end
+            chunks = []
+            while True:
+                chunk = channel.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b''.join(chunks)
+            with self.lock:
+                self.streamed += len(data)
+        if self.latency:
+            time.sleep(self.latency)
+        if command.startswith('echo "@@'):
+            exitcode, output = self.script(command)
+        else:
+            exitcode, output = self.command(command, data)
+        if exitcode == 0:
+            channel.sendall(output.encode())
+        else:
+            channel.sendall_stderr(output.encode())
+        # output, exit status and eof may precede the reply to the exec
+        # request, the channel is closed by the client once it is received
+        channel.send_exit_status(exitcode)
+        channel.shutdown_write()
+
+    def script(self, script):
+        """ run a RemoteSteps script, its echo lines and steps """
+        output = []
+        exitcode = 0
+        for line in script.split('\n'):
+            m = re.match(r'echo "(.*)"$', line)
+            if m is not None:
+                output.append(m.group(1).replace('$rc', str(exitcode)) +
+                              '\n')
+                continue
+            m = re.match(r'\( (.*) \) 2>&1; rc=\$\?; echo$', line)
+            if m is not None:
+                exitcode, step = self.command(m.group(1))
+                output.append(step + '\n')
+                continue
+            if line == '[ $rc -eq 0 ] || exit 0' and exitcode != 0:
+                break
+        return 0, ''.join(output)
+
+    def command(self, command, data=b''):
+        """ exit code and output of a single command """
+        if command.startswith('findmnt') or \
+                command.startswith('test -e /sys/block/'):
+            return 1, ''
+        if command.startswith('sudo dd if=') and 'base64' in command:
+            return 0, base64.b64encode(mbr(*PARTITION)).decode()
+        m = re.match(r'cat (.*)/(\d+)/etc/hostname$', command)
+        if m is not None:
+            template = self.cluster.template_of(int(m.group(2)))
+            if template is None:
+                return 1, 'cat: %s: No such file or directory' % command[4:]
+            return 0, '%s\n' % template
+        if 'for sys in /sys/block/nbd*' in command:
+            with self.lock:
+                if not self.nbd_free:
+                    return 1, ''
+                return 0, '%s\n' % self.nbd_free.pop(0)
+        m = re.match(r'rmdir .*/(nbd\d+)\.lock$', command)
+        if m is not None:
+            with self.lock:
+                self.nbd_free.append('/dev/%s' % m.group(1))
+            return 0, ''
+        m = re.search(r'sudo tar -xpf \$tmp --same-owner -C (\S+);', command)
+        if m is not None:
+            try:
+                with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                    members = tar.getnames()
+            except tarfile.TarError as ex:
+                return 2, 'tar: %s' % ex
+            with self.lock:
+                self.deployed[m.group(1)] = members
+            return 0, ''
+        return 0, ''
@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+
+from bench.fakeproxmox import FakeCluster, FakeProxmox
+from bench.fakessh import FakeSshTarget
+from metrics import PHASES
+import argparse
+import coloredlogs
+import copy
+import importlib
+import json
+import logging
+import os
+import paramiko
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
+OUTPUT_FORMATS = ['text', 'json']
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOSTBOOK = os.path.join(ROOT, 'hostbooks', 'spartacus01.yml')
+
+logger = logging.getLogger('bench')
+
+
+def log_init(loglevel):
+    """ initialize the logging system """
+    FORMAT = '%(asctime)s %(levelname)s %(module)s %(message)s'
+    logging.basicConfig(format=FORMAT, level=getattr(logging,
+                                                     loglevel.upper()))
+    coloredlogs.install(level=loglevel.upper(), stream=sys.stderr)
+
+
+def hostbooks(count, template):
+    """ count hostbooks from the example one, addresses leased by ipam """
+    with open(HOSTBOOK, 'r') as f:
+        example = yaml.safe_load(f)
+    documents = []
+    for i in range(count):
+        document = copy.deepcopy(example)
+        document['name'] = 'bench%03d' % i
+        document['template'] = template
+        for interface in document.get('interfaces', []):
+            interface['ipaddress'] = 'auto'
+            interface.pop('netmask', None)
+            interface.pop('gateway', None)
+        for host in document.get('hosts', []):
+            host['ipaddress'] = 'auto'
+            host['name'] = '%s.domain' % document['name']
+            host['alias'] = document['name']
+        documents.append(document)
+    return documents
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def phase_latencies(path):
+    """ p50 and p95 of the seconds of every phase over the vms, from the
+    timing spans of the run """
+    seconds = {}
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        for line in f:
+            span = json.loads(line)
+            vms = seconds.setdefault(span['phase'], {})
+            vms[span['vm']] = vms.get(span['vm'], 0) + span['seconds']
+    return dict((phase, {'p50': percentile(list(vms.values()), 0.5),
+                         'p95': percentile(list(vms.values()), 0.95)})
+                for phase, vms in seconds.items())
+
+
+def run(settings, count, options):
+    """ deploy count vms by spartacus on fresh stand-ins, return the
+    measures of the run """
+    workdir = tempfile.mkdtemp(prefix='spartacus-bench-')
+    cluster = FakeCluster(nodes=options.nodes,
+                          volumes=settings.VM_DEFAULTS['ODD_VOL'] +
+                          settings.VM_DEFAULTS['EVEN_VOL'],
+                          templates=[settings.BENCH_TEMPLATE],
+                          clone_time=options.clone_time)
+    api = FakeProxmox(cluster, workdir, latency=options.api_latency).start()
+    ssh = FakeSshTarget(cluster, latency=options.ssh_latency).start()
+    try:
+        key = os.path.join(workdir, 'id_ecdsa')
+        paramiko.ECDSAKey.generate().write_private_key_file(key)
+        inventory = os.path.join(workdir, 'inventory.yml')
+        with open(inventory, 'w') as f:
+            yaml.safe_dump_all(hostbooks(count, settings.BENCH_TEMPLATE), f)
+
+        command = [sys.executable, os.path.join(ROOT, 'spartacus.py'),
+                   '-s', options.settings, '-i', inventory,
+                   '-w', str(options.workers), '-l', 'info']
+        if not options.init:
+            command.append('-n')
+        if options.linked:
+            command.append('-k')
+        if options.nocloud:
+            command.append('-c')
+        env = dict(os.environ, SPARTACUS_BENCH_DIR=workdir,
+                   SPARTACUS_BENCH_API_PORT=str(api.port),
+                   SPARTACUS_BENCH_SSH_PORT=str(ssh.port),
+                   SPARTACUS_BENCH_SSH_KEY=key)
+        logger.info('deploying %s vms' % count)
+        started = time.time()
+        process = subprocess.run(command, cwd=ROOT, env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        elapsed = time.time() - started
+        if process.returncode != 0:
+            logger.error('spartacus exited with %s:\n%s'
+                         % (process.returncode, '\n'.join(
+                            process.stdout.decode().splitlines()[-20:])))
+
+        vms = [vm for vm in cluster.vms.values() if not vm['template']]
+        latencies = [vm['timeline']['started'] - vm['timeline']['clone']
+                     for vm in vms if 'started' in vm['timeline']]
+        return {'vms': count, 'workers': options.workers,
+                'exitcode': process.returncode, 'elapsed': elapsed,
+                'started': len(latencies),
+                'deploy_p50': percentile(latencies, 0.5),
+                'deploy_p95': percentile(latencies, 0.95),
+                'deploy_max': max(latencies) if latencies else None,
+                'api_calls': api.api_calls(),
+                'task_polls': api.calls['get task status'] +
+                api.calls['get task log'],
+                'api_routes': dict((route, n) for route, n
+                                   in sorted(api.calls.items())
+                                   if route != 'bytes in'),
+                'ssh_sessions': ssh.sessions, 'ssh_execs': ssh.execs,
+                'ssh_streamed': ssh.streamed,
+                'phases': phase_latencies(os.path.join(
+                    workdir, 'generated', 'metrics.jsonl'))}
+    finally:
+        api.stop()
+        ssh.stop()
+        if options.keep:
+            logger.info('work directory kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def regressions(results, baseline, tolerance):
+    """ the measures worse than the baseline ones: more requests (task
+    polls aside) or ssh round-trips, or task polls and wall time over the
+    tolerance, both depending on the timing of the run """
+    found = []
+    for result in results:
+        base = baseline.get(str(result['vms']))
+        if base is None:
+            continue
+        measures = {'requests': (result['api_calls'] - result['task_polls'],
+                                 base['api_calls'] - base['task_polls'], 0),
+                    'ssh_sessions': (result['ssh_sessions'],
+                                     base['ssh_sessions'], 0),
+                    'ssh_execs': (result['ssh_execs'], base['ssh_execs'], 0),
+                    'task_polls': (result['task_polls'], base['task_polls'],
+                                   tolerance),
+                    'elapsed': (result['elapsed'], base['elapsed'],
+                                tolerance)}
+        for measure, (value, base_value, allowed) in sorted(
+                measures.items()):
+            if value > base_value * (1 + allowed):
+                found.append('%s vms: %s %s, baseline %s'
+                             % (result['vms'], measure, round(value, 2),
+                                round(base_value, 2)))
+    return found
+
+
+def report_text(results):
+    lines = ['%5s %8s %7s %8s %8s %9s %8s %9s %9s'
+             % ('vms', 'elapsed', 'ok', 'p50', 'p95', 'api', 'api/vm',
+                'ssh', 'ssh/vm')]
+    for r in results:
+        lines.append('%5s %7.2fs %3s/%-3s %7.2fs %7.2fs %9s %8.1f %4s/%-4s '
+                     '%8.1f' % (r['vms'], r['elapsed'], r['started'],
+                                r['vms'], r['deploy_p50'] or 0,
+                                r['deploy_p95'] or 0, r['api_calls'],
+                                r['api_calls'] / r['vms'], r['ssh_sessions'],
+                                r['ssh_execs'], r['ssh_execs'] / r['vms']))
+    for r in results:
+        phases = r['phases']
+        items = ['%s %.2f/%.2fs' % (phase, phases[phase]['p50'],
+                                    phases[phase]['p95'])
+                 for phase in PHASES if phase in phases]
+        for i in range(0, len(items), 4):
+            lines.append('%24s %s' % ('%5s phases p50/p95:' % r['vms']
+                                      if i == 0 else '',
+                                      ', '.join(items[i:i + 4])))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    description = 'bench, end-to-end deploy benchmark on local proxmox ' \
+                  'api and ssh stand-ins'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-s', '--settings', default='bench',
+                        help='benchmark settings file in settings package '
+                        '(default bench)')
+    parser.add_argument('-n', '--vms', default=[1, 10, 100], type=int,
+                        nargs='+', help='vms deployed by every run '
+                        '(default 1 10 100)')
+    parser.add_argument('-w', '--workers', default=4, type=int,
+                        help='concurrent deployments (default 4)')
+    parser.add_argument('--nodes', default=8, type=int,
+                        help='nodes of the stand-in cluster (default 8)')
+    parser.add_argument('--api-latency', default=0.005, type=float,
+                        help='seconds to answer an api request '
+                        '(default 0.005)')
+    parser.add_argument('--ssh-latency', default=0.005, type=float,
+                        help='seconds to answer an ssh exec (default 0.005)')
+    parser.add_argument('--clone-time', default=0.5, type=float,
+                        help='seconds of a full clone task (default 0.5)')
+    parser.add_argument('--no-rawinit', dest='init', action='store_false',
+                        help='deploy without rawinit (default enabled)')
+    parser.set_defaults(init=True)
+    parser.add_argument('-k', '--linked', action='store_true',
+                        help='linked clones (default full)')
+    parser.add_argument('-c', '--nocloud', action='store_true',
+                        help='nocloud seed instead of rawinit '
+                        '(default disabled)')
+    parser.add_argument('-o', '--output', default=OUTPUT_FORMATS[0],
+                        choices=OUTPUT_FORMATS,
+                        help='report format (default text)')
+    parser.add_argument('--save', default=None,
+                        help='write the measures as the baseline file')
+    parser.add_argument('--baseline', default=None,
+                        help='baseline file to compare with, exit 1 on '
+                        'regressions')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='wall time and task polls increase allowed over '
+                        'the baseline (default 0.25)')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the work directories (default removed)')
+    parser.add_argument('-l', '--log-level', default=LOG_LEVELS[1],
+                        help='log level (default info)', choices=LOG_LEVELS)
+
+    cli_options = parser.parse_args()
+    log_init(cli_options.log_level)
+    logger.debug(cli_options)
+
+    sys.path.insert(0, ROOT)
+    settings = importlib.import_module('settings.%s' % cli_options.settings)
+
+    results = [run(settings, count, cli_options) for count in cli_options.vms]
+
+    if cli_options.output == 'json':
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(report_text(results))
+
+    if cli_options.save is not None:
+        with open(cli_options.save, 'w') as f:
+            json.dump(dict((str(r['vms']), r) for r in results), f,
+                      indent=2, sort_keys=True)
+        logger.info('baseline written to %s' % cli_options.save)
+
+    failed = [r for r in results if r['exitcode'] != 0 or
+              r['started'] != r['vms']]
+    for r in failed:
+        logger.error('%s vms: %s of %s deployed, exit code %s'
+                     % (r['vms'], r['started'], r['vms'], r['exitcode']))
+    found = []
+    if cli_options.baseline is not None:
+        with open(cli_options.baseline, 'r') as f:
+            found = regressions(results, json.load(f), cli_options.tolerance)
+        for regression in found:
+            logger.error('regression, %s' % regression)
+    if failed or found:
+        sys.exit(1)
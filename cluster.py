@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import logging
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger('cluster')
+
+
+def check_proxmox_response(response):
+    status_code = response['status']['code']
+    if status_code != 200:
+        reason = response['status']['reason']
+        logger.error('proxmox api error, response code %s: %s' %
+                     (status_code, reason))
+        sys.exit('exiting')
+    else:
+        return response
+
+
+class ClusterSnapshot:
+    """ point in time view of the cluster state shared by the lookups of a
+    run: every api resource is fetched once and served from the snapshot
+    until it is older than ttl seconds """
+    connessione = None
+    ttl = 60
+    timeout = 10
+
+    def __init__(self, connessione, ttl=60, timeout=10):
+        self.connessione = connessione
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.cache = {}
+        self.key_locks = {}
+
+    def cached(self, key, build):
+        """ return the cached value of key, built if missing or expired:
+        the lock of the key is held while building, so that a resource is
+        built once, the snapshot lock only while reading and storing """
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                entry = self.cache.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                entry = (time.time(), build())
+                with self.lock:
+                    self.cache[key] = entry
+            return entry[1]
+
+    def fetch(self, key, request):
+        """ return the cached data of key, calling the request if missing
+        or expired """
+        def build():
+            logger.debug('fetching %s from the cluster' % (key,))
+            return check_proxmox_response(request())['data']
+        return self.cached(key, build)
+
+    def invalidate(self, key=None):
+        """ drop a cached resource or the whole snapshot """
+        with self.lock:
+            if key is None:
+                self.cache = {}
+            else:
+                self.cache.pop(key, None)
+
+    def nodes(self):
+        """ cluster node list """
+        return self.fetch('nodes', self.connessione.getClusterNodeList)
+
+    def node_statuses(self, nodes):
+        """ status of many nodes, requested concurrently each with its own
+        timeout: nodes answering with an error or slower than the timeout
+        are left out until the snapshot expires """
+        def status(node):
+            def request():
+                # a plain pyproxmox client keeps the last response on the
+                # instance, every request gets its own copy sharing the
+                # authentication, with the node status timeout
+                client = copy.copy(self.connessione)
+                client.timeout = self.timeout
+                try:
+                    response = client.getNodeStatus(node)
+                except Exception as ex:
+                    logger.warning('node %s status failed, skipped: %s'
+                                   % (node, ex))
+                    return None
+                if response is None or response['status']['code'] != 200:
+                    logger.warning('node %s status error, skipped: %s'
+                                   % (node, response and
+                                      response['status']['reason']))
+                    return None
+                return response['data']
+            return self.cached(('status', node), request)
+
+        statuses = {}
+        missing = []
+        with self.lock:
+            for node in nodes:
+                entry = self.cache.get(('status', node))
+                if entry is None or time.time() - entry[0] > self.ttl:
+                    missing.append(node)
+                elif entry[1] is not None:
+                    statuses[node] = entry[1]
+        if not missing:
+            return statuses
+
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            for node, data in zip(missing, executor.map(status, missing)):
+                if data is not None:
+                    statuses[node] = data
+        return statuses
+
+    def node_storage(self, node):
+        """ datastores status seen by a node """
+        return self.fetch(('storage', node),
+                          lambda: self.connessione.getNodeStorage(node))
+
+    def storage_rrd(self, node, storage):
+        """ last hour statistics of a datastore seen by a node """
+        return self.fetch(('rrd', node, storage),
+                          lambda: self.connessione.getStorageRRDData(
+                              node, storage))
+
+    def vm_config(self, node, vmid):
+        """ configuration of a virtual machine """
+        return self.fetch(('config', node, vmid),
+                          lambda: self.connessione.getVirtualConfig(node,
+                                                                    vmid))
+
+    def vms(self):
+        """ cluster wide virtual machine index, by a single resources query
+        instead of one index request per node """
+        return self.fetch('vms', lambda: self.connessione.connect(
+                                 'get', 'cluster/resources?type=vm', None))
+
+    def template_index(self):
+        """ name to (vmid, node) index of the cluster kvm virtual machines,
+        built with the vm index and expiring with it """
+        def build():
+            index = {}
+            for vm in self.vms():
+                if vm.get('type') == 'qemu' and 'name' in vm:
+                    index.setdefault(vm['name'], (vm['vmid'], vm['node']))
+            return index
+        return self.cached('templates', build)
+
+    def find_template(self, name):
+        """ return id and node of the named template, on a miss the index
+        is rebuilt once to see templates created after the snapshot """
+        if name not in self.template_index():
+            logger.debug('template %s not indexed, refreshing' % name)
+            with self.lock:
+                self.invalidate('vms')
+                self.invalidate('templates')
+        return self.template_index().get(name, (None, None))
+
+    def version(self):
+        """ proxmox version as major.minor float """
+        version = self.fetch('version', lambda: self.connessione.connect(
+                                                'get', 'version', None))
+        logger.debug(version)
+        return float(re.match(r'\d+(\.\d+)?', version['version']).group())
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+import logging
+import queue
+import threading
+
+logger = logging.getLogger('hostkeys')
+
+KEY_TYPES = ['rsa', 'ecdsa', 'ed25519']
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def generate(kind):
+    """ generate a host key pair, return the private key and the public key
+    line, serialized in memory: rsa and ecdsa private keys in the pem
+    format that the older sshd of the legacy templates read, ed25519 ones
+    in the openssh format, the only one they have """
+    if kind == 'rsa':
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif kind == 'ecdsa':
+        key = ec.generate_private_key(ec.SECP256R1())
+    elif kind == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError('unsupported host key type %s' % kind)
+    if kind == 'ed25519':
+        private_format = serialization.PrivateFormat.OpenSSH
+    else:
+        private_format = serialization.PrivateFormat.TraditionalOpenSSL
+    private = key.private_bytes(serialization.Encoding.PEM, private_format,
+                                serialization.NoEncryption())
+    public = key.public_key().public_bytes(serialization.Encoding.OpenSSH,
+                                           serialization.PublicFormat.OpenSSH)
+    return private, public + b'\n'
+
+
+class KeyPool:
+    """ host key pairs generated in background, one filler thread per key
+    type keeps up to size ready pairs: a deploy takes them instantly and
+    generates inline only if the pool is empty. The fillers end once the
+    pool is stopped """
+    types = []
+    size = 8
+
+    def __init__(self, types, size=8):
+        for kind in types:
+            if kind not in KEY_TYPES:
+                raise ValueError('unsupported host key type %s' % kind)
+        self.types = list(types)
+        self.size = size
+        self.keys = dict((kind, queue.Queue(maxsize=size)) for kind in types)
+        self.stopped = threading.Event()
+        for kind in types:
+            filler = threading.Thread(target=self.fill, args=(kind,),
+                                      name='hostkeys-%s' % kind, daemon=True)
+            filler.start()
+
+    def fill(self, kind):
+        """ keep the pool of kind full, blocking while it is, until the pool
+        is stopped """
+        while not self.stopped.is_set():
+            key = generate(kind)
+            while not self.stopped.is_set():
+                try:
+                    self.keys[kind].put(key, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def stop(self):
+        """ end the fillers, the ready keys can still be taken """
+        self.stopped.set()
+
+    def get(self, kind):
+        """ a ready key pair of kind, never handed out twice """
+        try:
+            return self.keys[kind].get_nowait()
+        except queue.Empty:
+            logger.debug('%s host key pool empty, generating inline' % kind)
+            return generate(kind)
+
+
+def key_pool(types, size=8):
+    """ the process key pool, started on first use """
+    global pool
+    with pool_lock:
+        if pool is None or pool.types != list(types) or pool.size != size:
+            logger.debug('starting %s host key pool (%s keys each)'
+                         % (', '.join(types), size))
+            if pool is not None:
+                pool.stop()
+            pool = KeyPool(types, size)
+        return pool
@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import ipaddress
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import yaml
+
+logger = logging.getLogger('ipam')
+
+AUTO = 'auto'
+
+
+class Subnet:
+    """ address map of a vlan subnet, one byte per address: network,
+    broadcast, gateway and the addresses out of the range are reserved """
+    vlan = ''
+    network = None
+    gateway = None
+
+    def __init__(self, vlan, network, gateway=None, first=None, last=None):
+        self.vlan = vlan
+        self.network = ipaddress.ip_network(network, strict=False)
+        self.gateway = gateway
+        self.used = bytearray(self.network.num_addresses)
+        self.first = 1
+        self.last = self.network.num_addresses - 2
+        if first is not None:
+            self.first = max(self.first, self.offset(first))
+        if last is not None:
+            self.last = min(self.last, self.offset(last))
+        if gateway is not None:
+            self.use(gateway)
+
+    def offset(self, address):
+        """ index of the address in the map, None if out of the subnet """
+        address = ipaddress.ip_address(address)
+        if address not in self.network:
+            return None
+        return int(address) - int(self.network.network_address)
+
+    def use(self, address):
+        """ mark the address as used, False if out of the subnet """
+        offset = self.offset(address)
+        if offset is None:
+            return False
+        self.used[offset] = 1
+        return True
+
+    def allocate(self):
+        """ the first free address of the range, marked as used """
+        offset = self.used.find(b'\x00', self.first, self.last + 1)
+        if offset < 0:
+            return None
+        self.used[offset] = 1
+        return str(self.network.network_address + offset)
+
+    def netmask(self):
+        return str(self.network.netmask)
+
+
+def subnets_load(vlan_subnets):
+    """ subnets by vlan from the VLAN_SUBNETS setting """
+    subnets = {}
+    for vlan, subnet in vlan_subnets.items():
+        first, last = subnet.get('RANGE', (None, None))
+        subnets[str(vlan)] = Subnet(str(vlan), subnet['NETWORK'],
+                                    subnet.get('GATEWAY'), first, last)
+    return subnets
+
+
+def hostbook_addresses(hostbook):
+    """ static addresses of the interfaces and hosts of a hostbook """
+    addresses = []
+    for item in hostbook.get('interfaces', []) + hostbook.get('hosts', []):
+        address = item.get('ipaddress')
+        if address is not None and address != AUTO:
+            addresses.append(address)
+    return addresses
+
+
+def inventory_addresses(paths):
+    """ addresses used by the hostbooks of already deployed vms, files or
+    directories of files, by name """
+    addresses = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(path, f) for f in sorted(os.listdir(path))
+                     if f.endswith(('.yml', '.yaml'))]
+        else:
+            files = [path]
+        for hostbook in files:
+            try:
+                with open(hostbook, 'r') as yaml_stream:
+                    documents = list(yaml.safe_load_all(yaml_stream))
+            except (IOError, yaml.YAMLError) as ex:
+                logger.warning('%s skipped: %s' % (hostbook, ex))
+                continue
+            for document in documents:
+                if isinstance(document, dict):
+                    for address in hostbook_addresses(document):
+                        addresses[address] = document.get('name')
+    return addresses
+
+
+def cluster_addresses(cluster, workers=16):
+    """ addresses in the cloud-init ipconfig of the cluster vms, their
+    configurations requested concurrently """
+    vms = [vm for vm in cluster.vms() if vm.get('type') == 'qemu']
+    addresses = {}
+
+    def vm_addresses(vm):
+        response = cluster.connessione.getVirtualConfig(vm['node'],
+                                                        vm['vmid'])
+        if response['status']['code'] != 200:
+            logger.warning('vm %s config not received, skipped' % vm['vmid'])
+            return
+        for key, value in response['data'].items():
+            if not key.startswith('ipconfig'):
+                continue
+            for option in value.split(','):
+                if option.startswith('ip='):
+                    address = option[3:].split('/')[0]
+                    if address not in ('dhcp', 'manual'):
+                        addresses[address] = vm.get('name')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(vm_addresses, vms))
+    return addresses
+
+
+def uses_auto(hostbooks):
+    """ true if an interface of the hostbooks has ipaddress: auto """
+    return any(interface.get('ipaddress') == AUTO
+               for hostbook in hostbooks
+               for interface in hostbook.get('interfaces', []))
+
+
+class Ipam:
+    """ address allocator of the hostbook interfaces with ipaddress: auto,
+    leased from the vlan subnets; static addresses are never leased, only
+    kept out of the allocation. The leases are kept in a json file, locked
+    while allocating so that concurrent runs never hand out the same
+    address, and freed once their vm is no longer on the cluster """
+    leases_path = ''
+    grace = 3600
+
+    def __init__(self, vlan_subnets, leases_path, grace=3600):
+        self.vlan_subnets = vlan_subnets
+        self.leases_path = leases_path
+        self.grace = grace
+        self.lock = threading.Lock()
+
+    def load_leases(self):
+        if not os.path.exists(self.leases_path):
+            return {}
+        try:
+            with open(self.leases_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.error('invalid leases file %s' % self.leases_path)
+            sys.exit('exiting')
+
+    def save_leases(self, leases):
+        tmp = '%s.%s' % (self.leases_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(leases, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.leases_path)
+
+    def assign(self, hostbooks, seeds=None, save=True, deployed=None):
+        """ resolve the auto addresses of the hostbooks in place, avoiding
+        the leases, the seeds (address to owner name) and the static
+        addresses of the run: exit if a vlan has no subnet or no free
+        address. With deployed, the names of the cluster vms, the leases
+        of vms gone from the cluster are released. Nothing to do if no
+        hostbook uses auto addresses """
+        if not uses_auto(hostbooks):
+            return
+
+        def allocate():
+            leases = self.load_leases()
+            names = set(hostbook['name'] for hostbook in hostbooks)
+            self.expire(leases, names, deployed)
+            self.resolve(hostbooks, leases, seeds or {})
+            return leases
+
+        if not save:
+            # a dry run, no lock taken nor file written
+            allocate()
+            return
+        folder = os.path.dirname(self.leases_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with self.lock, open('%s.lock' % self.leases_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.save_leases(allocate())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def expire(self, leases, names, deployed=None):
+        """ drop in place the static leases of the older releases and,
+        with deployed, the leases of the vms not on the cluster nor in the
+        run: after grace seconds, a concurrent run may be deploying them """
+        now = time.time()
+        for address, lease in list(leases.items()):
+            if lease.get('static'):
+                del leases[address]
+            elif deployed is not None and lease['name'] not in names and \
+                    lease['name'] not in deployed and \
+                    now - lease['time'] > self.grace:
+                logger.info('%s released, %s is not on the cluster'
+                            % (address, lease['name']))
+                del leases[address]
+
+    def resolve(self, hostbooks, leases, seeds):
+        subnets = subnets_load(self.vlan_subnets)
+        owners = dict(seeds)
+        for address, lease in leases.items():
+            owners[address] = lease['name']
+
+        # static addresses of the run, only kept out of the allocation: a
+        # rebuilt or renamed vm may take the address of another
+        for hostbook in hostbooks:
+            name = hostbook['name']
+            for address in set(hostbook_addresses(hostbook)):
+                if address in owners and owners[address] != name:
+                    logger.warning('%s of %s also used by %s'
+                                   % (address, name,
+                                      owners[address] or 'an unnamed vm'))
+                owners[address] = name
+        for address in owners:
+            for subnet in subnets.values():
+                subnet.use(address)
+
+        for hostbook in hostbooks:
+            name = hostbook['name']
+            first = None
+            for i, interface in enumerate(hostbook.get('interfaces', [])):
+                if interface.get('ipaddress') == AUTO:
+                    subnet = subnets.get(interface.get('vlan'))
+                    if subnet is None:
+                        logger.error('no subnet of vlan %s for %s'
+                                     % (interface.get('vlan'), name))
+                        sys.exit('exiting')
+                    interface['ipaddress'] = self.lease(subnet, name, i,
+                                                        leases)
+                    logger.info('%s leased to %s on vlan %s'
+                                % (interface['ipaddress'], name,
+                                   subnet.vlan))
+                    # netmask and gateway of the vlan if not given
+                    interface.setdefault('netmask', subnet.netmask())
+                    if subnet.gateway is not None:
+                        interface.setdefault('gateway', subnet.gateway)
+                if first is None:
+                    first = interface.get('ipaddress')
+            for host in hostbook.get('hosts', []):
+                if host.get('ipaddress') == AUTO:
+                    host['ipaddress'] = first
+
+    def lease(self, subnet, name, interface, leases):
+        """ the address leased to an interface of name on the subnet, a new
+        one if none """
+        for address, lease in leases.items():
+            if lease['name'] == name and lease['vlan'] == subnet.vlan and \
+               lease['interface'] == interface:
+                return address
+        address = subnet.allocate()
+        if address is None:
+            logger.error('no free address on vlan %s for %s'
+                         % (subnet.vlan, name))
+            sys.exit('exiting')
+        leases[address] = {'name': name, 'vlan': subnet.vlan,
+                           'interface': interface, 'time': int(time.time())}
+        return address
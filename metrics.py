@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+
+from contextlib import contextmanager
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('metrics')
+
+PHASES = ['auth', 'version', 'template', 'placement', 'storage', 'clone',
+          'clone_wait', 'options', 'render', 'nbd', 'mount', 'deploy',
+          'umount', 'start', 'total']
+QUANTILES = [0.5, 0.95]
+
+sink = None
+sink_lock = threading.Lock()
+
+
+def quantile(values, q):
+    """ nearest rank quantile of a non empty list """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def escape(value):
+    """ prometheus label value """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class MetricsSink:
+    """ timing spans of a run: every span is appended to a json lines file
+    as it ends, the per phase summary (quantiles over the vms, sum and
+    count) is written to a prometheus textfile when the run ends """
+    path = None
+    textfile = None
+
+    def __init__(self, path=None, textfile=None, cluster=''):
+        self.path = path
+        self.textfile = textfile
+        self.cluster = cluster
+        self.started = time.time()
+        self.run = '%s-%s' % (int(self.started), os.getpid())
+        self.lock = threading.Lock()
+        self.spans = []
+        self.stream = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.stream = open(path, 'a')
+
+    def add(self, phase, vm, started, elapsed, status):
+        """ record a span and append it to the json lines """
+        span = {'run': self.run, 'cluster': self.cluster, 'phase': phase,
+                'vm': vm, 'start': round(started, 6),
+                'seconds': round(elapsed, 6), 'status': status}
+        with self.lock:
+            self.spans.append(span)
+            if self.stream is not None:
+                self.stream.write('%s\n' % json.dumps(span, sort_keys=True))
+                self.stream.flush()
+
+    def phase_seconds(self):
+        """ seconds by phase and vm, the spans of a phase repeated in a
+        deploy summed up """
+        seconds = {}
+        with self.lock:
+            for span in self.spans:
+                vms = seconds.setdefault(span['phase'], {})
+                vms[span['vm']] = vms.get(span['vm'], 0) + span['seconds']
+        return seconds
+
+    def prometheus(self):
+        """ the run summary in the prometheus text format """
+        cluster = escape(self.cluster)
+        lines = ['# HELP spartacus_phase_seconds deploy phase duration by vm',
+                 '# TYPE spartacus_phase_seconds summary']
+        seconds = self.phase_seconds()
+        for phase in sorted(seconds, key=lambda p: (
+                PHASES.index(p) if p in PHASES else len(PHASES), p)):
+            values = list(seconds[phase].values())
+            labels = 'cluster="%s",phase="%s"' % (cluster, escape(phase))
+            for q in QUANTILES:
+                lines.append('spartacus_phase_seconds{%s,quantile="%s"} %f'
+                             % (labels, q, quantile(values, q)))
+            lines.append('spartacus_phase_seconds_sum{%s} %f'
+                         % (labels, sum(values)))
+            lines.append('spartacus_phase_seconds_count{%s} %s'
+                         % (labels, len(values)))
+        with self.lock:
+            failed = len([s for s in self.spans if s['status'] != 'ok'])
+        lines += ['# HELP spartacus_phase_failures spans ended by an '
+                  'error',
+                  '# TYPE spartacus_phase_failures gauge',
+                  'spartacus_phase_failures{cluster="%s"} %s'
+                  % (cluster, failed),
+                  '# HELP spartacus_run_timestamp_seconds end of the run',
+                  '# TYPE spartacus_run_timestamp_seconds gauge',
+                  'spartacus_run_timestamp_seconds{cluster="%s"} %f'
+                  % (cluster, time.time())]
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        """ close the json lines and write the textfile, renamed in place
+        as the node exporter may read it at any time """
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        if self.textfile is None:
+            return
+        tmp = '%s.%s' % (self.textfile, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.prometheus())
+            os.rename(tmp, self.textfile)
+        except (IOError, OSError) as ex:
+            logger.warning('metrics textfile %s not written: %s'
+                           % (self.textfile, ex))
+
+
+def metrics_sink(path=None, textfile=None, cluster=''):
+    """ open the sink of the run, closed at exit """
+    global sink
+    with sink_lock:
+        if sink is None:
+            sink = MetricsSink(path, textfile, cluster)
+            atexit.register(sink.close)
+            logger.debug('timing spans of run %s to %s' % (sink.run, path))
+        return sink
+
+
+@contextmanager
+def span(phase, vm=None):
+    """ time the block as a phase of the deploy of vm (of the run if vm is
+    None), nothing recorded without a sink """
+    if sink is None:
+        yield
+        return
+    started = time.time()
+    status = 'ok'
+    try:
+        yield
+    except SystemExit as ex:
+        if ex.code not in (0, None):
+            status = 'error'
+        raise
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        sink.add(phase, vm, started, time.time() - started, status)
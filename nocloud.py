@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+import base64
+import logging
+import struct
+import time
+import yaml
+
+logger = logging.getLogger('nocloud')
+
+BLOCK = 2048
+# system area, primary and joliet descriptors, terminator, 4 path tables
+# and the 2 root directories
+DATA_START = 25
+
+
+def both16(value):
+    """ iso9660 both-endian 16 bit field """
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def both32(value):
+    """ iso9660 both-endian 32 bit field """
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def blocks_of(content):
+    """ blocks used by a file, at least one """
+    return max(1, -(-len(content) // BLOCK))
+
+
+def dir_date(now):
+    """ iso9660 7 bytes directory record date, utc """
+    return struct.pack('7B', now.tm_year - 1900, now.tm_mon, now.tm_mday,
+                       now.tm_hour, now.tm_min, now.tm_sec, 0)
+
+
+def vol_date(now):
+    """ iso9660 17 bytes volume descriptor date, utc """
+    return time.strftime('%Y%m%d%H%M%S00', now).encode() + b'\x00'
+
+
+def dir_record(name, extent, size, now, directory=False):
+    """ iso9660 directory record """
+    length = 33 + len(name)
+    length += length % 2
+    record = struct.pack('<BB', length, 0) + both32(extent) + \
+        both32(size) + dir_date(now) + \
+        struct.pack('<BBB', 2 if directory else 0, 0, 0) + both16(1) + \
+        struct.pack('<B', len(name)) + name
+    return record.ljust(length, b'\x00')
+
+
+def path_table(extent, big_endian=False):
+    """ path table of a single root directory """
+    order = '>' if big_endian else '<'
+    return struct.pack('%sBBIH' % order, 1, 0, extent, 1) + b'\x00\x00'
+
+
+def text(size, joliet=False):
+    """ blank descriptor text field, ucs-2 for joliet """
+    if joliet:
+        return (' ' * (size // 2)).encode('utf-16-be').ljust(size, b'\x00')
+    return b' ' * size
+
+
+def volume_descriptor(kind, label, blocks, root, tables, now, joliet=False):
+    """ primary (kind 1) or joliet supplementary (kind 2) descriptor """
+    descriptor = struct.pack('<B', kind) + b'CD001\x01\x00'
+    descriptor += text(32, joliet)
+    # the volume label is kept lowercase as the cloud-init tools write it
+    if joliet:
+        descriptor += label.ljust(16).encode('utf-16-be')
+    else:
+        descriptor += label.ljust(32).encode('ascii')
+    descriptor += b'\x00' * 8 + both32(blocks)
+    # ucs-2 level 3 escape sequence for joliet
+    descriptor += (b'%/E' if joliet else b'').ljust(32, b'\x00')
+    descriptor += both16(1) + both16(1) + both16(BLOCK) + both32(10)
+    descriptor += struct.pack('<II', tables[0], 0)
+    descriptor += struct.pack('>II', tables[1], 0)
+    descriptor += root
+    for size in (128, 128, 128, 128, 37, 37, 37):
+        descriptor += text(size, joliet)
+    descriptor += vol_date(now) * 2 + b'0' * 16 + b'\x00' + vol_date(now)
+    descriptor += b'\x01\x00'
+    return descriptor.ljust(BLOCK, b'\x00')
+
+
+def iso9660(files, label='cidata'):
+    """ build in memory a single directory iso9660 image with joliet names,
+    files is a list of (name, content) """
+    now = time.gmtime()
+    extents = []
+    extent = DATA_START
+    for name, content in files:
+        extents.append(extent)
+        extent += blocks_of(content)
+    blocks = extent
+
+    # root directories: 8.3 names in the primary, full names in joliet
+    roots = []
+    for joliet, root_extent in ((False, 23), (True, 24)):
+        records = [dir_record(b'\x00', root_extent, BLOCK, now, True),
+                   dir_record(b'\x01', root_extent, BLOCK, now, True)]
+        entries = []
+        for (name, content), file_extent in zip(files, extents):
+            if joliet:
+                file_id = name.encode('utf-16-be')
+            else:
+                base = ''.join(c if c.isalnum() else '_' for c in name)
+                file_id = ('%s.;1' % base[:8].upper()).encode('ascii')
+            entries.append(dir_record(file_id, file_extent, len(content),
+                                      now))
+        records.extend(sorted(entries, key=lambda record: record[33:]))
+        roots.append(b''.join(records).ljust(BLOCK, b'\x00'))
+
+    image = [b'\x00' * BLOCK * 16]
+    image.append(volume_descriptor(1, label, blocks,
+                                   dir_record(b'\x00', 23, BLOCK, now, True),
+                                   (19, 20), now))
+    image.append(volume_descriptor(2, label, blocks,
+                                   dir_record(b'\x00', 24, BLOCK, now, True),
+                                   (21, 22), now, joliet=True))
+    image.append(b'\xff' + b'CD001\x01'.ljust(BLOCK - 1, b'\x00'))
+    for root_extent in (23, 24):
+        image.append(path_table(root_extent).ljust(BLOCK, b'\x00'))
+        image.append(path_table(root_extent, True).ljust(BLOCK, b'\x00'))
+    image.extend(roots)
+    for name, content in files:
+        image.append(content.ljust(blocks_of(content) * BLOCK, b'\x00'))
+    return b''.join(image)
+
+
+def user_data(files, commands=()):
+    """ cloud-config writing the configuration files, as (path in the guest
+    root, content, mode), and running commands at the first boot """
+    config = {'write_files': [{'path': '/%s' % path,
+                               'content': base64.b64encode(content).decode(),
+                               'encoding': 'b64',
+                               'owner': 'root:root',
+                               'permissions': '0%o' % mode}
+                              for path, content, mode in files],
+              # keep the deployed host keys and root access
+              'ssh_deletekeys': False,
+              'ssh_genkeytypes': [],
+              'disable_root': False}
+    if commands:
+        config['runcmd'] = list(commands)
+    return ('#cloud-config\n%s' % yaml.safe_dump(config,
+                                                 default_flow_style=False)
+            ).encode()
+
+
+def meta_data(instance_id, hostname):
+    """ nocloud meta-data """
+    return yaml.safe_dump({'instance-id': instance_id,
+                           'local-hostname': hostname},
+                          default_flow_style=False).encode()
+
+
+def seed_image(instance_id, hostname, files, commands=()):
+    """ nocloud seed image, the network is configured by the deployed files
+    so cloud-init gets an empty network configuration """
+    logger.info('building nocloud seed for %s (%s files)'
+                % (hostname, len(files)))
+    return iso9660([('meta-data', meta_data(instance_id, hostname)),
+                    ('network-config', b'version: 1\nconfig: []\n'),
+                    ('user-data', user_data(files, commands))])
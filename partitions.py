@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+
+import json
+import logging
+import os
+import struct
+import threading
+
+logger = logging.getLogger('partitions')
+
+SECTOR = 512
+# sectors holding the mbr, the gpt header and 128 gpt entries
+TABLE_SECTORS = 34
+
+
+def partition_offset(data, part):
+    """ parse the mbr or gpt partition table at the start of a raw disk,
+    return offset and size in bytes of the partition number part, None
+    for a missing partition or an unsupported layout """
+    part = int(part)
+    if len(data) < SECTOR or data[510:512] != b'\x55\xaa':
+        return None
+    entries = [struct.unpack('<B3xB3xII', data[446 + 16 * i:462 + 16 * i])
+               for i in range(4)]
+
+    # protective mbr, partitions in the gpt
+    if entries[0][1] == 0xee:
+        header = data[SECTOR:2 * SECTOR]
+        if header[:8] != b'EFI PART':
+            return None
+        entries_lba, count, size = struct.unpack('<QII', header[72:88])
+        if part > count:
+            return None
+        start = entries_lba * SECTOR + (part - 1) * size
+        if start + size > len(data):
+            return None
+        first, last = struct.unpack('<QQ', data[start + 32:start + 48])
+        if first == 0:
+            return None
+        return first * SECTOR, (last - first + 1) * SECTOR
+
+    # primary mbr partitions only, logical ones need the extended chain
+    if part > 4:
+        return None
+    status, ptype, first, sectors = entries[part - 1]
+    if ptype == 0 or ptype in (0x05, 0x0f, 0x85) or sectors == 0:
+        return None
+    return first * SECTOR, sectors * SECTOR
+
+
+class PartitionCache:
+    """ partition offsets by template, every clone of a template has the
+    same partition table: kept in memory and in a json file """
+    path = ''
+    partitions = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.partitions = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.partitions = json.load(f)
+            except ValueError:
+                logger.warning('invalid partition cache %s, ignored' % path)
+
+    def key(self, template, part):
+        return '%s:%s' % (template, part)
+
+    def get(self, template, part):
+        with self.lock:
+            partition = self.partitions.get(self.key(template, part))
+        return tuple(partition) if partition is not None else None
+
+    def set(self, template, part, partition):
+        with self.lock:
+            self.partitions[self.key(template, part)] = list(partition)
+            self.save()
+
+    def drop(self, template, part):
+        with self.lock:
+            if self.partitions.pop(self.key(template, part), None):
+                self.save()
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.path, 'w') as f:
+            json.dump(self.partitions, f, indent=2, sort_keys=True)
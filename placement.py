@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+
+import logging
+
+logger = logging.getLogger('placement')
+
+
+class NodeCapacity:
+    """ resources of a node from its status, less the ones committed to
+    the vms placed on it and not yet running """
+    node = ''
+
+    def __init__(self, node, status):
+        self.node = node
+        self.ncpu = status['cpuinfo']['cpus']
+        cpu1 = int(float(status['loadavg'][0]))
+        cpu5 = int(float(status['loadavg'][1]))
+        self.load = (cpu1 + cpu5) / 2
+        self.totram = status['memory']['total'] / 1048576
+        self.freeram = status['memory']['free'] / 1048576
+        self.committed_ram = 0
+        self.committed_cpus = 0
+
+    def magic(self, memory=0, vcpus=0):
+        """ node score, the higher the better, with the committed resources
+        and a vm of memory MiB and vcpus placed on it: every vcpu counted
+        as fully loaded """
+        freeram = self.free(memory)
+        load = self.load + self.committed_cpus + vcpus
+        return self.ncpu - load + int(freeram * 100 / self.totram)
+
+    def free(self, memory=0):
+        """ free MiB with the committed ones and memory placed on it """
+        return self.freeram - self.committed_ram - memory
+
+    def fits(self, memory, vcpus, thres):
+        """ the node stays in the thresholds with the vm placed on it """
+        return self.magic(memory, vcpus) >= thres['MAGIC'] and \
+            self.free(memory) > thres['MEMORY']
+
+    def commit(self, memory, vcpus):
+        self.committed_ram += memory
+        self.committed_cpus += vcpus
+
+
+def vm_request(options):
+    """ memory MiB and vcpus requested by a hostbook """
+    return (int(options['memory']),
+            int(options['sockets']) * int(options['cores']))
+
+
+def ranked(statuses, options, thres):
+    """ the nodes where the vm of a hostbook stays in the thresholds, best
+    scoring first """
+    memory, vcpus = vm_request(options)
+    nodes = [NodeCapacity(node, status) for node, status in statuses.items()]
+    candidates = [capacity for capacity in nodes
+                  if capacity.fits(memory, vcpus, thres)]
+    return [capacity.node for capacity in sorted(
+        candidates, key=lambda c: (c.magic(memory, vcpus), c.node),
+        reverse=True)]
+
+
+def place(statuses, hostbooks, thres):
+    """ placement plan of a batch in one pass, vm name to node (None if no
+    node fits): the vms with a given node are committed first, then the
+    others by decreasing memory each on the best scoring node that stays
+    in the thresholds, so that every choice sees the previous ones """
+    nodes = dict((node, NodeCapacity(node, status))
+                 for node, status in statuses.items())
+    plan = {}
+    pending = []
+    for options in hostbooks:
+        memory, vcpus = vm_request(options)
+        node = options.get('node', 'auto')
+        if node != 'auto':
+            plan[options['name']] = node
+            if node in nodes:
+                nodes[node].commit(memory, vcpus)
+        else:
+            pending.append((memory, vcpus, options['name']))
+
+    for memory, vcpus, name in sorted(pending, key=lambda r: (-r[0], -r[1])):
+        candidates = [capacity for capacity in nodes.values()
+                      if capacity.fits(memory, vcpus, thres)]
+        if not candidates:
+            logger.warning('no node with resources available for %s' % name)
+            plan[name] = None
+            continue
+        best = max(candidates, key=lambda c: (c.magic(memory, vcpus),
+                                              c.node))
+        best.commit(memory, vcpus)
+        plan[name] = best.node
+        logger.debug('%s placed on %s (magic %s, free %s MiB)'
+                     % (name, best.node, best.magic(), best.free()))
+    return plan
@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+
+from proxmoxapi import PooledAuth, PooledProxmox
+from yamlschema import YamlSchema
+from cluster import ClusterSnapshot, check_proxmox_response
+from ipam import Ipam, cluster_addresses, inventory_addresses, uses_auto
+from concurrent.futures import ThreadPoolExecutor
+import spartacus
+import argparse
+import coloredlogs
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
+OUTPUT_FORMATS = ['text', 'json']
+
+logger = logging.getLogger('plan')
+
+
+def log_init(loglevel):
+    """ initialize the logging system, on stderr to keep the plan apart """
+    FORMAT = '%(asctime)s %(levelname)s %(module)s %(message)s'
+    logging.basicConfig(format=FORMAT, level=getattr(logging,
+                                                     loglevel.upper()))
+    coloredlogs.install(level=loglevel.upper(), stream=sys.stderr)
+
+
+class RecordedApi:
+    """ read only pyproxmox stand-in answering from a recorded cluster
+    snapshot: nodes, statuses, storage, vm index, vm configs and version.
+    New vm ids are handed out from the first one free in the snapshot """
+    snapshot = {}
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.lock = threading.Lock()
+        self.used = set(int(vm['vmid']) for vm in snapshot['vms'])
+        self.next = 100
+
+    def response(self, data, code=200, reason='OK'):
+        return {'status': {'code': code, 'ok': code == 200,
+                           'reason': reason},
+                'data': data}
+
+    def missing(self, what):
+        return self.response(None, 404, '%s not recorded' % what)
+
+    def connect(self, conn_type, option, post_data, files=None):
+        """ the recorded read requests, every change refused """
+        if conn_type != 'get':
+            return self.response(None, 501, 'offline plan, %s %s refused'
+                                 % (conn_type, option))
+        if option == 'version':
+            return self.response(self.snapshot['version'])
+        if option.startswith('cluster/resources'):
+            return self.response(self.snapshot['vms'])
+        m = re.match(r'cluster/nextid\?vmid=(\d+)$', option)
+        if m is not None:
+            if int(m.group(1)) in self.used:
+                return self.response(None, 400, 'vmid already used')
+            return self.response(m.group(1))
+        return self.missing(option)
+
+    def getClusterNodeList(self):
+        return self.response(self.snapshot['nodes'])
+
+    def getNodeStatus(self, node):
+        if node not in self.snapshot['statuses']:
+            return self.missing('status of %s' % node)
+        return self.response(self.snapshot['statuses'][node])
+
+    def getNodeStorage(self, node):
+        if node not in self.snapshot['storage']:
+            return self.missing('storage of %s' % node)
+        return self.response(self.snapshot['storage'][node])
+
+    def getStorageRRDData(self, node, storage, timeframe='hour'):
+        return self.response(self.snapshot.get('rrd', {}).get(
+                             '%s/%s' % (node, storage), []))
+
+    def getVirtualConfig(self, node, vmid):
+        key = '%s/%s' % (node, vmid)
+        if key not in self.snapshot['configs']:
+            return self.missing('config of %s' % key)
+        return self.response(self.snapshot['configs'][key])
+
+    def getClusterVmNextId(self):
+        """ the first id free in the snapshot and not yet planned """
+        with self.lock:
+            while self.next in self.used:
+                self.next += 1
+            self.used.add(self.next)
+            return self.response(str(self.next))
+
+
+def record(connessione, cluster, host, rrd_volumes=(), workers=16):
+    """ snapshot of the cluster state read by a deploy, the storage seen by
+    the online nodes and by the api host, the configs of the vms requested
+    concurrently """
+    nodes = cluster.nodes()
+    online = [node['node'] for node in nodes if node['status'] == 'online']
+    vms = cluster.vms()
+    snapshot = {'recorded': int(time.time()),
+                'version': check_proxmox_response(connessione.connect(
+                    'get', 'version', None))['data'],
+                'nodes': nodes,
+                'statuses': cluster.node_statuses(online),
+                'storage': dict((node, cluster.node_storage(node))
+                                for node in set(online + [host])),
+                'vms': vms, 'configs': {}, 'rrd': {}}
+
+    def vm_config(vm):
+        response = connessione.getVirtualConfig(vm['node'], vm['vmid'])
+        if response['status']['code'] != 200:
+            logger.warning('vm %s config not received, skipped' % vm['vmid'])
+            return
+        snapshot['configs']['%s/%s' % (vm['node'], vm['vmid'])] = \
+            response['data']
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(vm_config, [vm for vm in vms
+                                      if vm.get('type') == 'qemu']))
+    for volume in rrd_volumes:
+        snapshot['rrd']['%s/%s' % (host, volume)] = cluster.storage_rrd(
+            host, volume)
+    return snapshot
+
+
+def plan(cfg, snapshot, hostbooks, init=True, log_level=LOG_LEVELS[2],
+         keep=False):
+    """ run the deploy of the hostbooks readonly against the snapshot, no
+    request leaves the process: return the result of every vm, the
+    rendered configurations written to TMP_DIR only if keep """
+    spartacus.cfg = cfg
+    connessione = RecordedApi(snapshot)
+    cluster = ClusterSnapshot(connessione, ttl=float('inf'))
+
+    if uses_auto(hostbooks):
+        seeds = inventory_addresses(cfg['IPAM']['HOSTBOOKS'])
+        if cfg['IPAM']['SEED_CLUSTER']:
+            seeds.update(cluster_addresses(cluster))
+        ipam = Ipam(cfg['VLAN_SUBNETS'], '%s/ipam.json' % cfg['TMP_DIR'])
+        ipam.assign(hostbooks, seeds, save=False)
+
+    spartacus.placementPlan(cluster, hostbooks)
+    return [spartacus.deploy_job(connessione, cluster, options, init,
+                                 True, True, log_level, keep)
+            for options in hostbooks]
+
+
+def report_text(results, elapsed):
+    """ the plan of every vm and the totals by node and storage """
+    lines = []
+    for r in results:
+        lines.append('%-24s %-7s id %-6s node %-8s storage %-8s'
+                     % (r['name'], r['status'], r['vmid'], r['node'],
+                        r['storage']))
+        if r['status'] != 'ok':
+            lines.append('    %s' % r['error'])
+            continue
+        lines.append('    %s clone of %s (id %s)'
+                     % (r['clone'], r['template'], r['tid']))
+        for interface in r['interfaces']:
+            lines.append('    %s vlan %s mac %s address %s netmask %s '
+                         'gateway %s' % (interface['net'], interface['vlan'],
+                                         interface['mac'],
+                                         interface['ipaddress'],
+                                         interface['netmask'],
+                                         interface['gateway']))
+        for key, value in sorted(r['config'].items()):
+            lines.append('    %s: %s' % (key, value))
+        for name, content in sorted(r['rendered'].items()):
+            if not content:
+                continue
+            lines.append('    --- %s' % name)
+            lines.extend(('    %s' % line).rstrip()
+                         for line in content.rstrip('\n').split('\n'))
+    planned = [r for r in results if r['status'] == 'ok']
+    for key in ('node', 'storage'):
+        counts = {}
+        for r in planned:
+            counts[r[key]] = counts.get(r[key], 0) + 1
+        lines.append('by %s: %s' % (key, ', '.join(
+            '%s %s' % (k, counts[k]) for k in sorted(counts))))
+    lines.append('%s planned, %s failed in %.3fs'
+                 % (len(planned), len(results) - len(planned), elapsed))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    description = 'plan, simulate a deploy on a recorded cluster snapshot'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-s', '--settings', default='settings',
+                        help='custom settings file in settings package')
+    parser.add_argument('-f', '--snapshot', required=True,
+                        help='json cluster snapshot to plan on')
+    parser.add_argument('-R', '--record', dest='record',
+                        action='store_true',
+                        help='record the snapshot from the live cluster '
+                        'instead of planning (default disabled)')
+    parser.set_defaults(record=False)
+    parser.add_argument('-i', '--inventory', default=None,
+                        help='yaml file (also multi-document) or directory '
+                        'of yaml files to plan')
+    parser.add_argument('-n', '--no-rawinit', dest='init',
+                        action='store_false',
+                        help='disables templates rendering (default enabled)')
+    parser.set_defaults(init=True)
+    parser.add_argument('-k', '--linked', dest='linked',
+                        action='store_true',
+                        help='linked clone of the template for all the '
+                        'hostbooks (default by hostbook, full)')
+    parser.set_defaults(linked=False)
+    parser.add_argument('-c', '--nocloud', dest='nocloud',
+                        action='store_true',
+                        help='customize all the hostbooks by a nocloud seed '
+                        'image instead of rawinit (default disabled)')
+    parser.set_defaults(nocloud=False, readonly=True)
+    parser.add_argument('-K', '--keep', dest='keep', action='store_true',
+                        help='write the rendered configurations to TMP_DIR '
+                        '(default disabled)')
+    parser.set_defaults(keep=False)
+    parser.add_argument('-o', '--output', default=OUTPUT_FORMATS[0],
+                        choices=OUTPUT_FORMATS,
+                        help='plan format (default text)')
+    parser.add_argument('-l', '--log-level', default=LOG_LEVELS[2],
+                        help='log level (default warning)',
+                        choices=LOG_LEVELS)
+
+    # parse cli options
+    cli_options = parser.parse_args()
+    log_init(cli_options.log_level)
+    logger.debug(cli_options)
+
+    # load settings from setting package
+    cfg = spartacus.settings_load(cli_options.settings)
+
+    if cli_options.record:
+        logger.info('connecting to %s' % cfg['PROXMOX']['HOST'])
+        auth = PooledAuth(cfg['PROXMOX']['HOST'], cfg['PROXMOX']['USER'],
+                          cfg['PROXMOX']['PASSWORD'],
+                          port=cfg['PROXMOX'].get('PORT', 8006),
+                          pool_size=cfg['API_POOL']['SIZE'],
+                          timeout=cfg['API_POOL']['TIMEOUT'])
+        proxmox_api = PooledProxmox(auth)
+        cluster = ClusterSnapshot(proxmox_api, ttl=cfg['CLUSTER_TTL'],
+                                  timeout=cfg['NODE_STATUS_TIMEOUT'])
+        rrd_volumes = []
+        if cfg['STORAGE_BALANCE']['RRD']:
+            rrd_volumes = cfg['VM_DEFAULTS']['ODD_VOL'] + \
+                cfg['VM_DEFAULTS']['EVEN_VOL']
+        snapshot = record(proxmox_api, cluster,
+                          cfg['PROXMOX']['HOST'].split('.')[0], rrd_volumes)
+        with open(cli_options.snapshot, 'w') as f:
+            json.dump(snapshot, f, indent=2, sort_keys=True)
+        logger.info('cluster snapshot of %s vms recorded in %s'
+                    % (len(snapshot['vms']), cli_options.snapshot))
+        sys.exit(0)
+
+    if cli_options.inventory is None:
+        parser.error('the inventory is required to plan')
+    try:
+        with open(cli_options.snapshot, 'r') as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError) as ex:
+        logger.error('cluster snapshot loading error: %s' % ex)
+        sys.exit('exiting')
+
+    started = time.time()
+    hostbook_cache = None
+    if cfg['HOSTBOOK_CACHE']:
+        hostbook_cache = '%s/hostbooks.json' % cfg['TMP_DIR']
+    yaml_schema = YamlSchema(cfg['VM_DEFAULTS'], cfg['VM_RESOURCES'],
+                             cache=hostbook_cache)
+    hostbooks = [spartacus.options_prepare(parsed_options, cli_options)
+                 for parsed_options
+                 in yaml_schema.parse_all(cli_options.inventory)]
+    results = plan(cfg, snapshot, hostbooks, init=cli_options.init,
+                   log_level=cli_options.log_level,
+                   keep=cli_options.keep or cfg['KEEP_RENDERED'])
+    elapsed = time.time() - started
+
+    if cli_options.output == 'json':
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(report_text(results, elapsed))
+
+    if any(r['status'] != 'ok' for r in results):
+        sys.exit(1)
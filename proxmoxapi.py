@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+
+from pyproxmox import pyproxmox
+from requests.adapters import HTTPAdapter
+import json
+import logging
+import os
+import requests
+import sys
+import threading
+import time
+import urllib.parse
+import urllib3
+
+logger = logging.getLogger('proxmoxapi')
+
+# proxmox tickets are valid for two hours, renew them a bit before
+TICKET_LIFETIME = 7000
+
+
+class PooledAuth:
+    """ proxmox authentication by a keep-alive session: the ticket is
+    optionally cached on disk and reused by the next runs while valid """
+    url = ''
+    port = 8006
+    ticket = {}
+    CSRF = ''
+    created = 0
+
+    def __init__(self, url, username, password, port=8006, pool_size=16,
+                 timeout=30, ticket_cache=None):
+        self.url = url
+        self.port = port
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+        self.ticket_cache = ticket_cache
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        if not self.load_ticket():
+            self.renew()
+
+    def base_url(self):
+        return 'https://%s:%s/api2/json' % (self.url, self.port)
+
+    def renew(self, seen=None):
+        """ get a new ticket and csrf token and cache them, unless another
+        thread already renewed the ticket created at seen """
+        with self.lock:
+            if seen is not None and self.created != seen:
+                logger.debug('proxmox ticket already renewed')
+                return
+            self.login()
+            self.save_ticket()
+
+    def login(self):
+        """ get a new ticket and csrf token """
+        logger.debug('login on %s as %s' % (self.url, self.username))
+        response = self.session.post('%s/access/ticket' % self.base_url(),
+                                     data={'username': self.username,
+                                           'password': self.password},
+                                     verify=False, timeout=self.timeout)
+        if response.status_code != 200:
+            logger.error('proxmox login failed, response code %s: %s' %
+                         (response.status_code, response.reason))
+            sys.exit('exiting')
+        data = response.json()['data']
+        self.ticket = {'PVEAuthCookie': data['ticket']}
+        self.CSRF = data['CSRFPreventionToken']
+        self.created = time.time()
+
+    def load_ticket(self):
+        """ reuse a cached ticket of the same user and host, if valid """
+        ticket_cache = self.ticket_cache
+        if ticket_cache is None or not os.path.exists(ticket_cache):
+            return False
+        try:
+            with open(ticket_cache, 'r') as f:
+                cached = json.load(f)
+        except ValueError:
+            return False
+        if cached.get('url') != self.url or \
+           cached.get('username') != self.username or \
+           time.time() - cached.get('created', 0) > TICKET_LIFETIME:
+            return False
+        logger.debug('reusing cached ticket from %s' % ticket_cache)
+        self.ticket = {'PVEAuthCookie': cached['ticket']}
+        self.CSRF = cached['CSRF']
+        self.created = cached['created']
+        return True
+
+    def save_ticket(self):
+        """ cache the ticket, readable only by the current user """
+        ticket_cache = self.ticket_cache
+        if ticket_cache is None:
+            return
+        folder = os.path.dirname(ticket_cache)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        fd = os.open(ticket_cache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'url': self.url, 'username': self.username,
+                       'ticket': self.ticket['PVEAuthCookie'],
+                       'CSRF': self.CSRF, 'created': self.created}, f)
+
+
+class PooledProxmox(pyproxmox):
+    """ pyproxmox api sharing the keep-alive session of the authentication:
+    responses are not kept on the instance, so a single object can be used
+    by concurrent threads """
+
+    def __init__(self, auth_class):
+        self.auth = auth_class
+        self.url = auth_class.url
+        self.session = auth_class.session
+        self.timeout = auth_class.timeout
+
+    def request(self, conn_type, option, post_data, files=None):
+        """ send a request with the current ticket of the session """
+        headers = {'Accept': 'application/json'}
+        if conn_type != 'get':
+            headers['CSRFPreventionToken'] = str(self.auth.CSRF)
+        return self.session.request(conn_type.upper(),
+                                    '%s/%s' % (self.auth.base_url(), option),
+                                    data=post_data, files=files,
+                                    cookies=self.auth.ticket,
+                                    headers=headers, verify=False,
+                                    timeout=self.timeout)
+
+    def connect(self, conn_type, option, post_data, files=None):
+        """ the main communication method, pyproxmox compatible, files are
+        sent as multipart form data """
+        try:
+            seen = self.auth.created
+            response = self.request(conn_type, option, post_data, files)
+            if response.status_code == 401:
+                # cached or long lived ticket expired, login again once
+                # for all the threads that saw it rejected
+                logger.info('proxmox ticket expired, renewing it')
+                self.auth.renew(seen)
+                response = self.request(conn_type, option, post_data,
+                                        files)
+        except requests.RequestException as ex:
+            logger.debug('request %s %s failed: %s' % (conn_type, option, ex))
+            return {'status': {'code': 599, 'ok': False, 'reason': str(ex)},
+                    'data': None}
+        try:
+            returned_data = response.json()
+        except ValueError:
+            returned_data = {'data': None}
+        returned_data['status'] = {'code': response.status_code,
+                                   'ok': response.ok,
+                                   'reason': response.reason}
+        return returned_data
+
+    # api methods missing in the pypi release of pyproxmox
+    def getClusterNodeList(self):
+        """List cluster nodes. Returns JSON"""
+        return self.connect('get', 'nodes', None)
+
+    def cloneVirtualMachine(self, node, vmid, post_data):
+        """Create a copy of virtual machine/template. Returns JSON"""
+        return self.connect('post', 'nodes/%s/qemu/%s/clone' % (node, vmid),
+                            post_data)
+
+    def uploadStorageContent(self, node, storage, content, filename, data):
+        """Upload a file (iso, vztmpl) to a node storage. Returns JSON"""
+        return self.connect('post', 'nodes/%s/storage/%s/upload'
+                            % (node, storage), {'content': content},
+                            files={'filename': (filename, data)})
+
+    def deleteStorageContent(self, node, storage, volume):
+        """Delete a volume of a node storage. Returns JSON"""
+        return self.connect('delete', 'nodes/%s/storage/%s/content/%s'
+                            % (node, storage,
+                               urllib.parse.quote(volume, safe='')), None)
+
+    def getStorageRRDData(self, node, storage, timeframe='hour'):
+        """Read storage RRD statistics. Returns JSON"""
+        return self.connect('get', 'nodes/%s/storage/%s/rrddata?timeframe=%s'
+                            % (node, storage, timeframe), None)
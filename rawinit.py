@@ -1,26 +1,47 @@
 #! /usr/bin/env python
 
 from paramiko import SSHClient, WarningPolicy
-from paramiko import RSAKey, ECDSAKey
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from yamlschema import YamlSchema
 import sys
 import logging
 import argparse
+import base64
 import coloredlogs
-import subprocess
 import os
 import importlib
-from pysshops import SshOps, SftpOps, SshCommandBlockingException
+import io
+import tarfile
+import re
+import threading
+import time
+from remote import RemoteSteps
+from tracer import host_ops
+from metrics import span
+from hostkeys import key_pool
+import nocloud
+from partitions import PartitionCache, partition_offset, SECTOR, TABLE_SECTORS
+from pysshops import SshCommandBlockingException
 
 
 SETTINGS_KEY = ['PROXMOX', 'SSH_HOST_KEY', 'DEV', 'TMP_DIR', 'STATIC_DIR',
                 'VM_RESOURCES', 'VM_DEFAULTS', 'OS_DEFAULTS', 'KVM_THRES',
                 'IMAGES_BASEPATH', 'TEMPLATE_MAP', 'WORKING_MNT']
+SETTINGS_OPTIONAL = {'NBD_POOL': {'SIZE': 16,
+                                  'LOCK_DIR': '/run/lock/spartacus',
+                                  'TIMEOUT': 600, 'STALE': 3600},
+                     'LOOP_MOUNT': True, 'LOCAL_EXEC': True,
+                     'SSH_HOST_KEYS': {'TYPES': ['rsa'], 'POOL': 8},
+                     'KEEP_RENDERED': False}
 LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
 
 logger = logging.getLogger('rawinit')
 
+partition_cache = None
+
+env = None
+env_lock = threading.Lock()
+
 
 def log_init(loglevel):
     """ initialize the logging system """
@@ -48,6 +69,8 @@ def settings_load(settings_file):
     except AttributeError as ex:
         logger.error('settings loading error: %s' % (ex))
         sys.exit('exiting')
+    for setting, default in SETTINGS_OPTIONAL.items():
+        settings[setting] = getattr(settings_module, setting, default)
     return settings
 
 
@@ -67,123 +90,200 @@ def netid_generate(interfaces, template):
         logger.debug(interface['id'])
 
 
-def template_compile(configs):
-    """ compile jinja template """
-    env = Environment(loader=FileSystemLoader('templates'))
+def template_env():
+    """ the jinja environment shared by all the renderings of the process,
+    templates are compiled once and their bytecode cached in TMP_DIR """
+    global env
+    with env_lock:
+        if env is None:
+            cache_dir = '%s/.jinja' % cfg['TMP_DIR']
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            env = Environment(loader=FileSystemLoader('templates'),
+                              bytecode_cache=FileSystemBytecodeCache(
+                                  cache_dir))
+        return env
 
-    custom_tmp_fd = '%s/%s' % (cfg['TMP_DIR'], configs['name'])
-    try:
-        subprocess.call(['mkdir', '-p', custom_tmp_fd])
-    except subprocess.CalledProcessError as ex:
-        logger.error('error creating the folder %s: %s' % (custom_tmp_fd,
-                                                           ex.output))
-        sys.exit('exiting')
+
+def template_compile(configs, keep=False):
+    """ render the jinja templates in memory, return the configurations by
+    name, written to TMP_DIR/<name> too only if keep """
+    j2_env = template_env()
+    rendered = {}
 
     netid_generate(configs['interfaces'], configs['template'])
 
     # cross OS family configurations
     for config_key in cfg['TEMPLATE_MAP'].keys():
-        j2_template = env.get_template('%s.j2' % config_key)
-        with open('%s/%s' % (custom_tmp_fd, config_key), 'w') as config_file:
-            if cfg['TEMPLATE_MAP'][config_key] in configs:
-                var = configs[cfg['TEMPLATE_MAP'][config_key]]
-                config_file.write(j2_template.render(var=var))
+        rendered[config_key] = ''
+        if cfg['TEMPLATE_MAP'][config_key] in configs:
+            var = configs[cfg['TEMPLATE_MAP'][config_key]]
+            j2_template = j2_env.get_template('%s.j2' % config_key)
+            rendered[config_key] = j2_template.render(var=var)
 
     # network configuration based on OS family (template name)
     if 'debian' in configs['template']:
-        j2_debian_network = env.get_template('interfaces.j2')
-        with open('%s/interfaces' % (custom_tmp_fd), 'w') as config_file:
-            var = configs['interfaces']
-            config_file.write(j2_debian_network.render(var=var))
+        j2_debian_network = j2_env.get_template('interfaces.j2')
+        var = configs['interfaces']
+        rendered['interfaces'] = j2_debian_network.render(var=var)
     elif 'centos' in configs['template']:
-        j2_centos_network = env.get_template('ifcfg-ethX.j2')
+        j2_centos_network = j2_env.get_template('ifcfg-ethX.j2')
         for interface in configs['interfaces']:
-            with open('%s/ifcfg-%s' % (custom_tmp_fd, interface['id']), 'w') as config_file:
-                config_file.write(j2_centos_network.render(var=interface))
+            rendered['ifcfg-%s' % interface['id']] = \
+                j2_centos_network.render(var=interface)
     else:
         logger.error('template %s not recognized' % configs['template'])
         sys.exit('exiting')
 
+    if keep:
+        keep_artifacts(configs, dict((name, content.encode()) for
+                                     name, content in rendered.items()))
+    return rendered
+
 
-def nbd_module(ssh):
+def keep_artifacts(configs, artifacts):
+    """ write debug artifacts, as name and content, to TMP_DIR/<name> """
+    custom_tmp_fd = '%s/%s' % (cfg['TMP_DIR'], configs['name'])
+    try:
+        if not os.path.exists(custom_tmp_fd):
+            os.makedirs(custom_tmp_fd)
+        for name, content in artifacts.items():
+            with open('%s/%s' % (custom_tmp_fd, name), 'wb') as artifact:
+                artifact.write(content)
+    except OSError as ex:
+        logger.error('error writing to the folder %s: %s' % (custom_tmp_fd,
+                                                             ex))
+        sys.exit('exiting')
+    logger.info('%s written to %s' % (', '.join(sorted(artifacts)),
+                                      custom_tmp_fd))
+
+
+def nbd_module(steps):
     """ load the nbd kernel module """
-    logger.info('modprobe of nbd module')
-    command = 'sudo modprobe nbd'
-    ssh.remote_command(command)
+    command = 'sudo modprobe nbd max_part=16 nbds_max=%s' % \
+              cfg['NBD_POOL']['SIZE']
+    return steps.add(command)
+
+
+def nbd_acquire(ssh):
+    """ lock a free nbd device of the remote host: a device is free when
+    not connected and its lock directory can be created, locks older than
+    the stale timeout of not connected devices are reclaimed """
+    pool = cfg['NBD_POOL']
+    command = ('mkdir -p %(lock)s; '
+               'for sys in /sys/block/nbd*; do '
+               'dev=${sys##*/}; lock=%(lock)s/$dev.lock; '
+               '[ -e $sys/pid ] && continue; '
+               'find $lock -maxdepth 0 -mmin +%(stale)s '
+               '-exec rmdir {} \\; 2>/dev/null; '
+               'if mkdir $lock 2>/dev/null; then '
+               '[ -e $sys/pid ] && { rmdir $lock; continue; }; '
+               'echo /dev/$dev; exit 0; fi; '
+               'done; exit 1') % {'lock': pool['LOCK_DIR'],
+                                  'stale': pool['STALE'] // 60}
+    deadline = time.time() + pool['TIMEOUT']
+    while True:
+        exitcode, dev = ssh.remote_command(command, block=False)
+        if exitcode == 0:
+            return dev.strip()
+        if time.time() > deadline:
+            logger.error('no free nbd device in %ss' % pool['TIMEOUT'])
+            sys.exit('exiting')
+        logger.info('all nbd devices busy, waiting 5 seconds')
+        time.sleep(5)
 
 
-def image_mount(ssh, dev, src, dst, part):
+def nbd_release(steps, dev):
+    """ unlock an nbd device of the pool """
+    command = 'rmdir %s/%s.lock' % (cfg['NBD_POOL']['LOCK_DIR'],
+                                    os.path.basename(dev))
+    return steps.add(command, check=False)
+
+
+def image_mount(steps, dev, src, dst, part, fmt='raw'):
     """ create a custom mountpoint and mount a qemu
     supported image by nbd """
-    command = 'sudo qemu-nbd -f raw -c %s %s' % (dev, src)
-    ssh.remote_command(command)
-    command = 'mkdir -p %s' % dst
-    ssh.remote_command(command)
-    command = 'kpartx -a %s' % dev
-    ssh.remote_command(command)
+    steps.add('sudo qemu-nbd -f %s -c %s %s' % (fmt, dev, src))
+    steps.add('mkdir -p %s' % dst)
+    steps.add('kpartx -a %s' % dev)
     src_nbd = '%sp%s' % (dev, part)
     src_mapper_nbd = src_nbd.replace('/dev/', '/dev/mapper/')
-    command = 'sudo mount %s %s' % (src_mapper_nbd, dst)
-    ssh.remote_command(command)
+    return steps.add('sudo mount %s %s' % (src_mapper_nbd, dst))
+
+
+def partition_table(steps, src):
+    """ read the sectors of the partition table of a raw image, the step
+    output is base64 encoded """
+    command = 'sudo dd if=%s bs=%s count=%s 2>/dev/null | base64 -w0' % \
+              (src, SECTOR, TABLE_SECTORS)
+    return steps.add(command)
+
+
+def loop_mount(steps, src, dst, partition):
+    """ create a custom mountpoint and mount a partition of a raw image
+    by a loop device, detached on umount """
+    steps.add('mkdir -p %s' % dst)
+    offset, size = partition
+    return steps.add('sudo mount -o loop,offset=%s,sizelimit=%s %s %s'
+                     % (offset, size, src, dst))
 
 
-def image_umount(ssh, dev, src, dst):
+def image_umount(steps, dev, src, dst):
     """ umount a qemu mounted image by nbd
     and remove custom mountpoint """
     double_check_path(dst, cfg['WORKING_MNT'])
-    command = 'sudo umount %s' % dst
-    ssh.remote_command(command)
-    command = 'rmdir %s' % dst
-    ssh.remote_command(command)
-    nbd_disconnect(ssh, dev)
+    steps.add('sudo umount %s' % dst)
+    steps.add('rmdir %s' % dst)
+    if dev is not None:
+        steps.add('kpartx -d %s' % dev)
+        nbd_disconnect(steps, dev)
 
 
-def nbd_disconnect(ssh, dev):
+def mount_device(source):
+    """ return the nbd device of a mount source """
+    m = re.search(r'(nbd\d+)', source)
+    return '/dev/%s' % m.group(1) if m is not None else None
+
+
+def nbd_disconnect(steps, dev):
     """ disconnect mounted nbd device """
-    command = 'sudo qemu-nbd -d %s' % (dev)
-    ssh.remote_command(command)
+    return steps.add('sudo qemu-nbd -d %s' % (dev))
 
 
-def check_mount(ssh, dev, src, dst):
-    """ check if the target mount is mounted """
-    command = 'mount | grep -q %s' % dst
-    try:
-        ssh.remote_command(command)
-    except SshCommandBlockingException:
-        return False
-    return True
+def check_mount(steps, dst):
+    """ check if the target mount is mounted, the step output is the
+    mounted source """
+    return steps.add('findmnt -n -o SOURCE %s' % dst, check=False)
 
 
-def check_nbd(ssh, dev):
-    """ check if qemu-nbd is in use """
-    command = 'pgrep qemu-nbd'
-    try:
-        ssh.remote_command(command)
-    except SshCommandBlockingException:
-        return False
-    return True
+def check_nbd(steps, dev):
+    """ check if the nbd device is connected """
+    return steps.add('test -e /sys/block/%s/pid' % os.path.basename(dev),
+                     check=False)
 
 
-def ssh_folder_init(ssh, dst):
-    """ create and set permission for the user .ssh folder """
-    command = 'mkdir -p %s/root/.ssh && chmod 0700 %s/root/.ssh' % (dst,
-                                                                    dst)
-    ssh.remote_command(command)
+def host_keys():
+    """ ssh host keys of the new vm from the background key pool, as
+    (path in the image, content, mode) """
+    keys = []
+    pool = key_pool(cfg['SSH_HOST_KEYS']['TYPES'],
+                    cfg['SSH_HOST_KEYS']['POOL'])
+    for kind in cfg['SSH_HOST_KEYS']['TYPES']:
+        name = cfg['SSH_HOST_KEY'] if kind == 'rsa' \
+            else 'ssh_host_%s_key' % kind
+        private, public = pool.get(kind)
+        keys.append(('etc/ssh/%s' % name, private, 0o600))
+        keys.append(('etc/ssh/%s.pub' % name, public, 0o644))
+    return keys
 
 
-def generate_ssh_hostkeys(filename):
-    """ generate RSA host keys """
-    prv = RSAKey.generate(bits=2048, progress_func=None)
-    prv.write_private_key_file(filename=filename)
-    pub = RSAKey(filename=filename)
-    with open('%s.pub' % filename, 'w') as f:
-        f.write('%s %s' % (pub.get_name(), pub.get_base64()))
+def double_check_hostname(steps, dst):
+    """ read the hostname of the mounted image """
+    return steps.add('cat %s/etc/hostname' % dst)
 
 
-def double_check_hostname(ssh, dst, expected):
+def hostname_match(hostname, dst, expected):
     """ check if the hostname of the mounted images is consistent """
-    command = 'cat %s/etc/hostname' % dst
-    exitcode, hostname = ssh.remote_command(command)
     if hostname.strip() != expected:
         logger.error('the mount image on %s doesnt have the expected hostname'
                      % dst)
@@ -193,6 +293,75 @@ def double_check_hostname(ssh, dst, expected):
         return True
 
 
+def config_files(configs, rendered, keys):
+    """ list the rendered configurations to deploy as (path in the image,
+    content, mode), with the ssh host keys """
+    files = []
+
+    def add(name, path, mode=0o644):
+        if name not in rendered:
+            logger.warning('Missing %s file and will not be deployed' % name)
+            return
+        files.append((path, rendered[name].encode(), mode))
+
+    # network, debian or centos
+    if 'debian' in configs['template']:
+        add('interfaces', 'etc/network/interfaces')
+    elif 'centos' in configs['template']:
+        for interface in configs['interfaces']:
+            netid = interface['id']
+            add('ifcfg-%s' % netid,
+                'etc/sysconfig/network-scripts/ifcfg-%s' % netid)
+    add('hostname', 'etc/hostname')
+    add('serverfarm', 'etc/serverfarm')
+    add('pu_puppetenvironment', 'etc/pu_puppetenvironment')
+    add('hosts', 'etc/hosts')
+    add('puppet.conf', 'etc/puppet/puppet.conf')
+    # ssh host keys
+    files.extend(keys)
+    # public key to ssh access as root user
+    authorized_keys = '%s/authorized_keys' % cfg['STATIC_DIR']
+    if os.path.exists(authorized_keys):
+        with open(authorized_keys, 'rb') as f:
+            files.append(('root/.ssh/authorized_keys', f.read(), 0o600))
+    else:
+        logger.warning('Missing %s file and will not be deployed'
+                       % authorized_keys)
+    return files
+
+
+def config_archive(files):
+    """ pack the configurations in an in-memory tar owned by root, only
+    the root .ssh folder is added as directory to set its mode """
+    archive = io.BytesIO()
+    now = time.time()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        if any(path.startswith('root/.ssh/') for path, _, _ in files):
+            info = tarfile.TarInfo('root/.ssh')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o700
+            info.mtime = now
+            info.uname = info.gname = 'root'
+            tar.addfile(info)
+        for path, content, mode in files:
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            info.mode = mode
+            info.mtime = now
+            info.uname = info.gname = 'root'
+            tar.addfile(info, io.BytesIO(content))
+    return archive.getvalue()
+
+
+def deploy_archive(ssh, archive, dst):
+    """ stream the archive to the remote host in a single transfer and
+    unpack it in the mounted image once fully received """
+    command = ('tmp=$(mktemp) && cat > $tmp && '
+               'sudo tar -xpf $tmp --same-owner -C %s; '
+               'rc=$?; rm -f $tmp; exit $rc') % dst
+    ssh.stream_command(command, archive)
+
+
 def double_check_path(dst, mnt):
     """ check if destination path is on the expected mountpoint to
     prevent deploy on the host """
@@ -204,113 +373,200 @@ def double_check_path(dst, mnt):
         return True
 
 
-def rawinit(settings, configs, src, dst, dev='/dev/nbd0', part='1',
-            readonly=False, log_level='info'):
-    # log init
-    log_init(log_level)
+def first_boot_commands(configs):
+    """ commands applying the deployed network configuration, written by
+    cloud-init after the network is up """
+    if 'centos' in configs['template']:
+        return ['systemctl restart network']
+    return ['systemctl restart networking']
+
 
+def nocloud_seed(settings, configs, instance_id, readonly=False,
+                 log_level='info', keep=None):
+    """ compile the configurations in a nocloud seed image, an alternative
+    to rawinit for templates with cloud-init: the vm disk is not mounted.
+    Return the seed and the rendered configurations, kept in TMP_DIR if
+    keep (by default on readonly runs or with KEEP_RENDERED) """
     # load settings
     global cfg
     cfg = settings
+
+    # compile template, ssh host keys ready in the pool, none generated
+    # on readonly runs
+    if keep is None:
+        keep = readonly or cfg['KEEP_RENDERED']
+    with span('render', configs['name']):
+        rendered = template_compile(configs, keep)
+    files = config_files(configs, rendered,
+                         [] if readonly else host_keys())
+    for path, content, mode in files:
+        logger.info('%s (%o)' % (path, mode))
+    seed = nocloud.seed_image(instance_id, configs['name'], files,
+                              first_boot_commands(configs))
+    if keep:
+        keep_artifacts(configs, {'seed.iso': seed})
+    logger.info('nocloud seed of %s bytes built' % len(seed))
+    return seed, rendered
+
+
+def rawinit(settings, configs, src, dst, dev=None, part='1',
+            fmt='raw', readonly=False, log_level='info', keep=None):
+    """ customize the disk image of a vm, return the rendered
+    configurations: a readonly run only renders them. The configurations
+    are kept in TMP_DIR if keep (by default on readonly runs or with
+    KEEP_RENDERED) """
+    # load settings
+    global cfg, partition_cache
+    cfg = settings
     logger.debug(cfg)
     logger.debug(configs)
 
-    # compile template
-    template_compile(configs)
+    # compile template, kept in TMP_DIR for debug
+    if keep is None:
+        keep = readonly or cfg['KEEP_RENDERED']
+    with span('render', configs['name']):
+        rendered = template_compile(configs, keep)
 
-    # exit if it's a readonly run
+    # stop here if it's a readonly run
     if readonly:
         logger.info('running in readonly mode, templates compiled')
-        sys.exit(0)
+        return rendered
 
-    # proxmox ssh connection
-    proxmox_srv = SshOps(cfg['PROXMOX']['SSH_HOST'],
-                         cfg['PROXMOX']['USER'].split('@')[0])
+    # host keys generated in background while the image is prepared
+    key_pool(cfg['SSH_HOST_KEYS']['TYPES'], cfg['SSH_HOST_KEYS']['POOL'])
+    cache_path = '%s/partitions.json' % cfg['TMP_DIR']
+    if partition_cache is None or partition_cache.path != cache_path:
+        partition_cache = PartitionCache(cache_path)
 
-    with proxmox_srv as proxmox_ssh:
+    # proxmox ssh connection, local commands when running on the host
+    proxmox_srv = host_ops(cfg['PROXMOX']['SSH_HOST'],
+                           cfg['PROXMOX']['USER'].split('@')[0],
+                           cfg['LOCAL_EXEC'],
+                           port=cfg['PROXMOX'].get('SSH_PORT', 22),
+                           key_filename=cfg['PROXMOX'].get('SSH_KEY'))
 
-        # load nbd moudule on remote host
-        logger.info('modprobing of nbd module')
-        nbd_module(proxmox_ssh)
-        logger.info("nbd module modprobed")
+    with proxmox_srv as proxmox_ssh:
 
-        # mount vm image
-        if check_mount(proxmox_ssh, dev, src, dst):
+        # raw images are mounted by a loop device at the partition offset,
+        # qcow2 images (or a given device) by nbd
+        partition = None
+        loop = fmt == 'raw' and dev is None and cfg['LOOP_MOUNT']
+        if loop:
+            partition = partition_cache.get(configs['template'], part)
+
+        # look for a busy mountpoint on remote host
+        preflight = RemoteSteps('preflight')
+        mounted = check_mount(preflight, dst)
+        if loop and partition is None:
+            table = partition_table(preflight, src)
+        if dev is not None:
+            connected = check_nbd(preflight, dev)
+        with span('mount', configs['name']):
+            preflight.run(proxmox_ssh)
+        if loop and partition is None:
+            partition = partition_offset(base64.b64decode(table['output']),
+                                         part)
+            if partition is not None:
+                partition_cache.set(configs['template'], part, partition)
+            else:
+                logger.info('partition %s of %s not found, using nbd'
+                            % (part, src))
+
+        # release a busy mountpoint and a busy given device, load nbd module
+        cleanup = RemoteSteps('cleanup')
+        if mounted['exitcode'] == 0:
             logger.info('mountpoint %s busy, unmounting it' % dst)
-            image_umount(proxmox_ssh, dev, src, dst)
-        if check_nbd(proxmox_ssh, dev):
-            logger.info('qemu-nbd busy, disconnect it')
-            nbd_disconnect(proxmox_ssh, dev)
+            image_umount(cleanup, mount_device(mounted['output']), src, dst)
+        if dev is not None and connected['exitcode'] == 0:
+            logger.info('%s busy, disconnect it' % dev)
+            nbd_disconnect(cleanup, dev)
+        if partition is None:
+            nbd_module(cleanup)
+        with span('mount', configs['name']):
+            cleanup.run(proxmox_ssh)
+
+        if partition is not None:
+            rawinit_image(proxmox_ssh, configs, rendered, src, dst, None,
+                          part, fmt, False, partition)
+        else:
+            if dev is None:
+                # free device from the pool, concurrent rawinit use others
+                with span('nbd', configs['name']):
+                    dev = nbd_acquire(proxmox_ssh)
+                acquired = True
+                logger.info('nbd device %s acquired' % dev)
+            else:
+                acquired = False
+            try:
+                rawinit_image(proxmox_ssh, configs, rendered, src, dst, dev,
+                              part, fmt, acquired)
+            except BaseException:
+                if acquired:
+                    release = RemoteSteps('release')
+                    nbd_release(release, dev)
+                    release.run(proxmox_ssh)
+                    logger.info('nbd device %s released' % dev)
+                raise
+        logger.info('closing connection to %s' % cfg['PROXMOX']['SSH_HOST'])
+    logger.info('connection to %s closed' % cfg['PROXMOX']['SSH_HOST'])
+    return rendered
+
+
+def rawinit_image(proxmox_ssh, configs, rendered, src, dst, dev, part, fmt,
+                  acquired, partition=None):
+    """ mount the image by the nbd device (or by a loop device at the
+    partition offset), deploy the configurations and umount it """
+    mount = RemoteSteps('mount')
+    if partition is not None:
+        logger.info('mounting %s to %s by loop at offset %s'
+                    % (src, dst, partition[0]))
+        loop_mount(mount, src, dst, partition)
+    else:
         logger.info('mounting %s to %s by %s' % (src, dst, dev))
-        image_mount(proxmox_ssh, dev, src, dst, part)
-        logger.info('image %s mounted to %s by %sp%s' % (src, dst, dev, part))
+        image_mount(mount, dev, src, dst, part, fmt)
+    hostname = double_check_hostname(mount, dst)
+    with span('mount', configs['name']):
+        try:
+            mount.run(proxmox_ssh)
+        except SshCommandBlockingException:
+            if partition is not None:
+                # a stale cached offset, read the table again next time
+                partition_cache.drop(configs['template'], part)
+            raise
+    logger.info('image %s mounted to %s' % (src, dst))
+
+    # double check hostname on the mounted vm
+    if (not hostname_match(hostname['output'], dst, configs['template'])):
+        umount = RemoteSteps('umount')
+        image_umount(umount, dev, src, dst)
+        umount.run(proxmox_ssh)
+        sys.exit('exiting')
 
-        # double check hostname on the mounted vm
-        if (not double_check_hostname(proxmox_ssh, dst, configs['template'])):
-            image_umount(proxmox_ssh, dev, src, dst)
-            sys.exit('exiting')
+    # deploy configurations
+    logger.info('deploy configurations')
 
-        # deploy configurations
-        logger.info('deploy configurations')
-        custom_tmp_fd = '%s/%s' % (cfg['TMP_DIR'], configs['name'])
-
-        proxmox_sftp_srv = SftpOps(cfg['PROXMOX']['SSH_HOST'],
-                                   cfg['PROXMOX']['USER'].split('@')[0])
-        with proxmox_sftp_srv as proxmox_sftp:
-            logger.debug(proxmox_sftp)
-            logger.info('interfaces')
-            # debian
-            if 'debian' in configs['template']:
-                proxmox_sftp.deploy('%s/interfaces' % custom_tmp_fd,
-                                    '%s/etc/network/interfaces' % dst)
-            elif 'centos' in configs['template']:
-                for interface in configs['interfaces']:
-                    netid = interface['id']
-                    if_net_cfg = '%s/etc/sysconfig/network-scripts/ifcfg-%s'
-                    proxmox_sftp.deploy('%s/ifcfg-%s' % (custom_tmp_fd, netid),
-                                        if_net_cfg % (dst, netid))
-            logger.info('hostname')
-            proxmox_sftp.deploy('%s/hostname' % custom_tmp_fd,
-                                '%s/etc/hostname' % dst)
-            logger.info('serverfarm')
-            proxmox_sftp.deploy('%s/serverfarm' % custom_tmp_fd,
-                                '%s/etc/serverfarm' % dst)
-            logger.info('interfaces')
-            proxmox_sftp.deploy('%s/pu_puppetenvironment' % custom_tmp_fd,
-                                '%s/etc/pu_puppetenvironment' % dst)
-            logger.info('hosts')
-            proxmox_sftp.deploy('%s/hosts' % custom_tmp_fd,
-                                '%s/etc/hosts' % dst)
-            logger.info('puppet')
-            proxmox_sftp.deploy('%s/puppet.conf' % custom_tmp_fd,
-                                '%s/etc/puppet/puppet.conf' % dst)
-            # generate ssh host keys
-            logger.info('generate and deploy tmp RSA 2048 bit host keys')
-            generate_ssh_hostkeys('%s/%s' % (custom_tmp_fd,
-                                             cfg['SSH_HOST_KEY']))
-            logger.info('generated tmp RSA 2048 bit host keys')
-            priv = '%s' % cfg['SSH_HOST_KEY']
-            pub = '%s.pub' % cfg['SSH_HOST_KEY']
-            proxmox_sftp.deploy('%s/%s' % (custom_tmp_fd, priv),
-                                '%s/etc/ssh/%s' % (dst, priv))
-            proxmox_sftp.chmod('%s/etc/ssh/%s' % (dst, priv), 0600)
-            proxmox_sftp.deploy('%s/%s' % (custom_tmp_fd, pub), '%s/etc/ssh/%s'
-                                % (dst, pub))
-            proxmox_sftp.chmod('%s/etc/ssh/%s' % (dst, pub), 0644)
-            # public key to ssh access as root user
-            logger.info('creating the root .ssh folder')
-            ssh_folder_init(proxmox_ssh, dst)
-            proxmox_sftp.deploy('%s/authorized_keys' % cfg['STATIC_DIR'],
-                                '%s/root/.ssh/authorized_keys' % dst)
-            proxmox_sftp.chmod('%s/root/.ssh/authorized_keys' % dst, 0600)
-            logger.info('config deployed')
-
-        # deploy end, umount vm disk and close ssh connection
-        logger.info('unmounting of %s to %s by %s' % (src, dst, dev))
-        image_umount(proxmox_ssh, dev, src, dst)
-        logger.info('image %s unmounted from %s by %s' % (src, dst, dev))
-        logger.info('closing connection to %s' % cfg['PROXMOX']['SSH_HOST'])
-    logger.info('connection to %s closed' % cfg['PROXMOX']['SSH_HOST'])
+    # ssh host keys, ready in the pool
+    keys = host_keys()
+    logger.info('%s ssh host keys taken from the pool' % len(keys))
+
+    files = config_files(configs, rendered, keys)
+    for path, content, mode in files:
+        logger.info('%s (%o)' % (path, mode))
+    if not double_check_path(dst, cfg['WORKING_MNT']):
+        sys.exit('exiting')
+    with span('deploy', configs['name']):
+        deploy_archive(proxmox_ssh, config_archive(files), dst)
+    logger.info('config deployed')
+
+    # deploy end, umount vm disk, release the device and close ssh connection
+    logger.info('unmounting of %s from %s' % (src, dst))
+    umount = RemoteSteps('umount')
+    image_umount(umount, dev, src, dst)
+    if acquired:
+        nbd_release(umount, dev)
+    with span('umount', configs['name']):
+        umount.run(proxmox_ssh)
+    logger.info('image %s unmounted from %s' % (src, dst))
 
 
 if __name__ == '__main__':
@@ -322,6 +578,11 @@ if __name__ == '__main__':
                         help='custom settings file in settings package')
     parser.add_argument('-s', '--source', required=True,
                         help='the source id image to customize')
+    parser.add_argument('-f', '--format', default='raw',
+                        choices=['raw', 'qcow2'],
+                        help='the source image format (default raw)')
+    parser.add_argument('-d', '--device', default=None,
+                        help='the nbd device to use (default a free one)')
     parser.add_argument('-t', '--target', required=True,
                         help='the mount point to use for customization')
     parser.add_argument('-i', '--inventory', default=None,
@@ -361,6 +622,7 @@ if __name__ == '__main__':
 
     # call to raw init
     rawinit(cfg, options, cli_options.source, cli_options.target,
-            readonly=readonly, log_level=cli_options.log_level)
+            dev=cli_options.device, fmt=cli_options.format, readonly=readonly,
+            log_level=cli_options.log_level)
 
     sys.exit(0)
@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+
+from pysshops import SshOps, SshCommandBlockingException
+import logging
+import os
+import pwd
+import socket
+import subprocess
+import uuid
+
+logger = logging.getLogger('remote')
+
+
+class RemoteSteps:
+    """ a phase of shell steps sent to the remote host as a single script,
+    in a single ssh round-trip: the steps run in order, the first failing
+    checked step stops the phase """
+    name = ''
+    steps = []
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    def add(self, command, check=True):
+        """ append a step, return its result filled in by run """
+        step = {'command': command, 'check': check, 'exitcode': None,
+                'output': ''}
+        self.steps.append(step)
+        return step
+
+    def script(self, marker):
+        """ the shell script of the phase, the output and the exit code of
+        every step are delimited by marker lines """
+        lines = []
+        for i, step in enumerate(self.steps):
+            lines.append('echo "%s begin %s"' % (marker, i))
+            lines.append('( %s ) 2>&1; rc=$?; echo' % step['command'])
+            lines.append('echo "%s end %s $rc"' % (marker, i))
+            if step['check']:
+                lines.append('[ $rc -eq 0 ] || exit 0')
+        return '\n'.join(lines)
+
+    def parse(self, output, marker):
+        """ fill in the step results from the script output """
+        current = None
+        lines = []
+        for line in output.split('\n'):
+            fields = line.split(' ')
+            if fields[0] == marker and fields[1] == 'begin':
+                current = self.steps[int(fields[2])]
+                lines = []
+            elif fields[0] == marker and fields[1] == 'end':
+                # drop the newline echoed after the step output
+                current['output'] = '\n'.join(lines).rstrip('\n')
+                current['exitcode'] = int(fields[3])
+                current = None
+            elif current is not None:
+                lines.append(line)
+
+    def run(self, ssh):
+        """ run the phase on the ssh connection and return the step results,
+        raise SshCommandBlockingException if a checked step failed """
+        if not self.steps:
+            return self.steps
+        marker = '@@%s' % uuid.uuid4().hex
+        logger.info('running %s phase (%s steps) on %s'
+                    % (self.name, len(self.steps), ssh.hostname))
+        # the script always exits 0 so its stdout is returned, pysshops
+        # joins the output lines with ' ,'
+        exitcode, output = ssh.remote_command(self.script(marker),
+                                              block=False)
+        self.parse(output.replace('\n ,', '\n'), marker)
+        for step in self.steps:
+            logger.debug('%s: exit code %s, output: %s'
+                         % (step['command'], step['exitcode'],
+                            step['output']))
+            if step['check'] and step['exitcode'] != 0:
+                msg = '%s phase failed at %s, exit code %s: %s' \
+                      % (self.name, step['command'], step['exitcode'],
+                         step['output'])
+                logger.error(msg)
+                raise SshCommandBlockingException(msg)
+        return self.steps
+
+
+class StreamSshOps(SshOps):
+    """ pysshops ssh connection able to stream data to the stdin of a
+    remote command """
+
+    def stream_command(self, command, data, block=True):
+        """ execute a remote command feeding data to its stdin """
+        logger.info('streaming %s bytes to %s on %s' % (len(data), command,
+                                                        self.hostname))
+        stdin, stdout, stderr = self.ssh.exec_command(command)
+        stdin.write(data)
+        stdin.flush()
+        stdin.channel.shutdown_write()
+        stdout_str = stdout.read().decode()
+        stderr_str = stderr.read().decode()
+        exitcode = stdout.channel.recv_exit_status()
+        if exitcode == 0:
+            return exitcode, stdout_str
+        msg = 'ssh command failed with exit code %s: %s' % (exitcode,
+                                                            stderr_str)
+        logger.error(msg)
+        if block:
+            raise SshCommandBlockingException(msg)
+        return exitcode, stderr_str
+
+
+class LocalOps:
+    """ local execution with the interface of StreamSshOps, used when the
+    remote host is the machine running the code: commands run by the local
+    shell without the ssh handshake and encryption """
+    hostname = ''
+
+    def __init__(self, hostname, username=None):
+        self.hostname = hostname
+        self.username = username
+
+    def __enter__(self):
+        logger.info('%s is the local host, running commands locally'
+                    % self.hostname)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def check_exit(self, exitcode, stdout, stderr, block=True):
+        """ pysshops compatible exit check: stderr returned on failure """
+        if exitcode == 0:
+            return exitcode, stdout
+        msg = 'local command failed with exit code %s: %s' % (exitcode,
+                                                              stderr)
+        logger.error(msg)
+        if block:
+            raise SshCommandBlockingException(msg)
+        return exitcode, stderr
+
+    def remote_command(self, command, block=True):
+        """ execute a command by the local shell """
+        logger.info('running %s on %s' % (command, self.hostname))
+        return self.stream_command(command, b'', block)
+
+    def stream_command(self, command, data, block=True):
+        """ execute a command by the local shell feeding data to its stdin """
+        if data:
+            logger.info('streaming %s bytes to %s on %s'
+                        % (len(data), command, self.hostname))
+        process = subprocess.run(command, shell=True, input=data,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        stdout_str = process.stdout.decode()
+        stderr_str = process.stderr.decode()
+        logger.debug('stdout: ' + stdout_str)
+        logger.debug('stderr: ' + stderr_str)
+        return self.check_exit(process.returncode, stdout_str,
+                               stderr_str, block)
+
+
+def is_local_host(hostname):
+    """ true if hostname resolves to an address of the local machine: an
+    address can be bound only if assigned to a local interface """
+    try:
+        addresses = socket.getaddrinfo(hostname, None, 0, socket.SOCK_STREAM)
+    except socket.gaierror:
+        return False
+    for family, kind, proto, canonname, sockaddr in addresses:
+        probe = socket.socket(family, kind)
+        try:
+            probe.bind((sockaddr[0], 0))
+            return True
+        except OSError:
+            continue
+        finally:
+            probe.close()
+    return False
+
+
+def is_local_user(username):
+    """ true if the process runs as username, the user the commands would
+    run as by ssh (the local user when username is None) """
+    return username is None or \
+        pwd.getpwuid(os.geteuid()).pw_name == username
+
+
+def host_ops(hostname, username=None, local=True, port=22,
+             key_filename=None):
+    """ command execution on hostname: local when hostname is the local
+    machine and the process runs as the ssh user (and local execution is
+    allowed), by ssh otherwise """
+    if local and is_local_host(hostname):
+        if is_local_user(username):
+            return LocalOps(hostname, username)
+        logger.info('%s is the local host but the commands run as %s, '
+                    'running them by ssh' % (hostname, username))
+    return StreamSshOps(hostname, username, port=port,
+                        key_filename=key_filename)
@@ -0,0 +1,32 @@
+# benchmark settings (bench/run.py), the proxmox api and ssh stand-ins run
+# on the local host: ports, client key and work directory given by the
+# benchmark runner, the other settings as in settings.py
+import os
+
+from settings.settings import *  # noqa: F401,F403
+
+WORKING_DIR = os.environ.get('SPARTACUS_BENCH_DIR', './generated/bench')
+TMP_DIR = '%s/generated' % WORKING_DIR
+
+PROXMOX = {
+    'HOST': 'localhost',
+    'PORT': int(os.environ.get('SPARTACUS_BENCH_API_PORT', 18006)),
+    'SSH_HOST': 'localhost',
+    'SSH_PORT': int(os.environ.get('SPARTACUS_BENCH_SSH_PORT', 18022)),
+    'SSH_KEY': os.environ.get('SPARTACUS_BENCH_SSH_KEY'),
+    'USER': 'root@pam',
+    'PASSWORD': 'bench'
+}
+
+# the template of the benchmark hostbooks, cloned from the stand-in
+BENCH_TEMPLATE = 'bench-debian'
+
+# always through the ssh stand-in, a fresh login and state at every run
+LOCAL_EXEC = False
+API_POOL = {'SIZE': 16, 'TIMEOUT': 30, 'TICKET_CACHE': False}
+HOSTBOOK_CACHE = False
+CLONE_WAIT = {'TIMEOUT': 600, 'POLL_MIN': 0.1, 'POLL_MAX': 1}
+
+# timing spans and prometheus summary of the run in the work directory
+METRICS = {'SPANS': '%s/metrics.jsonl' % TMP_DIR,
+           'TEXTFILE': '%s/spartacus.prom' % TMP_DIR}
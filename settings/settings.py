@@ -86,7 +86,10 @@ OS_DEFAULTS = {
 # proxmox settings
 PROXMOX = {
     'HOST': 'kvm.domain',
+    'PORT': 8006,
     'SSH_HOST': 'kvm.domain',
+    'SSH_PORT': 22,
+    'SSH_KEY': None,
     'USER': 'root@pam',
     'PASSWORD': 'password'
 }
@@ -99,3 +102,84 @@ TEMPLATE_MAP = {
     'pu_puppetenvironment': 'env',
     'serverfarm': 'farm'
 }
+
+# seconds of validity of the cluster state snapshot shared by a run
+CLUSTER_TTL = 60
+# seconds to wait the node status requests, slower nodes are not placed on
+NODE_STATUS_TIMEOUT = 10
+
+# clone task wait, timeout and polling interval bounds in seconds
+CLONE_WAIT = {
+    'TIMEOUT': 3600,
+    'POLL_MIN': 0.5,
+    'POLL_MAX': 10,
+}
+
+# proxmox api client, keep-alive connection pool size, request timeout in
+# seconds and login ticket cache in TMP_DIR between runs
+API_POOL = {
+    'SIZE': 16,
+    'TIMEOUT': 30,
+    'TICKET_CACHE': True,
+}
+
+# nbd devices used by concurrent rawinit on the proxmox ssh host, remote lock
+# directory, seconds to wait a free device and age of stale locks
+NBD_POOL = {
+    'SIZE': 16,
+    'LOCK_DIR': '/run/lock/spartacus',
+    'TIMEOUT': 600,
+    'STALE': 3600,
+}
+
+# mount raw images by a loop device at the partition offset instead of
+# qemu-nbd and kpartx, partition offsets cached by template in TMP_DIR
+LOOP_MOUNT = True
+
+# run rawinit commands locally, without ssh, when PROXMOX['SSH_HOST']
+# resolves to an address of the machine running spartacus and spartacus
+# runs as PROXMOX['USER']
+LOCAL_EXEC = True
+
+# nocloud customization (-c/--nocloud or customize: nocloud), the seed image
+# is uploaded to an iso storage of the node and attached to the drive
+NOCLOUD = {'STORAGE': 'local', 'DRIVE': 'ide2'}
+
+# ssh host key types deployed on the new vms, rsa only by default, ecdsa and
+# ed25519 can be added; the rsa key is named as SSH_HOST_KEY; POOL ready keys
+# per type kept in background
+SSH_HOST_KEYS = {'TYPES': ['rsa'], 'POOL': 8}
+
+# write the rendered configurations (and the nocloud seed) to TMP_DIR/<name>
+# as debug artifacts, always done on readonly runs
+KEEP_RENDERED = False
+
+# reuse the normalized hostbooks and validation reports of the files not
+# changed since the last run, cached in TMP_DIR/hostbooks.json
+HOSTBOOK_CACHE = True
+
+# subnets by vlan for the interfaces with ipaddress: auto, addresses leased
+# in RANGE and kept in TMP_DIR/ipam.json; netmask and gateway of a vlan are
+# the interface defaults
+VLAN_SUBNETS = {
+    '116': {'NETWORK': '172.20.16.0/21', 'GATEWAY': '172.20.16.1',
+            'RANGE': ('172.20.16.100', '172.20.23.250')},
+}
+# addresses in use seeded from the hostbooks of the deployed vms (files or
+# directories) and from the cloud-init ipconfig of the cluster vms; the
+# lease of a vm not on the cluster is released after LEASE_GRACE seconds
+IPAM = {'HOSTBOOKS': [], 'SEED_CLUSTER': False, 'LEASE_GRACE': 3600}
+
+# seconds after which the vmid reserved by a deploy that never ended is free
+# again, reservations kept in TMP_DIR/vmids.json
+VMID_TTL = 7200
+
+# storage choice: the space of the pending clones is always reserved, with
+# RRD the volumes written now (used space growth in the last hour) count
+# HORIZON seconds of writes against their available space
+STORAGE_BALANCE = {'RRD': False, 'HORIZON': 600}
+
+# timing spans of the deploy phases appended as json lines to SPANS, per
+# phase summary of the run written to the prometheus TEXTFILE (e.g. in the
+# node exporter textfile directory), None disables each
+METRICS = {'SPANS': '%s/metrics.jsonl' % TMP_DIR, 'TEXTFILE': None}
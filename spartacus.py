@@ -1,6 +1,6 @@
 #! /usr/bin/env python
 
-from pyproxmox import *
+from proxmoxapi import PooledAuth
 import time
 import sys
 import random
@@ -10,17 +10,51 @@ import argparse
 import rawinit
 import re
 from yamlschema import YamlSchema
-import operator
+from cluster import ClusterSnapshot, check_proxmox_response
+from hostkeys import key_pool
+from ipam import Ipam, cluster_addresses, inventory_addresses, uses_auto
+from vmids import VmidReservations
+from placement import place, ranked
+from metrics import metrics_sink, span
+import tracer
+from storage import StorageReservations, boot_disk, config_bytes, \
+    disk_bytes, write_rate
 import importlib
+import threading
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 SETTINGS_KEY = ['PROXMOX', 'SSH_HOST_KEY', 'DEV', 'TMP_DIR', 'STATIC_DIR',
                 'VM_RESOURCES', 'VM_DEFAULTS', 'OS_DEFAULTS', 'KVM_THRES',
                 'IMAGES_BASEPATH', 'TEMPLATE_MAP', 'WORKING_MNT']
+SETTINGS_OPTIONAL = {'CLUSTER_TTL': 60, 'NODE_STATUS_TIMEOUT': 10,
+                     'CLONE_WAIT': {'TIMEOUT': 3600, 'POLL_MIN': 0.5,
+                                    'POLL_MAX': 10},
+                     'API_POOL': {'SIZE': 16, 'TIMEOUT': 30,
+                                  'TICKET_CACHE': True},
+                     'NBD_POOL': {'SIZE': 16,
+                                  'LOCK_DIR': '/run/lock/spartacus',
+                                  'TIMEOUT': 600, 'STALE': 3600},
+                     'LOOP_MOUNT': True, 'LOCAL_EXEC': True,
+                     'NOCLOUD': {'STORAGE': 'local', 'DRIVE': 'ide2'},
+                     'SSH_HOST_KEYS': {'TYPES': ['rsa'], 'POOL': 8},
+                     'KEEP_RENDERED': False, 'HOSTBOOK_CACHE': True,
+                     'VLAN_SUBNETS': {},
+                     'IPAM': {'HOSTBOOKS': [], 'SEED_CLUSTER': False,
+                              'LEASE_GRACE': 3600},
+                     'VMID_TTL': 7200,
+                     'STORAGE_BALANCE': {'RRD': False, 'HORIZON': 600},
+                     'METRICS': {'SPANS': None, 'TEXTFILE': None}}
+SIZE_UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3,
+              'TiB': 1024**4}
 LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
 
 logger = logging.getLogger('spartacus')
 
+reservations = None
+reservations_lock = threading.Lock()
+storages = None
+
 
 def log_init(loglevel):
     """ initialize the logging system """
@@ -48,6 +82,8 @@ def settings_load(settings_file):
     except AttributeError as ex:
         logger.error('settings loading error: %s' % (ex))
         sys.exit('exiting')
+    for setting, default in SETTINGS_OPTIONAL.items():
+        settings[setting] = getattr(settings_module, setting, default)
     return settings
 
 
@@ -65,9 +101,11 @@ def MACprettyprint(mac):
     return ':'.join(map(lambda x: "%02x" % x, mac))
 
 
-def getNFSVolume(connessione, name):
+def getNFSVolume(cluster, name, size=0):
     """ choose the storage volume based on vm index, check
-    for available space and selecte the bigger one """
+    for available space and selecte the bigger one, less the space of the
+    pending deployments: the size of the vm is reserved on it until
+    released, return the volume and the token of its reservation """
 
     selected_volumes = {}
 
@@ -80,235 +118,366 @@ def getNFSVolume(connessione, name):
         if int(index) % 2 == 0:
             volumes = cfg['VM_DEFAULTS']['EVEN_VOL']
 
-    storage = check_proxmox_response(connessione.getNodeStorage(
-                                     cfg['PROXMOX']['HOST'].split('.')[0]))
+    host = cfg['PROXMOX']['HOST'].split('.')[0]
+    storage = cluster.node_storage(host)
     logger.debug(storage)
 
-    for s in storage['data']:
+    for s in storage:
         for volume in volumes:
             logger.debug(volume)
             if volume in s['storage']:
-                avail = s['avail']
-                logger.debug(avail)
-                if avail <= cfg['KVM_THRES']['SPACE']:
-                    logger.debug('available space %s is under the minimum \
-                                 allowed (%s) on %s' %
-                                 (avail, cfg['KVM_THRES']['SPACE'], volume))
-                    continue
-                else:
-                    selected_volumes[volume] = avail
+                selected_volumes[volume] = s['avail']
+
+    # bytes written now on the volumes, by clones of this run or others
+    rates = {}
+    if cfg['STORAGE_BALANCE']['RRD']:
+        for volume in selected_volumes:
+            rates[volume] = write_rate(cluster.storage_rrd(host, volume))
+        logger.debug(rates)
 
     logger.debug(selected_volumes)
-    if not any(selected_volumes):
+    volume, token = storage_reservations().reserve(
+        selected_volumes, size, cfg['KVM_THRES']['SPACE'], rates,
+        cfg['STORAGE_BALANCE']['HORIZON'])
+    if volume is None:
         logger.error('no available space on selected volumes: %s' %
                      (','.join(volumes)))
         sys.exit('exiting')
-    else:
-        sorted_volumes = sorted(selected_volumes.items(),
-                                key=operator.itemgetter(1),
-                                reverse=True)
-        logger.debug(sorted_volumes)
-        return sorted_volumes[0][0]
+    return volume, token
 
 
-def findTemplate(connessione, vmname):
+def releaseVolume(cluster, token):
+    """ drop the space reservation of a deployment, the storage status is
+    fetched again to see the space allocated """
+    storage_reservations().release(token)
+    cluster.invalidate(('storage', cfg['PROXMOX']['HOST'].split('.')[0]))
+
+
+def findTemplate(cluster, vmname):
     """ look for the provided template and return id and
     location """
-    nodes = check_proxmox_response(connessione.getClusterNodeList())
-    for node in nodes['data']:
-        n = node['node']
-        machines = check_proxmox_response(connessione.getNodeVirtualIndex(n))
-        for m in machines['data']:
-            logger.debug(m['name'])
-            if (m['name'] == vmname):
-                return m['vmid'], n
-    return None, None
+    tid, node = cluster.find_template(vmname)
+    logger.debug('%s %s %s' % (vmname, tid, node))
+    return tid, node
+
+
+def templateDisk(cluster, node, tid):
+    """ return storage and format of the template boot disk, a linked
+    clone stays on the template storage """
+    config = cluster.vm_config(node, tid)
+    logger.debug(config)
+    if not config.get('template'):
+        logger.error('vm %s is not a template, linked clone not allowed'
+                     % tid)
+        sys.exit('exiting')
+    disk = boot_disk(config)
+    if disk is None:
+        logger.error('template %s has no boot disk' % tid)
+        sys.exit('exiting')
+    volume = config[disk].split(',')[0]
+    storage = volume.split(':')[0]
+    disk_format = os.path.splitext(volume)[1].lstrip('.') or 'raw'
+    return storage, disk_format
+
 
+def nodeStatuses(cluster):
+    """ status of the online nodes """
+    online = [node['node'] for node in cluster.nodes()
+              if node['status'] == 'online']
+    return cluster.node_statuses(online)
 
-def getAvailableNode(connessione, memory):
-    """choose the host wit more resources available"""
-    d = {}
-    nodes = check_proxmox_response(connessione.getClusterNodeList())
-
-    for node in nodes['data']:
-        if node['status'] == 'online':
-            n = node['node']
-            status = check_proxmox_response(connessione.getNodeStatus(n))
-            ncpu = status['data']['cpuinfo']['cpus']
-            cpu1 = int(float(status['data']['loadavg'][0]))
-            cpu5 = int(float(status['data']['loadavg'][1]))
-            totram = status['data']['memory']['total']/1048576
-            freeram = status['data']['memory']['free']/1048576
-            percram = int(freeram * 100 / totram)
-            magic = ncpu - (cpu1 + cpu5)/2 + int(percram)
-            logger.debug('%s %s %s %s %s %s %s' % (n, cpu1, cpu5, totram,
-                                                   freeram, percram, magic))
-            d[n] = {'magic': magic, 'freeram': freeram}
-
-    selected_nodes = []
-
-    for node_stat in sorted(d.items(), key=lambda x: x[1]['magic'],
-                            reverse=True):
-        logger.debug(node_stat)
-        if node_stat[1]['magic'] >= cfg['KVM_THRES']['MAGIC'] and\
-           node_stat[1]['freeram'] > int(memory) + cfg['KVM_THRES']['MEMORY']:
-            selected_nodes.append(node_stat[0])
 
+def getAvailableNode(cluster, options):
+    """choose the host wit more resources available, at random among the
+    best half so that concurrent runs do not pile on the same host"""
+    selected_nodes = ranked(nodeStatuses(cluster), options, cfg['KVM_THRES'])
     if len(selected_nodes) > 0:
-        return random.choice(selected_nodes[:len(selected_nodes)/2+1])
+        return random.choice(selected_nodes[:len(selected_nodes)//2+1])
     else:
         logger.error("no host with available resources found")
         sys.exit('exiting')
 
 
-def get_proxmox_version(connessione):
-    version = check_proxmox_response(connessione.connect('get',
-                                                         'version',
-                                                         None))
-    logger.debug(version)
-    return float(version['data']['version'])
-
-
-def check_proxmox_response(response):
-    status_code = response['status']['code']
-    if status_code != 200:
-        reason = response['status']['reason']
-        logger.error('proxmox api error, response code %s: %s' %
-                     (status_code, reason))
-        sys.exit('exiting')
-    else:
-        return response
-
+def placementPlan(cluster, hostbooks):
+    """ choose the hosts of a whole batch in one pass, the resources of
+    every vm placed counted on its host by the next choices: the auto
+    nodes of the hostbooks are set in place, to None if no host fits """
+    plan = place(nodeStatuses(cluster), hostbooks, cfg['KVM_THRES'])
+    for options in hostbooks:
+        if options.get('node', 'auto') == 'auto':
+            options['node'] = plan[options['name']]
+            logger.info('%s placed on %s' % (options['name'],
+                                             options['node']))
+    return plan
+
+
+def task_progress(lines):
+    """ parse the copy progress from the log lines of a clone task,
+    return the transferred bytes (if logged) and the percentage """
+    for line in reversed(lines):
+        # qemu-img convert: transferred 2.0 GiB of 10.0 GiB (20.00%)
+        m = re.search(r'transferred ([\d.]+) (\w+) of .*?([\d.]+)%', line)
+        if m is not None:
+            done = float(m.group(1)) * SIZE_UNITS.get(m.group(2), 1)
+            return done, float(m.group(3))
+        # drive-mirror: transferred: 1024 bytes remaining: ... 20.00 %
+        m = re.search(r'transferred: (\d+) bytes.*?([\d.]+) ?%', line)
+        if m is not None:
+            return float(m.group(1)), float(m.group(2))
+        m = re.search(r'([\d.]+) ?%', line)
+        if m is not None:
+            return None, float(m.group(1))
+    return None, None
 
-if __name__ == '__main__':
 
-    description = "spartacus, deploy vm on proxmox cluster"
-    parser = argparse.ArgumentParser(description=description)
-
-    parser.add_argument('-s', '--settings', default='settings',
-                        help='custom settings file in settings package')
-    parser.add_argument('-i', '--inventory', default=None,
-                        help='yaml file path to read', required=True)
-    parser.add_argument('-n', '--no-rawinit', dest='init',
-                        action='store_false',
-                        help='disables rawinit component (default enabled)')
-    parser.set_defaults(init=True)
-    parser.add_argument('-r', '--readonly', dest='readonly',
-                        action='store_true',
-                        help='readonly mode for debug (default disabled)')
-    parser.set_defaults(readonly=False)
-    parser.add_argument('-p', '--paused', dest='paused',
-                        action='store_true',
-                        help='disables vm boot when ready (default enabled)')
-    parser.set_defaults(paused=False)
-    parser.add_argument('-l', '--log-level', default=LOG_LEVELS[1],
-                        help='log level (default info)', choices=LOG_LEVELS)
+def wait_task(connessione, upid, wait):
+    """ wait the end of a proxmox task polling its status with an
+    increasing interval, log its progress and exit on failure or when the
+    timeout is reached: a poll answered by an error is retried """
+    node = upid.split(':')[1]
+    started = time.time()
+    deadline = started + wait['TIMEOUT']
+    interval = wait['POLL_MIN']
+    log_start = 0
+    last_done, last_time = 0, started
+
+    while True:
+        response = connessione.getNodeTaskStatusByUPID(node, upid)
+        if response is None or response['status']['code'] != 200:
+            logger.warning('task %s status not read, retrying: %s'
+                           % (upid, response and
+                              response['status']['reason']))
+            status = {}
+        else:
+            status = response['data']
+        if status.get('status') == 'stopped':
+            if status.get('exitstatus') != 'OK':
+                logger.error('task %s failed: %s' % (upid,
+                                                     status.get('exitstatus')))
+                sys.exit('exiting')
+            logger.info('task completed in %.1fs' % (time.time() - started))
+            return status
+
+        # only the log lines written since the last poll
+        log = connessione.connect('get', 'nodes/%s/tasks/%s/log?start=%s'
+                                  % (node, upid, log_start), None)
+        if log is not None and log['status']['code'] == 200:
+            lines = [line['t'] for line in log['data']]
+            log_start += len(lines)
+            done, percent = task_progress(lines)
+            if percent is not None:
+                now = time.time()
+                if done is not None and now > last_time:
+                    rate = (done - last_done) / (now - last_time) / 1048576
+                    logger.info('clone progress %.1f%%, %.1f MiB/s'
+                                % (percent, rate))
+                    last_done, last_time = done, now
+                else:
+                    logger.info('clone progress %.1f%%' % percent)
 
-    # parse cli options
-    options = {}
-    cli_options = parser.parse_args()
-    log_init(cli_options.log_level)
-    logger.debug(cli_options)
+        if time.time() + interval > deadline:
+            logger.error('task %s not completed in %ss' % (upid,
+                                                           wait['TIMEOUT']))
+            sys.exit('exiting')
+        logger.debug('waiting %.1f seconds' % interval)
+        time.sleep(interval)
+        interval = min(interval * 1.5, wait['POLL_MAX'])
 
-    # load settings from setting package
-    global cfg
-    cfg = settings_load(cli_options.settings)
-    logger.debug(cfg)
 
-    # load desired config from yaml
-    yaml_schema = YamlSchema(cfg['VM_DEFAULTS'], cfg['VM_RESOURCES'])
-    parsed_options = yaml_schema.parse(cli_options.inventory)
-    logger.debug(parsed_options)
-    logger.debug(parsed_options['template'])
+def options_prepare(parsed_options, cli_options):
+    """ complete the parsed hostbook with the cli run options """
     options = parsed_options
-    # fix rawinit
-    init = cli_options.init
     # fix puppet
     options['puppet'] = {}
     options['puppet']['puppetmaster'] = options['puppetmaster']
     options['puppet']['env'] = options['env']
     # fix readonly
     options['readonly'] = cli_options.readonly
-    readonly = options['readonly']
-    # fix paused
-    paused = cli_options.paused
+    # fix linked clone
+    if cli_options.linked:
+        options['clone'] = 'linked'
+    # fix nocloud customization
+    if cli_options.nocloud:
+        options['customize'] = 'nocloud'
     logger.debug(options)
-
-    # authentication on proxmox
-    logger.info('connecting to %s' % cfg['PROXMOX']['HOST'])
-    auth = prox_auth(cfg['PROXMOX']['HOST'], cfg['PROXMOX']['USER'],
-                     cfg['PROXMOX']['PASSWORD'])
-    proxmox_api = pyproxmox(auth)
-
-    logger.debug('Proxmox version: %s' % get_proxmox_version(proxmox_api))
+    return options
+
+
+def delete_seed(proxmox_api, node, volume):
+    """ delete a nocloud seed from the node iso storage, exit on error: a
+    missing seed is not one """
+    storage = volume.split(':')[0]
+    response = proxmox_api.deleteStorageContent(node, storage, volume)
+    if response['status']['code'] != 404:
+        check_proxmox_response(response)
+        logger.info('nocloud seed %s deleted' % volume)
+
+
+def attach_seed(proxmox_api, node, vmid, options, readonly, log_level,
+                keep=None):
+    """ build the nocloud seed image of the vm, upload it to the node iso
+    storage in a single request and attach it as cdrom, return the
+    rendered configurations """
+    nocloud = cfg['NOCLOUD']
+    # a new instance id for every deploy, cloud-init runs again on a
+    # reused vmid
+    instance_id = '%s-%s' % (vmid, int(time.time()))
+    seed, rendered = rawinit.nocloud_seed(cfg, options, instance_id,
+                                          readonly, log_level, keep)
+    filename = 'seed-%s.iso' % vmid
+    volume = '%s:iso/%s' % (nocloud['STORAGE'], filename)
+    if readonly:
+        return rendered
+    # a seed of a previous vm with the same id is replaced
+    delete_seed(proxmox_api, node, volume)
+    check_proxmox_response(proxmox_api.uploadStorageContent(
+                           node, nocloud['STORAGE'], 'iso', filename, seed))
+    try:
+        check_proxmox_response(proxmox_api.setVirtualMachineOptions(
+                               node, vmid, [(nocloud['DRIVE'],
+                                             '%s,media=cdrom' % volume)]))
+    except SystemExit:
+        # a seed not attached is never used nor replaced
+        delete_seed(proxmox_api, node, volume)
+        raise
+    logger.info('nocloud seed %s attached as %s' % (volume, nocloud['DRIVE']))
+    return rendered
+
+
+def vmid_reservations():
+    """ vm id reservations shared by the deployments of the process """
+    global reservations
+    with reservations_lock:
+        if reservations is None:
+            reservations = VmidReservations('%s/vmids.json' % cfg['TMP_DIR'],
+                                            cfg['VMID_TTL'])
+        return reservations
+
+
+def storage_reservations():
+    """ storage space reservations shared by the deployments of the
+    process """
+    global storages
+    with reservations_lock:
+        if storages is None:
+            storages = StorageReservations()
+        return storages
+
+
+def deploy(proxmox_api, cluster, options, init=True, readonly=False,
+           paused=False, log_level=LOG_LEVELS[1], keep=None):
+    """ deploy a single vm described by an hostbook, return a summary
+    of the deployed vm, the full plan of the vm on readonly runs: the
+    rendered configurations written to TMP_DIR too if keep (by default on
+    readonly runs or with KEEP_RENDERED) """
 
     # looking for template / src vm to clone
     vm_name = options['template']
     name = options['name']
+    tracer.vm_context(name)
     description = options['description']
     logger.info('looking for the template %s' % vm_name)
     if vm_name not in cfg['OS_DEFAULTS']:
-        tid, node = findTemplate(proxmox_api, vm_name)
+        with span('template', name):
+            tid, node = findTemplate(cluster, vm_name)
     else:
         tid = cfg['OS_DEFAULTS'][vm_name]['TEMPLATEID']
         node = cfg['OS_DEFAULTS'][vm_name]['TEMPLATENODE']
     logger.info('template %s, tid %s found'
                 % (options['template'], tid))
 
-    # template found, maybe
-    if (tid is not None):
-        # looking for next availabe vmid
-        if 'auto' in options['vmid']:
-            newid = check_proxmox_response(proxmox_api.getClusterVmNextId()
-                                           )['data']
-        else:
-            newid = options['vmid']
-        logger.info('VmNextId: %s found' % newid)
+    # template not found
+    if tid is None:
+        logger.error('unable to found template %s' % (vm_name))
+        sys.exit(2)
 
-        # select node
-        if 'node' in options and not options['node'] == 'auto':
-            # manual select
-            target_node = options['node']
+    # select node
+    if options.get('node', 'auto') is None:
+        # left out by the placement of the batch
+        logger.error("no host with available resources found")
+        sys.exit('exiting')
+    elif not options.get('node', 'auto') == 'auto':
+        # manual select
+        target_node = options['node']
+    else:
+        # auto select best matching vm requirements
+        with span('placement', name):
+            target_node = getAvailableNode(cluster, options)
+    logger.info('available node: %s found' % target_node)
+    # space of the clone and of the extra disks, reserved on the storage
+    # until allocated: a linked clone overlay starts empty
+    with span('storage', name):
+        size = sum(disk_bytes(disk['size'])
+                   for disk in options.get('disks', []))
+        if options['clone'] != 'linked':
+            size += config_bytes(cluster.vm_config(node, tid))
+        storage, token = getNFSVolume(cluster, options['name'], size)
+    logger.info('storage: %s found' % storage)
+
+    try:
+        # next available vmid, reserved only from here to the end of the
+        # clone, so that a deploy failing earlier leaves no reservation
+        vmid = None if 'auto' in options['vmid'] else options['vmid']
+        if readonly:
+            newid = vmid or check_proxmox_response(
+                proxmox_api.getClusterVmNextId())['data']
         else:
-            # auto select best matching vm requirements
-            target_node = getAvailableNode(proxmox_api, options['memory'])
-        logger.info('available node: %s found' % target_node)
-        storage = getNFSVolume(proxmox_api, options['name'])
-        logger.info('storage: %s found' % storage)
-
-        # clone
-        install = [('newid', newid), ('name', name), ('full', 1),
-                   ('format', 'raw'), ('storage', storage),
-                   ('target', target_node), ('description', description)]
-        logger.info('installing the vm %s (id %s)' % (name, newid))
-        logger.info('cloning template %s (id %s) on node %s' %
-                    (vm_name, tid, target_node))
-        logger.info('using storage %s' % storage)
-        if not readonly:
-            check_proxmox_response(proxmox_api.cloneVirtualMachine(node, tid,
-                                                                   install))
-        logger.info('starting the clone')
+            newid = vmid_reservations().reserve(proxmox_api, name, vmid)
+        logger.info('VmNextId: %s found' % newid)
 
-        if not readonly:
-            while True:
-                vstatus = proxmox_api.getVirtualStatus(target_node, newid)
-                if vstatus['status']['code'] == 200 \
-                   and vstatus['data']['name'] == name:
-                    break
-                logger.info('waiting 5 seconds')
-                time.sleep(5)
+        try:
+            # clone
+            if options['clone'] == 'linked':
+                # linked clone: a qcow2 overlay of the template disk, on
+                # the template storage, extra disks still go on the
+                # selected storage
+                image_storage, template_format = templateDisk(cluster, node,
+                                                              tid)
+                image_format = 'qcow2' if template_format == 'raw' \
+                    else template_format
+                install = [('newid', newid), ('name', name), ('full', 0),
+                           ('target', target_node),
+                           ('description', description)]
+            else:
+                image_storage, image_format = storage, 'raw'
+                install = [('newid', newid), ('name', name), ('full', 1),
+                           ('format', 'raw'), ('storage', storage),
+                           ('target', target_node),
+                           ('description', description)]
+            logger.info('installing the vm %s (id %s)' % (name, newid))
+            logger.info('%s cloning template %s (id %s) on node %s' %
+                        (options['clone'], vm_name, tid, target_node))
+            logger.info('using storage %s' % image_storage)
+            if not readonly:
+                with span('clone', name):
+                    upid = check_proxmox_response(
+                        proxmox_api.cloneVirtualMachine(node, tid,
+                                                        install))['data']
+                logger.info('starting the clone')
+                with span('clone_wait', name):
+                    wait_task(proxmox_api, upid, cfg['CLONE_WAIT'])
+        finally:
+            # the vm exists now (or the clone failed), its id is not free
+            if not readonly:
+                vmid_reservations().release(newid)
 
         logger.info('clone end')
 
         # customize new vm settings
         mod_conf = []
+        interfaces = []
         for i, interface in enumerate(options['interfaces']):
             if (interface['vlan'] is not None):
-                net_str = 'virtio=%s,bridge=vmbr%s' % (MACprettyprint(
-                                                       randomMAC()),
+                mac = MACprettyprint(randomMAC())
+                net_str = 'virtio=%s,bridge=vmbr%s' % (mac,
                                                        interface['vlan'])
                 mod_conf.append(('net%s' % i, net_str))
                 logger.debug(mod_conf)
+                interfaces.append({'net': 'net%s' % i, 'mac': mac,
+                                   'vlan': interface['vlan'],
+                                   'ipaddress': interface.get('ipaddress'),
+                                   'netmask': interface.get('netmask'),
+                                   'gateway': interface.get('gateway')})
 
         if 'disks' in options:
             for i, disk in enumerate(options['disks']):
@@ -322,32 +491,264 @@ if __name__ == '__main__':
         logger.debug(mod_conf)
 
         if not readonly:
-            check_proxmox_response(proxmox_api.setVirtualMachineOptions
-                                   (target_node, newid, mod_conf))
+            with span('options', name):
+                check_proxmox_response(proxmox_api.setVirtualMachineOptions
+                                       (target_node, newid, mod_conf))
         logger.info('options settings')
+    finally:
+        # a readonly run keeps the space reserved, as if allocated, so that
+        # the next choices of the run see it
+        if not readonly:
+            releaseVolume(cluster, token)
 
-        if get_proxmox_version(proxmox_api) >= 5.4:
-            newimage = 'vm-%s-disk-0.raw' % newid
-        else:
-            newimage = 'vm-%s-disk-1.raw' % newid
-        src = '%s/%s/images/%s/%s' % (cfg['IMAGES_BASEPATH'], storage, newid,
-                                      newimage)
-        logger.debug(src)
-        dst = '%s/%s' % (cfg['WORKING_MNT'], newid)
-        logger.debug(dst)
-        logger.debug(proxmox_api.getVirtualConfig(target_node, newid))
-
-        # customize new vm os settings by rawinit
-        if init:
-            rawinit.rawinit(cfg, options, src, dst, readonly=readonly,
-                            log_level=cli_options.log_level)
-
-        # finally start the new vm if desired
-        if not readonly and not paused:
+    if cluster.version() >= 5.4:
+        newimage = 'vm-%s-disk-0.%s' % (newid, image_format)
+    else:
+        newimage = 'vm-%s-disk-1.%s' % (newid, image_format)
+    src = '%s/%s/images/%s/%s' % (cfg['IMAGES_BASEPATH'], image_storage,
+                                  newid, newimage)
+    logger.debug(src)
+    dst = '%s/%s' % (cfg['WORKING_MNT'], newid)
+    logger.debug(dst)
+    logger.debug(proxmox_api.getVirtualConfig(target_node, newid))
+
+    # customize new vm os settings by a nocloud seed attached to the vm or
+    # by rawinit, on a free nbd device of the pool and its own mountpoint
+    rendered = {}
+    if init and options['customize'] == 'nocloud':
+        rendered = attach_seed(proxmox_api, target_node, newid, options,
+                               readonly, log_level, keep)
+    elif init:
+        rendered = rawinit.rawinit(cfg, options, src, dst, fmt=image_format,
+                                   readonly=readonly, log_level=log_level,
+                                   keep=keep)
+
+    # finally start the new vm if desired
+    if not readonly and not paused:
+        with span('start', name):
             check_proxmox_response(proxmox_api.startVirtualMachine(
                                    target_node, newid))
-            logger.info('starting the vm %s (id %s) on node %s' %
-                        (name, newid, target_node))
+        logger.info('starting the vm %s (id %s) on node %s' %
+                    (name, newid, target_node))
+
+    summary = {'vmid': newid, 'node': target_node, 'storage': image_storage,
+               'config': dict(mod_conf)}
+    if readonly:
+        # the full plan of the vm
+        summary.update({'template': vm_name, 'tid': tid,
+                        'clone': options['clone'], 'interfaces': interfaces,
+                        'rendered': rendered})
+    return summary
+
+
+def deploy_job(proxmox_api, cluster, options, init, readonly, paused,
+               log_level, keep=None):
+    """ batch worker, deploy a vm and never raise, return its status """
+    name = options['name']
+    result = {'name': name, 'vmid': options['vmid'], 'node': options['node'],
+              'storage': None, 'status': 'ok', 'error': None}
+    started = time.time()
+    logger.info('[%s] deploy started' % name)
+    try:
+        with span('total', name):
+            result.update(deploy(proxmox_api, cluster, options, init=init,
+                                 readonly=readonly, paused=paused,
+                                 log_level=log_level, keep=keep))
+    except SystemExit as ex:
+        # the deploy steps exit on error
+        if ex.code not in (0, None):
+            result['status'] = 'failed'
+            result['error'] = str(ex.code)
+    except Exception as ex:
+        logger.exception('[%s] unexpected error' % name)
+        result['status'] = 'failed'
+        result['error'] = str(ex)
+    result['elapsed'] = time.time() - started
+    if result['status'] == 'ok':
+        logger.info('[%s] deploy completed in %.1fs (id %s, node %s)'
+                    % (name, result['elapsed'], result['vmid'],
+                       result['node']))
     else:
-        logger.error('unable to found template %s' % (vm_name))
-        sys.exit(2)
+        logger.error('[%s] deploy failed in %.1fs: %s'
+                     % (name, result['elapsed'], result['error']))
+    return result
+
+
+def batch_deploy(proxmox_api, cluster, hostbooks, workers, init=True,
+                 readonly=False, paused=False, log_level=LOG_LEVELS[1]):
+    """ deploy many vms by a bounded pool of workers, return the status
+    of every deployment in hostbook order """
+    names = [options['name'] for options in hostbooks]
+    duplicates = set([n for n in names if names.count(n) > 1])
+    if duplicates:
+        logger.error('duplicated vm names in batch: %s'
+                     % ','.join(sorted(duplicates)))
+        sys.exit('exiting')
+
+    logger.info('batch deploy of %s vms with %s workers' % (len(hostbooks),
+                                                            workers))
+    # hosts chosen for the whole batch before the first clone, the nodes
+    # do not show the load of the vms still cloning
+    with span('placement'):
+        placementPlan(cluster, hostbooks)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(deploy_job, proxmox_api, cluster, options,
+                                init, readonly, paused, log_level)
+                for options in hostbooks]
+        results = [job.result() for job in jobs]
+    return results
+
+
+def batch_summary(results, elapsed):
+    """ log the final summary of a batch deploy """
+    logger.info('batch summary:')
+    for r in results:
+        line = '%-24s %-7s id %-6s node %-8s storage %-8s %6.1fs' % (
+               r['name'], r['status'], r['vmid'], r['node'], r['storage'],
+               r['elapsed'])
+        if r['status'] == 'ok':
+            logger.info(line)
+        else:
+            logger.error('%s %s' % (line, r['error']))
+    failed = len([r for r in results if r['status'] != 'ok'])
+    logger.info('%s deployed, %s failed, total time %.1fs'
+                % (len(results) - failed, failed, elapsed))
+    return failed
+
+
+if __name__ == '__main__':
+
+    description = "spartacus, deploy vm on proxmox cluster"
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-s', '--settings', default='settings',
+                        help='custom settings file in settings package')
+    parser.add_argument('-i', '--inventory', default=None,
+                        help='yaml file (also multi-document) or directory '
+                        'of yaml files to read', required=True)
+    parser.add_argument('-w', '--workers', default=4, type=int,
+                        help='concurrent deployments in batch mode '
+                        '(default 4)')
+    parser.add_argument('-n', '--no-rawinit', dest='init',
+                        action='store_false',
+                        help='disables rawinit component (default enabled)')
+    parser.set_defaults(init=True)
+    parser.add_argument('-r', '--readonly', dest='readonly',
+                        action='store_true',
+                        help='readonly mode for debug (default disabled)')
+    parser.set_defaults(readonly=False)
+    parser.add_argument('-k', '--linked', dest='linked',
+                        action='store_true',
+                        help='linked clone of the template for all the '
+                        'hostbooks (default by hostbook, full)')
+    parser.set_defaults(linked=False)
+    parser.add_argument('-c', '--nocloud', dest='nocloud',
+                        action='store_true',
+                        help='customize all the hostbooks by a nocloud seed '
+                        'image instead of rawinit (default disabled)')
+    parser.set_defaults(nocloud=False)
+    parser.add_argument('-p', '--paused', dest='paused',
+                        action='store_true',
+                        help='disables vm boot when ready (default enabled)')
+    parser.set_defaults(paused=False)
+    trace_group = parser.add_mutually_exclusive_group()
+    trace_group.add_argument('-t', '--trace', default=None,
+                             help='record the api requests and the ssh '
+                             'commands of the run with their timings in a '
+                             'trace file')
+    trace_group.add_argument('--replay', default=None,
+                             help='answer the api requests and the ssh '
+                             'commands from a recorded trace file, the '
+                             'cluster is never contacted')
+    parser.add_argument('--replay-speed', default=0.0, type=float,
+                        help='replay speed, 1 as recorded, 2 twice as fast '
+                        '(default 0, no waits)')
+    parser.add_argument('-l', '--log-level', default=LOG_LEVELS[1],
+                        help='log level (default info)', choices=LOG_LEVELS)
+
+    # parse cli options
+    cli_options = parser.parse_args()
+    log_init(cli_options.log_level)
+    logger.debug(cli_options)
+
+    # load settings from setting package
+    global cfg
+    cfg = settings_load(cli_options.settings)
+    logger.debug(cfg)
+
+    # timing spans of the deploy phases, no cost when disabled
+    if cfg['METRICS']['SPANS'] or cfg['METRICS']['TEXTFILE']:
+        metrics_sink(cfg['METRICS']['SPANS'], cfg['METRICS']['TEXTFILE'],
+                     cfg['PROXMOX']['HOST'])
+
+    # fill the ssh host key pool in background while cloning
+    if cli_options.init and not cli_options.readonly:
+        key_pool(cfg['SSH_HOST_KEYS']['TYPES'], cfg['SSH_HOST_KEYS']['POOL'])
+
+    # load desired configs from yaml, one or more hostbooks
+    hostbook_cache = None
+    if cfg['HOSTBOOK_CACHE']:
+        hostbook_cache = '%s/hostbooks.json' % cfg['TMP_DIR']
+    yaml_schema = YamlSchema(cfg['VM_DEFAULTS'], cfg['VM_RESOURCES'],
+                             cache=hostbook_cache)
+    hostbooks = [options_prepare(parsed_options, cli_options)
+                 for parsed_options
+                 in yaml_schema.parse_all(cli_options.inventory)]
+
+    # api requests and ssh commands traced or answered from a trace
+    if cli_options.trace is not None:
+        tracer.trace_start(cli_options.trace, cfg['PROXMOX']['HOST'])
+    if cli_options.replay is not None:
+        tracer.replay_start(cli_options.replay, cli_options.replay_speed)
+
+    # authentication on proxmox
+    auth = None
+    if cli_options.replay is None:
+        logger.info('connecting to %s' % cfg['PROXMOX']['HOST'])
+        ticket_cache = None
+        if cfg['API_POOL']['TICKET_CACHE']:
+            ticket_cache = '%s/.proxmox_ticket.json' % cfg['TMP_DIR']
+        with span('auth'):
+            auth = PooledAuth(cfg['PROXMOX']['HOST'],
+                              cfg['PROXMOX']['USER'],
+                              cfg['PROXMOX']['PASSWORD'],
+                              port=cfg['PROXMOX'].get('PORT', 8006),
+                              pool_size=cfg['API_POOL']['SIZE'],
+                              timeout=cfg['API_POOL']['TIMEOUT'],
+                              ticket_cache=ticket_cache)
+    # a single keep-alive client shared by all the deployments of the run
+    proxmox_api = tracer.proxmox_api(auth)
+
+    # cluster state shared by all the deployments of the run
+    cluster = ClusterSnapshot(proxmox_api, ttl=cfg['CLUSTER_TTL'],
+                              timeout=cfg['NODE_STATUS_TIMEOUT'])
+    with span('version'):
+        logger.debug('Proxmox version: %s' % cluster.version())
+
+    # auto interface addresses leased from the vlan subnets, the leases of
+    # the vms gone from the cluster released
+    if uses_auto(hostbooks):
+        seeds = inventory_addresses(cfg['IPAM']['HOSTBOOKS'])
+        if cfg['IPAM']['SEED_CLUSTER']:
+            seeds.update(cluster_addresses(cluster))
+        ipam = Ipam(cfg['VLAN_SUBNETS'], '%s/ipam.json' % cfg['TMP_DIR'],
+                    cfg['IPAM'].get('LEASE_GRACE', 3600))
+        deployed = set(vm['name'] for vm in cluster.vms() if 'name' in vm)
+        ipam.assign(hostbooks, seeds, save=not cli_options.readonly,
+                    deployed=deployed)
+
+    if len(hostbooks) == 1:
+        with span('total', hostbooks[0]['name']):
+            deploy(proxmox_api, cluster, hostbooks[0],
+                   init=cli_options.init, readonly=cli_options.readonly,
+                   paused=cli_options.paused,
+                   log_level=cli_options.log_level)
+    else:
+        started = time.time()
+        results = batch_deploy(proxmox_api, cluster, hostbooks,
+                               cli_options.workers, init=cli_options.init,
+                               readonly=cli_options.readonly,
+                               paused=cli_options.paused,
+                               log_level=cli_options.log_level)
+        if batch_summary(results, time.time() - started) > 0:
+            sys.exit(1)
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+
+import itertools
+import logging
+import re
+import threading
+
+logger = logging.getLogger('storage')
+
+SIZE_SUFFIX = {'': 1024**3, 'K': 1024, 'M': 1024**2, 'G': 1024**3,
+               'T': 1024**4}
+DISK_KEY = r'(virtio|scsi|sata|ide)(\d+)$'
+
+
+def disk_bytes(size):
+    """ bytes of a proxmox disk size, 10G, 512M or a plain number of GiB
+    as in the new disks of a vm config """
+    m = re.match(r'(\d+(?:\.\d+)?)([KMGT]?)$', str(size).strip())
+    if m is None:
+        logger.warning('unknown disk size %s, counted as 0' % size)
+        return 0
+    return int(float(m.group(1)) * SIZE_SUFFIX[m.group(2)])
+
+
+def is_disk(config, key):
+    """ the key of a vm config is a disk, not a cdrom drive """
+    return re.match(DISK_KEY, key) is not None and key in config and \
+        'media=cdrom' not in config[key]
+
+
+def boot_disk(config):
+    """ key of the boot disk in a vm config: the first disk of the boot
+    order, the legacy bootdisk, or the first disk by bus and number; None
+    if the config has no disk """
+    for option in config.get('boot', '').split(','):
+        if option.startswith('order='):
+            for key in option[6:].split(';'):
+                if is_disk(config, key):
+                    return key
+    if is_disk(config, config.get('bootdisk', '')):
+        return config['bootdisk']
+    disks = sorted((m.group(1), int(m.group(2)))
+                   for m in (re.match(DISK_KEY, k) for k in config)
+                   if m is not None and is_disk(config, m.group()))
+    return '%s%s' % disks[0] if disks else None
+
+
+def config_bytes(config):
+    """ bytes of the boot disk of a vm config, from its size option """
+    disk = boot_disk(config)
+    if disk is None:
+        return 0
+    for option in config[disk].split(',')[1:]:
+        if option.startswith('size='):
+            return disk_bytes(option[5:])
+    logger.warning('no size of the disk %s, counted as 0' % disk)
+    return 0
+
+
+def write_rate(rrd):
+    """ bytes written per second on a storage in the rrd samples, the
+    growth of the used space: the writes of the clones running now, by
+    this run or by others """
+    samples = [s for s in rrd if s.get('used') is not None and 'time' in s]
+    if len(samples) < 2:
+        return 0
+    first, last = samples[0], samples[-1]
+    if last['time'] <= first['time']:
+        return 0
+    return max(0, (float(last['used']) - float(first['used'])) /
+               (last['time'] - first['time']))
+
+
+class StorageReservations:
+    """ space of the pending deployments on the storage volumes: the choice
+    of a volume reserves the clone and disks size until released, so that
+    the concurrent deployments of a run count each other against the
+    available space instead of landing on the same volume """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.tokens = itertools.count(1)
+
+    def reserved(self, volume):
+        """ bytes reserved on a volume """
+        return sum(size for v, size in self.pending.values() if v == volume)
+
+    def reserve(self, avails, size, thres, rates=None, horizon=0):
+        """ choose the volume with the most space left once the reserved
+        bytes, the size and, with rates, the bytes written in the next
+        horizon seconds are subtracted: return the volume and the token
+        of its reservation, None and None if no volume has more than thres
+        bytes available besides the reserved ones """
+        rates = rates or {}
+        with self.lock:
+            lefts = {}
+            for volume, avail in avails.items():
+                free = avail - self.reserved(volume)
+                if free <= thres:
+                    logger.debug('available space %s is under the minimum '
+                                 'allowed (%s) on %s' % (free, thres, volume))
+                    continue
+                lefts[volume] = free - size - rates.get(volume, 0) * horizon
+            if not lefts:
+                return None, None
+            volume = max(sorted(lefts), key=lambda v: lefts[v])
+            token = next(self.tokens)
+            self.pending[token] = (volume, size)
+            logger.debug('%s bytes reserved on %s (%s left)'
+                         % (size, volume, lefts[volume]))
+            return volume, token
+
+    def release(self, token):
+        """ drop a reservation, its space is allocated or never will """
+        with self.lock:
+            self.pending.pop(token, None)
@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+
+from ipam import Ipam
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+SUBNETS = {'116': {'NETWORK': '172.20.16.0/24', 'GATEWAY': '172.20.16.1',
+                   'RANGE': ('172.20.16.100', '172.20.16.103')}}
+
+
+def hostbook(name, *addresses):
+    """ a hostbook with an interface on vlan 116 for every address """
+    interfaces = []
+    for address in addresses:
+        interface = {'vlan': '116', 'ipaddress': address}
+        if address != 'auto':
+            interface['netmask'] = '255.255.255.0'
+        interfaces.append(interface)
+    return {'name': name, 'interfaces': interfaces,
+            'hosts': [{'ipaddress': 'auto'}]}
+
+
+class IpamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'ipam.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def leases(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def test_auto(self):
+        hostbooks = [hostbook('vm01', 'auto'), hostbook('vm02', 'auto')]
+        Ipam(SUBNETS, self.path).assign(hostbooks)
+        vm01, vm02 = [h['interfaces'][0] for h in hostbooks]
+        self.assertEqual(vm01['ipaddress'], '172.20.16.100')
+        self.assertEqual(vm02['ipaddress'], '172.20.16.101')
+        self.assertEqual(vm01['netmask'], '255.255.255.0')
+        self.assertEqual(vm01['gateway'], '172.20.16.1')
+        self.assertEqual(hostbooks[0]['hosts'][0]['ipaddress'],
+                         '172.20.16.100')
+        self.assertEqual(sorted(self.leases()),
+                         ['172.20.16.100', '172.20.16.101'])
+
+    def test_same_name_same_address(self):
+        Ipam(SUBNETS, self.path).assign([hostbook('vm01', 'auto')])
+        Ipam(SUBNETS, self.path).assign([hostbook('vm02', 'auto')])
+        again = hostbook('vm01', 'auto')
+        Ipam(SUBNETS, self.path).assign([again])
+        self.assertEqual(again['interfaces'][0]['ipaddress'],
+                         '172.20.16.100')
+
+    def test_static_and_seeds_avoided(self):
+        hostbooks = [hostbook('vm01', '172.20.16.100'),
+                     hostbook('vm02', 'auto')]
+        Ipam(SUBNETS, self.path).assign(hostbooks,
+                                        seeds={'172.20.16.101': 'old'})
+        self.assertEqual(hostbooks[1]['interfaces'][0]['ipaddress'],
+                         '172.20.16.102')
+        # static addresses are never leased
+        self.assertEqual(list(self.leases()), ['172.20.16.102'])
+
+    def test_static_only(self):
+        hostbooks = [hostbook('vm01', '172.20.16.100')]
+        Ipam({}, self.path).assign(hostbooks)
+        hostbooks[0]['name'] = 'vm02'
+        Ipam({}, self.path).assign(hostbooks)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_no_subnet(self):
+        with self.assertRaises(SystemExit):
+            Ipam({}, self.path).assign([hostbook('vm01', 'auto')])
+
+    def test_range_full(self):
+        hostbooks = [hostbook('vm%02d' % i, 'auto') for i in range(5)]
+        with self.assertRaises(SystemExit):
+            Ipam(SUBNETS, self.path).assign(hostbooks)
+
+    def test_dry_run(self):
+        hostbooks = [hostbook('vm01', 'auto')]
+        Ipam(SUBNETS, self.path).assign(hostbooks, save=False)
+        self.assertEqual(hostbooks[0]['interfaces'][0]['ipaddress'],
+                         '172.20.16.100')
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_expire(self):
+        old = time.time() - 7200
+        leases = {'172.20.16.100': {'name': 'gone', 'vlan': '116',
+                                    'interface': 0, 'time': old},
+                  '172.20.16.101': {'name': 'running', 'vlan': '116',
+                                    'interface': 0, 'time': old},
+                  '172.20.16.102': {'name': 'cloning', 'vlan': '116',
+                                    'interface': 0, 'time': time.time()},
+                  '172.20.16.103': {'name': 'legacy', 'vlan': '116',
+                                    'interface': 0, 'time': time.time(),
+                                    'static': True}}
+        ipam = Ipam(SUBNETS, self.path, grace=3600)
+        ipam.expire(leases, set(['vm01']), deployed=set(['running']))
+        self.assertEqual(sorted(leases), ['172.20.16.101', '172.20.16.102'])
+
+    def test_expire_without_cluster(self):
+        leases = {'172.20.16.100': {'name': 'gone', 'vlan': '116',
+                                    'interface': 0, 'time': 0}}
+        Ipam(SUBNETS, self.path, grace=0).expire(leases, set())
+        self.assertEqual(list(leases), ['172.20.16.100'])
+
+    def test_assign_releases(self):
+        Ipam(SUBNETS, self.path).assign([hostbook('gone', 'auto')])
+        hostbooks = [hostbook('vm01', 'auto')]
+        Ipam(SUBNETS, self.path, grace=-1).assign(hostbooks,
+                                                  deployed=set())
+        self.assertEqual(hostbooks[0]['interfaces'][0]['ipaddress'],
+                         '172.20.16.100')
+        self.assertEqual([lease['name'] for lease in self.leases().values()],
+                         ['vm01'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+
+from partitions import SECTOR, TABLE_SECTORS, partition_offset
+import struct
+import unittest
+
+
+def mbr(entries):
+    """ disk start with an mbr of (type, first sector, sectors) entries """
+    data = bytearray(TABLE_SECTORS * SECTOR)
+    for i, (ptype, first, sectors) in enumerate(entries):
+        data[446 + 16 * i:462 + 16 * i] = struct.pack('<B3xB3xII', 0x80,
+                                                      ptype, first, sectors)
+    data[510:512] = b'\x55\xaa'
+    return data
+
+
+def gpt(entries, count=128, size=128):
+    """ disk start with a protective mbr and a gpt of (first lba, last lba)
+    entries """
+    data = mbr([(0xee, 1, 0xffffffff)])
+    header = b'EFI PART' + bytes(64) + struct.pack('<QII', 2, count, size)
+    data[SECTOR:SECTOR + len(header)] = header
+    for i, (first, last) in enumerate(entries):
+        start = 2 * SECTOR + i * size
+        data[start + 32:start + 48] = struct.pack('<QQ', first, last)
+    return bytes(data)
+
+
+class MbrTest(unittest.TestCase):
+
+    def test_primary(self):
+        data = mbr([(0x83, 2048, 4096), (0x82, 6144, 1024)])
+        self.assertEqual(partition_offset(data, '1'),
+                         (2048 * SECTOR, 4096 * SECTOR))
+        self.assertEqual(partition_offset(data, 2),
+                         (6144 * SECTOR, 1024 * SECTOR))
+
+    def test_missing(self):
+        data = mbr([(0x83, 2048, 4096)])
+        self.assertIsNone(partition_offset(data, 2))
+        self.assertIsNone(partition_offset(data, 5))
+
+    def test_extended(self):
+        data = mbr([(0x83, 2048, 4096), (0x05, 6144, 1024)])
+        self.assertIsNone(partition_offset(data, 2))
+
+    def test_no_signature(self):
+        data = mbr([(0x83, 2048, 4096)])
+        data[510:512] = b'\x00\x00'
+        self.assertIsNone(partition_offset(data, 1))
+        self.assertIsNone(partition_offset(b'', 1))
+
+
+class GptTest(unittest.TestCase):
+
+    def test_partition(self):
+        data = gpt([(2048, 4095), (4096, 8191)])
+        self.assertEqual(partition_offset(data, 1),
+                         (2048 * SECTOR, 2048 * SECTOR))
+        self.assertEqual(partition_offset(data, '2'),
+                         (4096 * SECTOR, 4096 * SECTOR))
+
+    def test_missing(self):
+        data = gpt([(2048, 4095)])
+        self.assertIsNone(partition_offset(data, 2))
+        self.assertIsNone(partition_offset(gpt([], count=4), 5))
+
+    def test_entries_out_of_data(self):
+        self.assertIsNone(partition_offset(gpt([(2048, 4095)]), 128))
+
+    def test_bad_header(self):
+        data = bytearray(gpt([(2048, 4095)]))
+        data[SECTOR:SECTOR + 8] = b'NOT PART'
+        self.assertIsNone(partition_offset(bytes(data), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+
+from storage import StorageReservations, boot_disk, config_bytes, disk_bytes
+import unittest
+
+GiB = 1024**3
+
+
+class DiskBytesTest(unittest.TestCase):
+
+    def test_suffixes(self):
+        self.assertEqual(disk_bytes('10G'), 10 * GiB)
+        self.assertEqual(disk_bytes('512M'), 512 * 1024**2)
+        self.assertEqual(disk_bytes('64K'), 64 * 1024)
+        self.assertEqual(disk_bytes('1.5T'), int(1.5 * 1024**4))
+
+    def test_plain_gib(self):
+        self.assertEqual(disk_bytes(32), 32 * GiB)
+        self.assertEqual(disk_bytes(' 8 '), 8 * GiB)
+
+    def test_unknown(self):
+        self.assertEqual(disk_bytes('big'), 0)
+        self.assertEqual(disk_bytes('10GB'), 0)
+
+
+class BootDiskTest(unittest.TestCase):
+
+    def test_boot_order(self):
+        config = {'scsi0': 'vol:1', 'virtio2': 'vol:2',
+                  'ide2': 'local:iso/x.iso,media=cdrom',
+                  'boot': 'order=ide2;virtio2;net0'}
+        self.assertEqual(boot_disk(config), 'virtio2')
+
+    def test_legacy_bootdisk(self):
+        config = {'scsi0': 'vol:1', 'virtio2': 'vol:2', 'boot': 'cdn',
+                  'bootdisk': 'virtio2'}
+        self.assertEqual(boot_disk(config), 'virtio2')
+
+    def test_numeric_order(self):
+        config = {'virtio10': 'vol:10', 'virtio2': 'vol:2'}
+        self.assertEqual(boot_disk(config), 'virtio2')
+
+    def test_missing_bootdisk(self):
+        config = {'bootdisk': 'scsi0', 'scsi1': 'vol:1'}
+        self.assertEqual(boot_disk(config), 'scsi1')
+
+    def test_no_disk(self):
+        config = {'ide2': 'local:iso/x.iso,media=cdrom',
+                  'boot': 'order=ide2;net0'}
+        self.assertIsNone(boot_disk(config))
+        self.assertEqual(config_bytes(config), 0)
+
+    def test_config_bytes(self):
+        config = {'boot': 'order=scsi0', 'scsi0': 'vol:vm-1-disk-0,size=20G'}
+        self.assertEqual(config_bytes(config), 20 * GiB)
+        self.assertEqual(config_bytes({'scsi0': 'vol:vm-1-disk-0'}), 0)
+
+
+class StorageReservationsTest(unittest.TestCase):
+
+    def test_most_space_left(self):
+        reservations = StorageReservations()
+        volume, token = reservations.reserve({'a': 500, 'b': 400}, 50, 100)
+        self.assertEqual(volume, 'a')
+        self.assertEqual(reservations.reserved('a'), 50)
+
+    def test_pending_counted(self):
+        reservations = StorageReservations()
+        avails = {'a': 500, 'b': 400}
+        volumes = [reservations.reserve(avails, 150, 100)[0]
+                   for i in range(3)]
+        self.assertEqual(volumes, ['a', 'b', 'a'])
+
+    def test_threshold(self):
+        reservations = StorageReservations()
+        avails = {'a': 150, 'b': 120}
+        # admitted while the space less the reserved one is above thres,
+        # the size of the clone is not counted against it
+        self.assertEqual(reservations.reserve(avails, 60, 100)[0], 'a')
+        self.assertEqual(reservations.reserve(avails, 60, 100)[0], 'b')
+        self.assertEqual(reservations.reserve(avails, 60, 100),
+                         (None, None))
+
+    def test_release(self):
+        reservations = StorageReservations()
+        volume, token = reservations.reserve({'a': 150}, 60, 100)
+        self.assertEqual(reservations.reserve({'a': 150}, 60, 100),
+                         (None, None))
+        reservations.release(token)
+        self.assertEqual(reservations.reserved('a'), 0)
+        self.assertEqual(reservations.reserve({'a': 150}, 60, 100)[0], 'a')
+
+    def test_write_rates(self):
+        reservations = StorageReservations()
+        volume, token = reservations.reserve({'a': 500, 'b': 400}, 50, 100,
+                                             rates={'a': 2}, horizon=100)
+        self.assertEqual(volume, 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+
+from vmids import VmidReservations
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class Cluster:
+    """ api stand-in answering nextid like proxmox: 400 to an id in use """
+
+    def __init__(self, used, error=None):
+        self.used = set(used)
+        self.error = error
+
+    def response(self, data, code=200):
+        return {'status': {'code': code, 'ok': code == 200, 'reason': ''},
+                'data': data}
+
+    def getClusterVmNextId(self):
+        vmid = 100
+        while vmid in self.used:
+            vmid += 1
+        return self.response(str(vmid))
+
+    def connect(self, conn_type, option, post_data):
+        vmid = int(option.split('=')[1])
+        if self.error is not None:
+            return self.response(None, self.error)
+        if vmid in self.used:
+            return self.response(None, 400)
+        return self.response(str(vmid))
+
+
+class VmidReservationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'vmids.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_next_free(self):
+        reservations = VmidReservations(self.path)
+        cluster = Cluster([100, 101])
+        self.assertEqual(reservations.reserve(cluster, 'vm01'), '102')
+        # the cluster still answers 102, reserved but not cloned yet
+        self.assertEqual(reservations.reserve(cluster, 'vm02'), '103')
+
+    def test_used_after_next(self):
+        reservations = VmidReservations(self.path)
+        cluster = Cluster([100, 102])
+        self.assertEqual(reservations.reserve(cluster, 'vm01'), '101')
+        self.assertEqual(reservations.reserve(cluster, 'vm02'), '103')
+
+    def test_shared_by_runs(self):
+        cluster = Cluster([])
+        VmidReservations(self.path).reserve(cluster, 'vm01')
+        self.assertEqual(VmidReservations(self.path).reserve(cluster,
+                                                             'vm02'), '101')
+
+    def test_release(self):
+        reservations = VmidReservations(self.path)
+        cluster = Cluster([])
+        vmid = reservations.reserve(cluster, 'vm01')
+        reservations.release(vmid)
+        self.assertEqual(reservations.reserve(cluster, 'vm02'), vmid)
+
+    def test_expired(self):
+        cluster = Cluster([])
+        VmidReservations(self.path, ttl=0).reserve(cluster, 'vm01')
+        self.assertEqual(VmidReservations(self.path, ttl=0).reserve(
+                         cluster, 'vm02'), '100')
+
+    def test_given(self):
+        reservations = VmidReservations(self.path)
+        cluster = Cluster([])
+        self.assertEqual(reservations.reserve(cluster, 'vm01', 200), '200')
+        # the same vm deployed again keeps its reservation
+        self.assertEqual(reservations.reserve(cluster, 'vm01', 200), '200')
+        with self.assertRaises(SystemExit):
+            reservations.reserve(cluster, 'vm02', 200)
+
+    def test_cluster_error(self):
+        reservations = VmidReservations(self.path)
+        with self.assertRaises(SystemExit):
+            reservations.reserve(Cluster([], error=500), 'vm01')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,474 @@
+#! /usr/bin/env python
+
+from proxmoxapi import PooledProxmox
+from pysshops import SshCommandBlockingException
+from remote import RemoteSteps
+import remote
+import argparse
+import atexit
+import coloredlogs
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
+OUTPUT_FORMATS = ['text', 'json']
+TRACE_VERSION = 1
+# the random marker of the RemoteSteps scripts, the same in every trace
+MARKER = re.compile(r'@@[0-9a-f]{32}')
+TRACE_MARKER = '@@marker'
+STEP = re.compile(r'\( (.*) \) 2>&1; rc=\$\?; echo$')
+STEP_CHECK = '[ $rc -eq 0 ] || exit 0'
+
+logger = logging.getLogger('tracer')
+
+recorder = None
+replayer = None
+# the vm deployed by the current thread, set by the deploy
+context = threading.local()
+
+
+def log_init(loglevel):
+    """ initialize the logging system """
+    FORMAT = '%(asctime)s %(levelname)s %(module)s %(message)s'
+    logging.basicConfig(format=FORMAT, level=getattr(logging,
+                                                     loglevel.upper()))
+    coloredlogs.install(level=loglevel.upper(), stream=sys.stdout)
+
+
+def vm_context(name):
+    """ the requests of the current thread are made for the vm name """
+    context.vm = name
+
+
+def script_steps(script):
+    """ the commands of a RemoteSteps script and if they are checked """
+    steps = []
+    for line in script.split('\n'):
+        m = STEP.match(line)
+        if m is not None:
+            steps.append((m.group(1), False))
+        elif line == STEP_CHECK and steps:
+            steps[-1] = (steps[-1][0], True)
+    return steps
+
+
+def step_events(event):
+    """ the results of the steps of a recorded RemoteSteps script, as
+    events answering the single steps """
+    steps = RemoteSteps('trace')
+    for command, check in script_steps(event['command']):
+        steps.add(command, check)
+    # pysshops joins the output lines with ' ,'
+    steps.parse(event['output'].replace('\n ,', '\n'), TRACE_MARKER)
+    run = [step for step in steps.steps if step['exitcode'] is not None]
+    return [{'kind': 'step', 'command': step['command'],
+             'exitcode': step['exitcode'], 'output': step['output'],
+             'seconds': event['seconds'] / len(run), 'vm': event.get('vm')}
+            for step in run]
+
+
+def post_fields(post_data, files=None):
+    """ the post data of a request as traced, files by their size """
+    if isinstance(post_data, dict):
+        fields = dict(post_data)
+    elif post_data is not None:
+        fields = [list(field) for field in post_data]
+    else:
+        fields = None
+    if files:
+        fields = {'fields': fields, 'files': dict(
+            (key, {'filename': value[0], 'bytes': len(value[1])})
+            for key, value in files.items())}
+    return fields
+
+
+class TraceRecorder:
+    """ the api requests and the ssh commands of a run, with their start
+    offset and seconds, appended as json lines as soon as they end. Login
+    credentials, tickets and streamed data (host keys) are never traced,
+    only the size of the streamed data """
+
+    def __init__(self, path, cluster=''):
+        self.path = path
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.events = 0
+        self.stream = open(path, 'w')
+        self.write({'trace': TRACE_VERSION, 'cluster': cluster,
+                    'started': self.started})
+
+    def write(self, event):
+        self.stream.write('%s\n' % json.dumps(event, sort_keys=True))
+        self.stream.flush()
+
+    def add(self, kind, started, event):
+        """ record an event of kind (api, ssh) started at started """
+        event = dict(event, kind=kind,
+                     at=round(started - self.started, 6),
+                     seconds=round(time.time() - started, 6),
+                     thread=threading.current_thread().name,
+                     vm=getattr(context, 'vm', None))
+        with self.lock:
+            self.events += 1
+            self.write(event)
+
+    def close(self):
+        with self.lock:
+            if not self.stream.closed:
+                self.stream.close()
+        logger.info('%s events traced in %s' % (self.events, self.path))
+
+
+class TracedProxmox(PooledProxmox):
+    """ pooled api client recording every request and its response """
+
+    def __init__(self, auth_class, recorder):
+        super(TracedProxmox, self).__init__(auth_class)
+        self.recorder = recorder
+
+    def connect(self, conn_type, option, post_data, files=None):
+        started = time.time()
+        response = super(TracedProxmox, self).connect(conn_type, option,
+                                                      post_data, files)
+        self.recorder.add('api', started, {
+            'method': conn_type, 'option': option,
+            'data': post_fields(post_data, files), 'response': response})
+        return response
+
+
+class TracedOps:
+    """ command execution recording the connection, every command and its
+    result; the other attributes are the ones of the wrapped ops """
+
+    def __init__(self, ops, recorder):
+        self.ops = ops
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.ops, name)
+
+    def __enter__(self):
+        started = time.time()
+        self.ops.__enter__()
+        self.recorder.add('ssh', started, {'call': 'connect',
+                                           'host': self.ops.hostname})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.ops.__exit__(exc_type, exc_value, traceback)
+
+    def traced(self, call, command, data, block):
+        started = time.time()
+        event = {'call': call, 'host': self.ops.hostname,
+                 'command': MARKER.sub(TRACE_MARKER, command),
+                 'bytes': len(data)}
+        try:
+            if call == 'stream_command':
+                exitcode, output = self.ops.stream_command(command, data,
+                                                           block)
+            else:
+                exitcode, output = self.ops.remote_command(command, block)
+        except SshCommandBlockingException as ex:
+            event['raised'] = str(ex)
+            self.recorder.add('ssh', started, event)
+            raise
+        event['exitcode'] = exitcode
+        event['output'] = MARKER.sub(TRACE_MARKER, output)
+        self.recorder.add('ssh', started, event)
+        return exitcode, output
+
+    def remote_command(self, command, block=True):
+        return self.traced('remote_command', command, b'', block)
+
+    def stream_command(self, command, data, block=True):
+        return self.traced('stream_command', command, data, block)
+
+
+class TraceReplay:
+    """ the events of a recorded trace answering the same requests. The
+    requests of a vm deploy get the answers recorded for that vm by route,
+    in order: the workers of a batch may take vm ids and volumes in another
+    order than in the recorded run. The other requests (and those a vm did
+    not record) get the answers of the same request, else of the route.
+    The answers of a request are given in order, the last one repeated
+    once used up (the task status polls of a longer wait). Each answer
+    comes after its recorded seconds divided by speed, at once with 0 """
+
+    def __init__(self, path, speed=0.0):
+        self.path = path
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.by_vm = {}
+        self.by_request = {}
+        self.by_route = {}
+        self.missed = 0
+        self.header = {}
+        events = 0
+        with open(path, 'r') as f:
+            for line in f:
+                event = json.loads(line)
+                if 'trace' in event:
+                    self.header = event
+                    continue
+                events += 1
+                self.index(event)
+                if event['kind'] == 'ssh' and 'output' in event and \
+                        TRACE_MARKER in event.get('command', ''):
+                    for step in step_events(event):
+                        self.index(step)
+        logger.info('replaying %s recorded requests from %s'
+                    % (events, path))
+
+    def index(self, event):
+        if event.get('vm') is not None:
+            self.by_vm.setdefault((event['vm'], route(event)),
+                                  []).append(event)
+        self.by_request.setdefault(self.key(event), []).append(event)
+        self.by_route.setdefault(route(event), []).append(event)
+
+    def key(self, event):
+        if event['kind'] == 'api':
+            return ('api', event['method'], event['option'])
+        if event['kind'] == 'step':
+            return ('step', event['command'])
+        return ('ssh', event['call'], event.get('command'))
+
+    def script(self, script):
+        """ the output of a RemoteSteps script answered step by step, the
+        steps of a phase may change between runs (a cached partition) """
+        lines = []
+        for i, (command, check) in enumerate(script_steps(script)):
+            event = self.answer({'kind': 'step', 'command': command})
+            if event is None:
+                exitcode, output = 255, '%s not in the trace' % command
+            else:
+                exitcode, output = event['exitcode'], event['output']
+            lines += ['%s begin %s' % (TRACE_MARKER, i), output,
+                      '%s end %s %s' % (TRACE_MARKER, i, exitcode)]
+            if check and exitcode != 0:
+                break
+        return '\n'.join(lines)
+
+    def answer(self, request):
+        """ the next recorded event answering request, None if the
+        request was never seen """
+        vm = getattr(context, 'vm', None)
+        with self.lock:
+            answers = self.by_vm.get((vm, route(request))) or \
+                self.by_request.get(self.key(request)) or \
+                self.by_route.get(route(request))
+            if not answers:
+                self.missed += 1
+                logger.warning('%s not in the trace' % route(request))
+                return None
+            event = answers.pop(0) if len(answers) > 1 else answers[0]
+        if self.speed > 0:
+            time.sleep(event['seconds'] / self.speed)
+        return event
+
+    def close(self):
+        if self.missed:
+            logger.warning('%s requests not in the trace %s'
+                           % (self.missed, self.path))
+
+
+class ReplayProxmox(PooledProxmox):
+    """ api client answering from a trace, no request leaves the process """
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.url = replay.header.get('cluster', '')
+
+    def connect(self, conn_type, option, post_data, files=None):
+        event = self.replay.answer({'kind': 'api', 'method': conn_type,
+                                    'option': option})
+        if event is None:
+            return {'status': {'code': 404, 'ok': False,
+                               'reason': '%s %s not in the trace'
+                               % (conn_type, option)},
+                    'data': None}
+        return event['response']
+
+
+class ReplayOps:
+    """ command execution answering from a trace with the interface of
+    StreamSshOps, the script markers of the trace replaced by the current
+    ones """
+
+    def __init__(self, hostname, replay):
+        self.hostname = hostname
+        self.replay = replay
+
+    def __enter__(self):
+        self.replay.answer({'kind': 'ssh', 'call': 'connect'})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def replayed(self, call, command, block):
+        markers = MARKER.findall(command)
+        if markers and script_steps(command):
+            output = self.replay.script(command)
+            return 0, output.replace(TRACE_MARKER, markers[0])
+        event = self.replay.answer({'kind': 'ssh', 'call': call,
+                                    'command': MARKER.sub(TRACE_MARKER,
+                                                          command)})
+        if event is None:
+            exitcode, output = 255, '%s not in the trace' % command
+        elif 'raised' in event:
+            raise SshCommandBlockingException(event['raised'])
+        else:
+            exitcode, output = event['exitcode'], event['output']
+        if markers:
+            output = output.replace(TRACE_MARKER, markers[0])
+        if exitcode != 0 and block:
+            raise SshCommandBlockingException(output)
+        return exitcode, output
+
+    def remote_command(self, command, block=True):
+        return self.replayed('remote_command', command, block)
+
+    def stream_command(self, command, data, block=True):
+        return self.replayed('stream_command', command, block)
+
+
+def trace_start(path, cluster=''):
+    """ record the api requests and ssh commands of the run to path """
+    global recorder
+    recorder = TraceRecorder(path, cluster)
+    atexit.register(recorder.close)
+    return recorder
+
+
+def replay_start(path, speed=0.0):
+    """ answer the api requests and ssh commands of the run from path """
+    global replayer
+    replayer = TraceReplay(path, speed)
+    atexit.register(replayer.close)
+    return replayer
+
+
+def proxmox_api(auth):
+    """ the api client of the run: from the trace when replaying (no auth
+    needed), else on auth and traced when recording """
+    if replayer is not None:
+        return ReplayProxmox(replayer)
+    if recorder is not None:
+        return TracedProxmox(auth, recorder)
+    return PooledProxmox(auth)
+
+
+def host_ops(hostname, username=None, local=True, port=22,
+             key_filename=None):
+    """ remote.host_ops, from the trace when replaying and traced when
+    recording """
+    if replayer is not None:
+        return ReplayOps(hostname, replayer)
+    ops = remote.host_ops(hostname, username, local, port=port,
+                          key_filename=key_filename)
+    if recorder is not None:
+        return TracedOps(ops, recorder)
+    return ops
+
+
+def route(event):
+    """ the request of an event with the ids left out """
+    if event['kind'] == 'api':
+        option = re.sub(r'UPID:[^/]+', '{upid}', event['option'])
+        option = re.sub(r'/\d+(?=/|$|\?)', '/{id}', option)
+        option = re.sub(r'nodes/[^/]+', 'nodes/{node}', option)
+        return 'api %s %s' % (event['method'], option.split('?')[0])
+    if event['kind'] == 'step':
+        return 'step %s' % command_route(event['command'])
+    if event['call'] == 'connect':
+        return 'ssh connect'
+    steps = script_steps(event['command'])
+    if steps:
+        return 'ssh %s' % ', '.join(command_route(command).split()[0]
+                                    for command, check in steps)
+    return 'ssh %s' % command_route(event['command'])
+
+
+def command_route(command):
+    """ the first words of a command, sudo and numbers left out """
+    words = command.split()
+    if words[:1] == ['sudo']:
+        words = words[1:]
+    return re.sub(r'\d+', 'N', ' '.join(words[:2]))
+
+
+def summary(path, top=10):
+    """ time by route and the slowest events of a trace """
+    events = []
+    header = {}
+    with open(path, 'r') as f:
+        for line in f:
+            event = json.loads(line)
+            if 'trace' in event:
+                header = event
+            else:
+                events.append(event)
+    routes = {}
+    for event in events:
+        r = routes.setdefault(route(event), {'count': 0, 'seconds': 0.0,
+                                             'max': 0.0})
+        r['count'] += 1
+        r['seconds'] += event['seconds']
+        r['max'] = max(r['max'], event['seconds'])
+    slowest = sorted(events, key=lambda e: -e['seconds'])[:top]
+    return {'cluster': header.get('cluster'), 'events': len(events),
+            'elapsed': max([e['at'] + e['seconds'] for e in events] or [0]),
+            'routes': routes,
+            'slowest': [dict(route=route(e), at=e['at'], seconds=e['seconds'],
+                             thread=e.get('thread')) for e in slowest]}
+
+
+def report_text(report):
+    lines = ['%s events on %s in %.2fs' % (report['events'],
+                                           report['cluster'],
+                                           report['elapsed']),
+             '%-48s %6s %9s %8s' % ('route', 'count', 'seconds', 'max')]
+    for name, r in sorted(report['routes'].items(),
+                          key=lambda item: -item[1]['seconds']):
+        lines.append('%-48s %6s %8.2fs %7.2fs' % (name[:48], r['count'],
+                                                  r['seconds'], r['max']))
+    lines.append('slowest:')
+    for e in report['slowest']:
+        lines.append('%8.2fs at %8.2fs %-20s %s'
+                     % (e['seconds'], e['at'], e['thread'], e['route']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    description = 'tracer, time by request of a recorded deploy trace'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-f', '--trace', required=True,
+                        help='trace file recorded by spartacus -t/--trace')
+    parser.add_argument('-t', '--top', default=10, type=int,
+                        help='slowest requests shown (default 10)')
+    parser.add_argument('-o', '--output', default=OUTPUT_FORMATS[0],
+                        choices=OUTPUT_FORMATS,
+                        help='report format (default text)')
+    parser.add_argument('-l', '--log-level', default=LOG_LEVELS[1],
+                        help='log level (default info)', choices=LOG_LEVELS)
+
+    cli_options = parser.parse_args()
+    log_init(cli_options.log_level)
+    logger.debug(cli_options)
+
+    try:
+        report = summary(cli_options.trace, cli_options.top)
+    except (IOError, ValueError) as ex:
+        logger.error('trace loading error: %s' % ex)
+        sys.exit('exiting')
+    if cli_options.output == 'json':
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(report_text(report))
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+
+from yamlschema import YamlSchema, HostbookCache
+from multiprocessing import Pool
+import argparse
+import coloredlogs
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+SETTINGS_KEY = ['VM_DEFAULTS', 'VM_RESOURCES', 'TMP_DIR']
+SETTINGS_OPTIONAL = {'HOSTBOOK_CACHE': True}
+LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
+OUTPUT_FORMATS = ['text', 'json']
+
+logger = logging.getLogger('validate')
+
+# the schema of a worker process, built once by the pool initializer
+schema = None
+
+
+def log_init(loglevel):
+    """ initialize the logging system """
+    FORMAT = '%(asctime)s %(levelname)s %(module)s %(message)s'
+    logging.basicConfig(format=FORMAT, level=getattr(logging,
+                                                     loglevel.upper()))
+    coloredlogs.install(level=loglevel.upper(), stream=sys.stderr)
+
+
+def settings_load(settings_file):
+    """ load settings from settings package """
+    logger.info('loading settings from %s' % (settings_file))
+    try:
+        settings_basename = os.path.basename(settings_file)
+        module_name = 'settings.%s' % (os.path.splitext(settings_basename)[0])
+        logger.debug(module_name)
+        settings_module = importlib.import_module(module_name)
+    except ImportError:
+        logger.error('no such file: %s' % (settings_file))
+        sys.exit('exiting')
+    settings = {}
+    try:
+        for setting in SETTINGS_KEY:
+            settings[setting] = getattr(settings_module, setting)
+    except AttributeError as ex:
+        logger.error('settings loading error: %s' % (ex))
+        sys.exit('exiting')
+    for setting, default in SETTINGS_OPTIONAL.items():
+        settings[setting] = getattr(settings_module, setting, default)
+    return settings
+
+
+def hostbook_paths(paths):
+    """ the inventory files to check, directories walked recursively """
+    hostbooks = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                hostbooks.extend(os.path.join(root, f) for f in sorted(files)
+                                 if f.endswith(('.yml', '.yaml')))
+        else:
+            hostbooks.append(path)
+    return hostbooks
+
+
+def worker_init(defaults, resources):
+    """ build the schema and its validator once per worker """
+    global schema
+    schema = YamlSchema(defaults, resources)
+
+
+def check_file(path):
+    """ worker task, the reports of every document of a file """
+    return schema.check_file(path)
+
+
+def validate(settings, paths, workers, cache=None):
+    """ check the inventory files, across worker processes if more than
+    one, return the document reports in the file order: the reports of
+    the files unchanged since the last run come from the cache """
+    results = {}
+    states = {}
+    if cache is not None:
+        for path in paths:
+            if path in results or not os.path.isfile(path):
+                continue
+            results[path], states[path] = cache.lookup(path, 'reports')
+        logger.info('%s files unchanged, from cache'
+                    % sum(1 for r in results.values() if r is not None))
+    missing = [path for path in paths if results.get(path) is None]
+
+    if workers > 1 and len(missing) > 1:
+        chunksize = max(1, len(missing) // (workers * 4))
+        with Pool(workers, worker_init, (settings['VM_DEFAULTS'],
+                                         settings['VM_RESOURCES'])) as pool:
+            checked = pool.map(check_file, missing, chunksize)
+    else:
+        worker_init(settings['VM_DEFAULTS'], settings['VM_RESOURCES'])
+        checked = [check_file(path) for path in missing]
+
+    for path, reports in zip(missing, checked):
+        results[path] = reports
+        if cache is not None and path in states:
+            cache.store(path, states[path], 'reports', reports)
+    if cache is not None:
+        cache.save()
+    return [report for path in paths for report in results[path]]
+
+
+def report_text(reports):
+    """ the errors of every invalid document and a summary """
+    lines = []
+    for report in reports:
+        if report['valid']:
+            continue
+        where = report['file']
+        if report['document'] is not None:
+            where = '%s[%s]' % (where, report['document'])
+        if report['name']:
+            where = '%s (%s)' % (where, report['name'])
+        lines.append('%s: %s errors' % (where, len(report['errors'])))
+        lines.extend('    %s' % error for error in report['errors'])
+    invalid = sum(1 for report in reports if not report['valid'])
+    lines.append('%s documents in %s files, %s invalid'
+                 % (len(reports), len(set(r['file'] for r in reports)),
+                    invalid))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    description = 'validate, check hostbooks against the inventory schema'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-s', '--settings', default='settings',
+                        help='custom settings file in settings package')
+    parser.add_argument('-w', '--workers', default=os.cpu_count() or 1,
+                        type=int, help='worker processes (default the cpu '
+                        'count)')
+    parser.add_argument('-o', '--output', default=OUTPUT_FORMATS[0],
+                        choices=OUTPUT_FORMATS,
+                        help='report format (default text)')
+    parser.add_argument('-n', '--no-cache', dest='cache',
+                        action='store_false',
+                        help='check also the files unchanged since the last '
+                        'run (default cached)')
+    parser.set_defaults(cache=True)
+    parser.add_argument('-l', '--log-level', default=LOG_LEVELS[2],
+                        help='log level (default warning)',
+                        choices=LOG_LEVELS)
+    parser.add_argument('inventory', nargs='+',
+                        help='yaml files (also multi-document) or '
+                        'directories of yaml files to check')
+
+    # parse cli options
+    cli_options = parser.parse_args()
+    log_init(cli_options.log_level)
+    logger.debug(cli_options)
+
+    # load settings from setting package
+    cfg = settings_load(cli_options.settings)
+
+    # reports of unchanged files reused
+    cache = None
+    if cfg['HOSTBOOK_CACHE'] and cli_options.cache:
+        cache = HostbookCache('%s/hostbooks.json' % cfg['TMP_DIR'],
+                              YamlSchema(cfg['VM_DEFAULTS'],
+                                         cfg['VM_RESOURCES']).fingerprint())
+
+    started = time.time()
+    paths = hostbook_paths(cli_options.inventory)
+    reports = validate(cfg, paths, cli_options.workers, cache)
+    logger.info('%s files checked in %.2fs' % (len(paths),
+                                               time.time() - started))
+
+    if cli_options.output == 'json':
+        print(json.dumps(reports, indent=2))
+    else:
+        print(report_text(reports))
+
+    if not reports or not all(report['valid'] for report in reports):
+        sys.exit(1)
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+
+from cluster import check_proxmox_response
+from yamlschema import VMID_MAX
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger('vmids')
+
+
+class VmidReservations:
+    """ vm ids reserved by the running deployments, from the choice of the
+    id to the end of the clone: kept in a json file locked while reserving,
+    so that concurrent runs and batch workers never get the same id. A
+    reservation expires after ttl seconds if its run died """
+    path = ''
+    ttl = 7200
+
+    def __init__(self, path, ttl=7200):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def locked(self, update):
+        """ run update on the current reservations under the file lock and
+        save them """
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with self.lock, open('%s.lock' % self.path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                reservations = {}
+                if os.path.exists(self.path):
+                    try:
+                        with open(self.path, 'r') as f:
+                            reservations = json.load(f)
+                    except ValueError:
+                        logger.warning('invalid reservations %s, reset'
+                                       % self.path)
+                now = time.time()
+                reservations = dict((vmid, reservation) for vmid, reservation
+                                    in reservations.items()
+                                    if now - reservation['time'] < self.ttl)
+                result = update(reservations)
+                tmp = '%s.%s' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(reservations, f, indent=2, sort_keys=True)
+                os.replace(tmp, self.path)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def reserve(self, connessione, name, vmid=None):
+        """ reserve the given vm id or, if None, the first id free on the
+        cluster and not reserved: exit if not available """
+        def update(reservations):
+            if vmid is not None:
+                reservation = reservations.get(str(vmid))
+                if reservation is not None and reservation['name'] != name:
+                    logger.error('vmid %s reserved by %s'
+                                 % (vmid, reservation['name']))
+                    sys.exit('exiting')
+                candidate = int(vmid)
+            else:
+                candidate = int(check_proxmox_response(
+                                connessione.getClusterVmNextId())['data'])
+                # recheck the next ids on the cluster, another run may have
+                # reserved them but not cloned yet
+                while str(candidate) in reservations or \
+                        not id_free(connessione, candidate):
+                    candidate += 1
+                    if candidate >= VMID_MAX:
+                        logger.error('no vmid free below %s' % VMID_MAX)
+                        sys.exit('exiting')
+            reservations[str(candidate)] = {'name': name, 'pid': os.getpid(),
+                                            'time': time.time()}
+            return str(candidate)
+        reserved = self.locked(update)
+        logger.info('vmid %s reserved for %s' % (reserved, name))
+        return reserved
+
+    def release(self, vmid):
+        """ drop a reservation, the vm exists or its deploy failed """
+        self.locked(lambda reservations: reservations.pop(str(vmid), None))
+        logger.debug('vmid %s released' % vmid)
+
+
+def id_free(connessione, vmid):
+    """ true if the id is not used on the cluster: proxmox answers 400 to
+    an id in use, any other error stops the run """
+    response = connessione.connect('get', 'cluster/nextid?vmid=%s' % vmid,
+                                   None)
+    if response['status']['code'] == 400:
+        return False
+    check_proxmox_response(response)
+    return True
@@ -4,13 +4,113 @@
 from cerberus import Validator
 import socket
 import yaml
+import hashlib
+import json
 import logging
 import sys
 import argparse
+import copy
 import os
+import threading
+
+# libyaml loader if available, several times faster than the python one
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 logger = logging.getLogger('yamlschema')
 
+# bump to drop the cached hostbooks when their format changes
+CACHE_VERSION = 1
+# vm ids allowed, up to this one excluded
+VMID_MAX = 10000
+
+
+class HostbookCache:
+    """ normalized hostbooks and validation reports of the inventory files,
+    json file: an entry is reused while the file has the same mtime and
+    size or, if touched, the same content hash, and the schema is the same
+    """
+    path = ''
+    fingerprint = ''
+    entries = {}
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    cached = json.load(f)
+                if cached.get('fingerprint') == fingerprint:
+                    self.entries = cached['entries']
+                else:
+                    logger.debug('schema changed, hostbook cache dropped')
+            except (ValueError, KeyError):
+                logger.warning('invalid hostbook cache %s, ignored' % path)
+
+    def lookup(self, filename, kind):
+        """ return the cached value of kind for the file, or None, and the
+        file state to store a new value with """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        with self.lock:
+            entry = self.entries.get(filename)
+        if entry is not None and entry['mtime'] == stat.st_mtime and \
+           entry['size'] == stat.st_size:
+            return entry.get(kind), self.state(entry)
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        state = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                 'sha1': digest}
+        if entry is not None and entry['sha1'] == digest:
+            # same content, only touched
+            with self.lock:
+                entry.update(state)
+                self.changed = True
+            return entry.get(kind), state
+        return None, state
+
+    def state(self, entry):
+        """ the file state of an entry """
+        return dict((key, entry[key]) for key in ('mtime', 'size', 'sha1'))
+
+    def store(self, filename, state, kind, value):
+        """ cache the value of kind computed for the file in state """
+        try:
+            json.dumps(value)
+        except TypeError:
+            logger.debug('%s not cacheable' % filename)
+            return
+        filename = os.path.abspath(filename)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or entry['sha1'] != state['sha1']:
+                entry = {}
+                self.entries[filename] = entry
+            entry.update(state)
+            entry[kind] = value
+            self.changed = True
+
+    def save(self):
+        """ write the cache if changed, replaced atomically """
+        with self.lock:
+            if not self.changed:
+                return
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            tmp = '%s.%s' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint,
+                           'entries': self.entries}, f)
+            os.replace(tmp, self.path)
+            self.changed = False
+
 
 class YamlSchema:
     defaults = {}
@@ -19,8 +119,10 @@ class YamlSchema:
     interfaces_schema = {}
     disks_schema = {}
     vm_schema = {}
+    validator = None
+    cache = None
 
-    def __init__(self, defaults, resources):
+    def __init__(self, defaults, resources, cache=None):
         self.defaults = defaults
         self.resources = resources
         self.hosts_schema = {
@@ -30,7 +132,7 @@ class YamlSchema:
                 'type': 'dict',
                 'schema': {
                     'ipaddress': {
-                        'type': 'ipaddress'
+                        'type': 'ipauto'
                     },
                     'name': {
                         'type': 'string',
@@ -59,8 +161,9 @@ class YamlSchema:
                         'type': 'boolean', 'default': False
                     },
                     'ipaddress': {
-                        'type': 'ipaddress',
-                        'dependencies': ['netmask', 'vlan']
+                        'type': 'ipauto',
+                        'dependencies': ['vlan'],
+                        'static_netmask': True
                     },
                     'netmask': {
                         'type': 'netmask',
@@ -68,7 +171,7 @@ class YamlSchema:
                     },
                     'gateway': {
                         'type': 'ipaddress',
-                        'dependencies': ['ipaddress', 'netmask']
+                        'dependencies': ['ipaddress']
                     },
                 }
             }
@@ -95,6 +198,11 @@ class YamlSchema:
                          'default': self.defaults['TEMPLATE']},
             'name': {'required': True, 'type': 'string'},
             'vmid': {'type': 'vmid', 'default': 'auto'},
+            'clone': {'type': 'string', 'allowed': ['full', 'linked'],
+                      'default': 'full'},
+            'customize': {'type': 'string',
+                          'allowed': ['rawinit', 'nocloud'],
+                          'default': 'rawinit'},
             'node': {'type': 'string', 'default': 'auto',
                      'allowed': self.resources['NODES']},
             'description': {'type': 'string'},
@@ -114,13 +222,29 @@ class YamlSchema:
                               'default': 'puppet.register.it'}
         }
 
+        if cache is not None:
+            self.cache = HostbookCache(cache, self.fingerprint())
+
     def get_vm_schema(self):
         """ return the current schema """
         return self.vm_schema
 
+    def fingerprint(self):
+        """ hash of the schema, cached hostbooks are valid only for it """
+        schema = json.dumps([CACHE_VERSION, self.vm_schema], sort_keys=True,
+                            default=str)
+        return hashlib.sha1(schema.encode()).hexdigest()
+
+    def get_validator(self):
+        """ the validator of the schema, built once and reused by every
+        document """
+        if self.validator is None:
+            self.validator = VMDefValidator(self.vm_schema)
+        return self.validator
+
     def is_valid(self, yaml):
         """ validator for the yaml inventory """
-        validator = VMDefValidator(self.vm_schema)
+        validator = self.get_validator()
         logger.debug(yaml)
         normalized_yaml = validator.normalized(yaml)
         isvalid = validator.validate(normalized_yaml)
@@ -131,17 +255,88 @@ class YamlSchema:
         path = self.argparse_exists(path)
         with open(path, 'r') as yaml_stream:
             try:
-                input_yaml = yaml.safe_load(yaml_stream)
+                input_yaml = yaml.load(yaml_stream, Loader=SafeLoader)
             except yaml.YAMLError as ex:
                 logger.error('YAML parsing exception: %s' % str(ex))
                 sys.exit('exiting')
-            input_yaml, isvalid, errors = self.is_valid(input_yaml)
-            if isvalid:
-                return input_yaml
+            return self.normalize(input_yaml, path)
+
+    def parse_all(self, path):
+        """ yaml parser of a multi-document inventory file or of a
+        directory of inventory files """
+        path = self.argparse_exists(path)
+        if os.path.isdir(path):
+            paths = [os.path.join(path, f) for f in sorted(os.listdir(path))
+                     if f.endswith(('.yml', '.yaml'))]
+        else:
+            paths = [path]
+        hostbooks = []
+        for hostbook in paths:
+            if self.cache is not None:
+                cached, state = self.cache.lookup(hostbook, 'documents')
+                if cached is not None:
+                    logger.debug('%s unchanged, from cache' % hostbook)
+                    # the hostbooks are changed in place by the deploy
+                    hostbooks.extend(copy.deepcopy(cached))
+                    continue
+            with open(hostbook, 'r') as yaml_stream:
+                try:
+                    documents = list(yaml.load_all(yaml_stream,
+                                                   Loader=SafeLoader))
+                except yaml.YAMLError as ex:
+                    logger.error('YAML parsing exception in %s: %s'
+                                 % (hostbook, str(ex)))
+                    sys.exit('exiting')
+            normalized = [self.normalize(document, hostbook)
+                          for document in documents if document is not None]
+            if self.cache is not None:
+                self.cache.store(hostbook, state, 'documents',
+                                 copy.deepcopy(normalized))
+            hostbooks.extend(normalized)
+        if self.cache is not None:
+            self.cache.save()
+        if not hostbooks:
+            logger.error('no inventory found in %s' % path)
+            sys.exit('exiting')
+        return hostbooks
+
+    def normalize(self, input_yaml, path):
+        """ validate a parsed inventory and exit on schema errors """
+        input_yaml, isvalid, errors = self.is_valid(input_yaml)
+        if isvalid:
+            return input_yaml
+        else:
+            logger.error('YAML schema error in %s: ' % path)
+            logger.error(errors)
+            sys.exit('exiting')
+
+    def check_file(self, path):
+        """ validate every document of an inventory file without exiting,
+        return a report with all the errors of each document """
+        try:
+            with open(path, 'r') as yaml_stream:
+                documents = list(yaml.load_all(yaml_stream,
+                                               Loader=SafeLoader))
+        except (IOError, yaml.YAMLError) as ex:
+            return [{'file': path, 'document': None, 'name': None,
+                     'valid': False, 'errors': [str(ex)]}]
+        reports = []
+        for i, document in enumerate(documents):
+            if document is None:
+                continue
+            report = {'file': path, 'document': i, 'name': None}
+            if isinstance(document, dict):
+                report['name'] = document.get('name')
+                document, isvalid, errors = self.is_valid(document)
+                report['errors'] = flatten_errors(errors)
             else:
-                logger.error('YAML schema error: ')
-                logger.error(errors)
-                sys.exit('exiting')
+                report['errors'] = ['the document is not a mapping']
+            report['valid'] = not report['errors']
+            reports.append(report)
+        if not reports:
+            reports.append({'file': path, 'document': None, 'name': None,
+                            'valid': False, 'errors': ['no inventory found']})
+        return reports
 
     def argparse_exists(self, path):
         """ custom argparse validator for input file """
@@ -152,6 +347,20 @@ class YamlSchema:
             return path
 
 
+def flatten_errors(errors, prefix=''):
+    """ cerberus nested errors as a list of 'field.path: message' """
+    messages = []
+    for field, field_errors in sorted(errors.items(),
+                                      key=lambda error: str(error[0])):
+        path = '%s%s' % (prefix, field)
+        for error in field_errors:
+            if isinstance(error, dict):
+                messages.extend(flatten_errors(error, '%s.' % path))
+            else:
+                messages.append('%s: %s' % (path, error))
+    return messages
+
+
 class VMDefValidator(Validator):
     def _validate_type_ipaddress(self, value):
         try:
@@ -160,6 +369,21 @@ class VMDefValidator(Validator):
         except socket.error:
             return False
 
+    def _validate_type_ipauto(self, value):
+        """ an address or auto, leased from the vlan subnet """
+        return value == 'auto' or self._validate_type_ipaddress(value)
+
+    def _validate_static_netmask(self, static_netmask, field, value):
+        """ a static address needs its netmask, an auto one gets the
+        netmask of the vlan subnet
+
+        The rule's arguments are validated against this schema:
+        {'type': 'boolean'}
+        """
+        if static_netmask and value != 'auto' and \
+                'netmask' not in self.document:
+            self._error(field, 'a static address needs a netmask')
+
     def _validate_type_netmask(self, value):
         if not self._validate_type_ipaddress(value):
             return False
@@ -177,7 +401,7 @@ class VMDefValidator(Validator):
     def _validate_type_vmid(self, value):
         if value == 'auto':
             return True
-        elif int(value) < 10000:
+        elif int(value) < VMID_MAX:
             return True
         else:
             return False